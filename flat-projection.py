@@ -32,6 +32,26 @@
 # 2019-06-28, jw, v0.9.3  added shading options.
 # 2019-07-01, jw, v0.9.4  Fixed manual rotation.
 # 2019-07-08, jw, v0.9.5  extra rotation added. We sometimes need out of order rotations.
+# 2026-10-17,     v0.9.6  Sweep-line z-sort from src/zsort2d.py replaces the all-pairs cmp2D() loop.
+#                         * option --zsort=pairs: vectorized, block-chunked cmp2D_batch().
+#                           Only pairs from overlap_pairs() are compared, most pairs cannot overlap in x.
+#                         * side walls are sorted in independent x_clusters().
+#                         * option --zsort_workers: sort clusters on a process pool.
+#                         * TSortArray: CSR adjacency and a heap. Unrelated faces keep document order.
+#                           Cycles are broken locally, instead of aborting with "cyclic dependency".
+#                         * O(n) edge visibility from face adjacency and edge position, no pairwise same_point3d().
+#                         * side walls are an indexed mesh: vertex buffer, edge and face index arrays.
+#                         * all subpaths are projected in one batch, subpaths are views into it.
+#                         * flat shading of all side faces in one vectorized pass, one SvgColor per distinct fill.
+#                         * options --style_classes, --shading_levels: each distinct style is written once.
+#                         * options --path_precision, --path_relative: compact path data, formatted per array.
+#                         * generated elements are queued as xml text and parsed once per group.
+#                         * option --curved_faces: front and back faces keep their curves, under a matrix.
+#                         * option --side_strips: smooth runs of side faces become one path each, shaded by a gradient.
+#                         * side faces that sort next to their coplanar neighbour of the same style merge into one path.
+#                         * option --cull_back: side faces pointing away are dropped for closed, opaque objects.
+#                         * option --clip: faces outside the page or a given rectangle are dropped, and counted.
+#                         * option --lod: sub-pixel side faces are dropped, nearly collinear points merged.
 #
 # TODO:
 #   * test: adjustment of line-width according to transformation.
@@ -125,6 +145,12 @@ else:   # Linux
 #                      Added traverse().
 # 2019-01-12 jw, v1.7e debug output to self.tty
 # 2019-01-15 jw, v1.7f tunnel transform as third item into paths tuple. needed for style stroke-width adjustment.
+#                v1.7g getNodeStyle() memoized per node, recursivelyTraverseSvg() carries the style down.
+#                v1.7h cssDictAdd() parses each rule once. getNodeStyleOne() caches per class combination,
+#                      tag.class selectors use the tag name without namespace, plain tag selectors work.
+#                v1.7i Added parseTransform() with a cache. recursivelyGetEnclosingTransform() memoized per ancestor.
+#                v1.7j Added getElementsById(), indexElement(): one id index for the document, also used with <use>.
+#                v1.7k getPathVertices() flattens elements referenced by <use> once, in their own coordinates.
 
 import gettext
 import re
@@ -308,7 +334,7 @@ class InkSvg():
     #    print(svg.paths)       # all coordinates in mm
 
     """
-    __version__ = "1.7f"
+    __version__ = "1.7k"
     DEFAULT_WIDTH = 100
     DEFAULT_HEIGHT = 100
 
@@ -332,8 +358,7 @@ class InkSvg():
         nodes = []
         for id in ids:
           if id != '':    # empty strings happen after splitting...
-            path = '//*[@id="%s"]' % id
-            el_list = self.document.xpath(path, namespaces=InkSvg.NSS)
+            el_list = self.getElementsById(id)
             if el_list:
               for node in el_list:
                 nodes.append(node)
@@ -342,6 +367,27 @@ class InkSvg():
         return nodes
 
 
+    def getElementsById(self, id):
+        """
+        Returns the list of all nodes with this id, in document order.
+        The index of all ids is built on first use. Add new nodes with indexElement().
+        """
+        if self.id_index is None:
+          self.id_index = {}
+          for node in self.document.getroot().iter(etree.Element):
+            self.indexElement(node)
+        return self.id_index.get(id, [])
+
+    def indexElement(self, node):
+        """
+        Add a node to the index of getElementsById(), e.g. after creating it.
+        """
+        if self.id_index is None: return        # built later, with node.
+        id = node.get('id')
+        if id:
+          self.id_index.setdefault(id, []).append(node)
+
+
     def load(self, filename):
         inkex.localize()
         # OO-Fail: cannot call inkex.Effect.parse(), Effect constructor has so many side-effects.
@@ -373,40 +419,59 @@ class InkSvg():
 
     def getNodeStyleOne(self, node):
         """
-        Finds style declarations by .class, #id or by tag.class syntax,
+        Finds style declarations by tag, .class, tag.class or #id syntax,
         and of course by a direct style='...' attribute.
+        The rules for each combination of tag and classes are merged once, then cached.
         # FIXME: stroke-width depends on the current transformation matrix scale.
         """
-        sheet = ''
-        selectors = []
+        tag = node.tag.split('}')[-1] if isinstance(node.tag, basestring) else ''
         classes = node.get('class', '')         # classes == None can happen here.
-        if classes is not None and classes != '':
-            selectors = ["."+cls for cls in re.split('[\s,]+', classes)]
-            selectors += [node.tag+sel for sel in selectors]
+        if classes is None: classes = ''
+        key = (tag, classes)
+        if key not in self.css_class_cache:
+            sheet = dict(self.css_dict.get(tag, {}))
+            if classes != '':
+                selectors = ["."+cls for cls in re.split('[\s,]+', classes)]
+                selectors += [tag+sel for sel in selectors]
+                for sel in selectors:
+                    sheet.update(self.css_dict.get(sel, {}))
+            self.css_class_cache[key] = sheet
+        sheet = dict(self.css_class_cache[key])
         node_id = node.get('id', '')
         if node_id is not None and node_id != '':
-            selectors += [ "#"+node_id ]
-        for sel in selectors:
-            if sel in self.css_dict:
-                sheet += '; '+self.css_dict[sel]
+            sheet.update(self.css_dict.get("#"+node_id, {}))
         style = node.get('style', '')
         if style is not None and style != '':
-            sheet += '; '+style
-        return simplestyle.parseStyle(sheet)
+            if style not in self.style_attr_cache:
+                self.style_attr_cache[style] = simplestyle.parseStyle(style)
+            sheet.update(self.style_attr_cache[style])
+        return sheet
 
     def getNodeStyle(self, node):
         """
         Recurse into parent group nodes, like simpletransform.ComposeParents
         Calling getNodeStyleOne() for each.
+        The result is memoized per node, callers must not modify it.
         """
-        combined_style = {}
+        if node in self.node_style:
+            return self.node_style[node]
+        parent_style = {}
         parent = node.getparent()
-        if parent.tag == inkex.addNS('g','svg') or parent.tag == 'g':
-            combined_style = self.getNodeStyle(parent)
+        if parent is not None and (parent.tag == inkex.addNS('g','svg') or parent.tag == 'g'):
+            parent_style = self.getNodeStyle(parent)
+        return self.getNodeStyleInherit(node, parent_style)
+
+    def getNodeStyleInherit(self, node, parent_style):
+        """
+        Combine parent_style, the style of the parent group as from getNodeStyle(), with the
+        style of node itself. The result is memoized for getNodeStyle().
+        """
+        combined_style = dict(parent_style)
         style = self.getNodeStyleOne(node)
         for s in style:
             # FIXME: stroke-width depends on the current transformation matrix scale.
             combined_style[s] = style[s]        # overwrite or add
+        self.node_style[node] = combined_style
         return combined_style
 
 
@@ -528,9 +593,12 @@ class InkSvg():
 
     def cssDictAdd(self, text):
         """
-        Represent css cdata as a hash in css_dict.
+        Represent css cdata as a hash in css_dict, from selector to a dict of declarations.
         Implements what is seen on: http://www.blooberry.com/indexdot/css/examples/cssembedded.htm
+        Styles memoized by getNodeStyle() and getNodeStyleOne() are dropped, new rules may apply to them.
         """
+        self.node_style = {}
+        self.css_class_cache = {}
         text=re.sub('^\s*(<!--)?\s*', '', text)
         while True:
             try:
@@ -544,11 +612,9 @@ class InkSvg():
             (val,text) = rest.split('}', 1)
             val = re.sub('/\*.*?\*/', '', val)      # replace comments nothing in values
             val = re.sub('\s+', ' ', val).strip()   # normalize whitespace
+            decl = simplestyle.parseStyle(val)      # parsed once per rule
             for k in keys:
-                if not k in self.css_dict:
-                    self.css_dict[k] = val
-                else:
-                    self.css_dict[k] += '; '+val
+                self.css_dict.setdefault(k, {}).update(decl)
 
 
     def roundedRectBezier(self, x, y, w, h, rx, ry=0):
@@ -676,6 +742,11 @@ class InkSvg():
 
         # cssDictAdd collects style definitions here:
         self.css_dict = {}
+        self.css_class_cache = {}       # getNodeStyleOne(): (tag, classes) -> merged rules
+        self.style_attr_cache = {}      # getNodeStyleOne(): style attribute -> parsed dict
+
+        # getNodeStyle() memoizes the combined style of each node here:
+        self.node_style = {}
 
         # For handling an SVG viewbox attribute, we will need to know the
         # values of the document's <svg> width and height attributes as well
@@ -685,6 +756,19 @@ class InkSvg():
         self.docHeight = float(self.DEFAULT_HEIGHT)
         self.docTransform = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]
 
+        # parseTransform() caches parsed transform attributes here, by their text.
+        # recursivelyGetEnclosingTransform() memoizes the transform each ancestor passes on to its children.
+        self.transform_cache = {}
+        self.enclosing_transform = {}
+
+        # getElementsById() indexes the document here, from id to a list of nodes.
+        self.id_index = None
+
+        # getPathVertices() keeps the flattened subpaths of nodes referenced by <use> here, untransformed.
+        # Keyed by (node, path d, smoothness in node coordinates). use_depth > 0 while inside a <use>.
+        self.instance_cache = {}
+        self.use_depth = 0
+
         # Dictionary of warnings issued.  This to prevent from warning
         # multiple times about the same problem
         self.warnings = {}
@@ -817,6 +901,7 @@ class InkSvg():
                     sx = self.docWidth  / float(vinfo[2])
                     sy = self.docHeight / float(vinfo[3])
                     self.docTransform = simpletransform.parseTransform('scale(%f,%f)' % (sx, sy))
+                    self.enclosing_transform = {}
 
     def getPathVertices(self, path, node=None, transform=None, smoothness=None):
 
@@ -839,29 +924,54 @@ class InkSvg():
             # Nothing to do
             return None
 
-        if node is not None:
-            path = self.styleDasharray(path, node)
-
-        # parsePath() may raise an exception.  This is okay
-        sp = simplepath.parsePath(path)
-        if (not sp) or (len(sp) == 0):
-            # Path must have been devoid of any real content
-            return None
-
-        # Get a cubic super path
-        p = cubicsuperpath.CubicSuperPath(sp)
-        if (not p) or (len(p) == 0):
-            # Probably never happens, but...
-            return None
-
-        if transform:
-            simpletransform.applyTransformToPath(transform, p)
-
-        # Now traverse the cubic super path
+        # Clones of the same node at the same scale share one flattening, done in node coordinates.
+        # Each clone then only applies its transform. The smoothness is divided by the largest
+        # stretch of the transform (its largest singular value), so that it holds in all directions.
+        instance = None
+        if self.use_depth and node is not None and transform:
+            (a, b, c, d) = (transform[0][0], transform[1][0], transform[0][1], transform[1][1])
+            q = a*a + b*b - c*c - d*d
+            scale = (0.5 * (a*a + b*b + c*c + d*d + (q*q + 4*(a*c + b*d)**2) ** 0.5)) ** 0.5
+            if scale > 0:
+                instance = (node, path, '%.6g' % (float(smoothness) / scale))
+
+        if instance is not None and instance in self.instance_cache:
+            vertex_lists = self.instance_cache[instance]
+        else:
+            if node is not None:
+                path = self.styleDasharray(path, node)
+
+            # parsePath() may raise an exception.  This is okay
+            sp = simplepath.parsePath(path)
+            if (not sp) or (len(sp) == 0):
+                # Path must have been devoid of any real content
+                return None
+
+            # Get a cubic super path
+            p = cubicsuperpath.CubicSuperPath(sp)
+            if (not p) or (len(p) == 0):
+                # Probably never happens, but...
+                return None
+
+            if transform and instance is None:
+                simpletransform.applyTransformToPath(transform, p)
+
+            vertex_lists = []
+            for sp in p:
+                self.subdivideCubicPath(sp, float(instance[2] if instance else smoothness))
+                vertex_lists.append([csp[1] for csp in sp])
+            if instance is not None:
+                self.instance_cache[instance] = vertex_lists
+
+        if instance is not None:
+            ((a, c, e), (b, d, f)) = transform
+            vertex_lists = [[[a*x + c*y + e, b*x + d*y + f] for (x, y) in v] for v in vertex_lists]
+
+        # Now traverse the flattened subpaths
         subpath_list = []
         subpath_vertices = []
 
-        for sp in p:
+        for vertices in vertex_lists:
 
             # We've started a new subpath
             # See if there is a prior subpath and whether we should keep it
@@ -869,23 +979,19 @@ class InkSvg():
                 subpath_list.append([subpath_vertices, [sp_xmin, sp_xmax, sp_ymin, sp_ymax]])
 
             subpath_vertices = []
-            self.subdivideCubicPath(sp, float(smoothness))
 
             # Note the first point of the subpath
-            first_point = sp[0][1]
+            first_point = vertices[0]
             subpath_vertices.append(first_point)
             sp_xmin = first_point[0]
             sp_xmax = first_point[0]
             sp_ymin = first_point[1]
             sp_ymax = first_point[1]
 
-            n = len(sp)
-
             # Traverse each point of the subpath
-            for csp in sp[1:n]:
+            for pt in vertices[1:]:
 
                 # Append the vertex to our list of vertices
-                pt = csp[1]
                 subpath_vertices.append(pt)
 
                 # Track the bounding box of this subpath
@@ -919,7 +1025,7 @@ class InkSvg():
 
 
     def recursivelyTraverseSvg(self, aNodeList, matCurrent=[[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]],
-                               parent_visibility='visible'):
+                               parent_visibility='visible', parent_style=None):
 
         '''
         [ This too is largely lifted from eggbot.py ]
@@ -940,6 +1046,9 @@ class InkSvg():
             processing directives
 
         All other SVG elements trigger an error (including <text>)
+
+        parent_style is the style of the group aNodeList, as from getNodeStyle().
+        Each node then only adds its own style, instead of walking up all its parents.
         '''
 
         for node in aNodeList:
@@ -952,23 +1061,30 @@ class InkSvg():
                 continue
 
             # FIXME: should we inherit styles from parents?
-            s = self.getNodeStyle(node)
+            if parent_style is not None and node not in self.node_style and \
+               self.node_style.get(node.getparent()) is parent_style:
+                s = self.getNodeStyleInherit(node, parent_style)
+            else:
+                s = self.getNodeStyle(node)     # also, when a style element invalidated parent_style.
             if s.get('display', '') == 'none': continue
 
             # First apply the current matrix transform to this node's tranform
-            matNew = simpletransform.composeTransform(
-                matCurrent, simpletransform.parseTransform(node.get("transform")))
+            transform = node.get("transform")
+            if transform:
+                matNew = simpletransform.composeTransform(matCurrent, self.parseTransform(transform))
+            else:
+                matNew = matCurrent
 
             if node.tag == inkex.addNS('g', 'svg') or node.tag == 'g':
 
-                self.recursivelyTraverseSvg(node, matNew, visibility)
+                self.recursivelyTraverseSvg(node, matNew, visibility, s)
 
             elif node.tag == inkex.addNS('use', 'svg') or node.tag == 'use':
 
                 # A <use> element refers to another SVG element via an
                 # xlink:href="#blah" attribute.  We will handle the element by
-                # doing an XPath search through the document, looking for the
-                # element with the matching id="blah" attribute.  We then
+                # looking up the element with the matching id="blah" attribute
+                # in the id index of the document.  We then
                 # recursively process that element after applying any necessary
                 # (x,y) translation.
                 #
@@ -985,18 +1101,21 @@ class InkSvg():
                     continue
 
                 # [1:] to ignore leading '#' in reference
-                path = '//*[@id="%s"]' % refid[1:]
-                refnode = node.xpath(path)
+                refnode = self.getElementsById(refid[1:])
                 if refnode:
                     x = float(node.get('x', '0'))
                     y = float(node.get('y', '0'))
                     # Note: the transform has already been applied
                     if (x != 0) or (y != 0):
-                        matNew2 = simpletransform.composeTransform(matNew, simpletransform.parseTransform('translate(%f,%f)' % (x, y)))
+                        matNew2 = simpletransform.composeTransform(matNew, [[1.0, 0.0, x], [0.0, 1.0, y]])
                     else:
                         matNew2 = matNew
                     visibility = node.get('visibility', visibility)
-                    self.recursivelyTraverseSvg(refnode, matNew2, visibility)
+                    self.use_depth += 1
+                    try:
+                        self.recursivelyTraverseSvg(refnode, matNew2, visibility)
+                    finally:
+                        self.use_depth -= 1
 
             elif node.tag == inkex.addNS('path', 'svg'):
 
@@ -1199,31 +1318,46 @@ class InkSvg():
                 inkex.errormsg('Warning: unable to draw object <%s>, please convert it to a path first.' % node.tag)
                 pass
 
+    def parseTransform(self, transform):
+
+        '''
+        simpletransform.parseTransform() with a cache by the attribute text.
+        The returned matrix is shared, callers must not modify it.
+        '''
+        if transform not in self.transform_cache:
+            self.transform_cache[transform] = simpletransform.parseTransform(transform)
+        return self.transform_cache[transform]
+
     def recursivelyGetEnclosingTransform(self, node):
 
         '''
         Determine the cumulative transform which node inherits from
         its chain of ancestors.
+        The transform each ancestor passes on is memoized, so that nodes
+        sharing ancestors only walk up to the first one seen before.
         '''
+        chain = []
         node = node.getparent()
-        if node is not None:
-            parent_transform = self.recursivelyGetEnclosingTransform(node)
-            node_transform = node.get('transform', None)
-            if node_transform is None:
-                return parent_transform
-            else:
-                tr = simpletransform.parseTransform(node_transform)
-                if parent_transform is None:
-                    return tr
-                else:
-                    return simpletransform.composeTransform(parent_transform, tr)
+        while node is not None and node not in self.enclosing_transform:
+            chain.append(node)
+            node = node.getparent()
+        if node is None:
+            mat = self.docTransform
         else:
-            return self.docTransform
+            mat = self.enclosing_transform[node]
+        for node in reversed(chain):
+            node_transform = node.get('transform', None)
+            if node_transform is not None:
+                mat = simpletransform.composeTransform(mat, self.parseTransform(node_transform))
+            self.enclosing_transform[node] = mat
+        return mat
 
 #! /usr/bin/python3
 #
 
 from collections import defaultdict     # minimum python 2.5
+import heapq
+import numpy as np
 
 class TSort:
     """
@@ -1238,6 +1372,11 @@ class TSort:
     def addPre(self, u, v):
         self.graph[u].append(v)
 
+    def addEdges(self, u, v):
+        """ addPre(u[i], v[i]) for all i """
+        for (i, j) in zip(list(u), list(v)):
+            self.graph[int(i)].append(int(j))
+
     def sort(self):
         # Create a vector to store indegrees of all vertices.
         # Initialize all indegrees as 0.
@@ -1284,11 +1423,172 @@ class TSort:
             raise Exception("cyclic dependency")
         return top_order
 
+class TSortArray:
+    """
+    Kahn's Algorithm for topological ordering, array backed.
+
+    Same interface as TSort, but edges are collected in bulk, e.g. as numpy arrays
+    from zsort2d.batch_edges(), and turned into a CSR adjacency (indptr, indices)
+    only once, when sort() is called. A heap keyed on the vertex index replaces the
+    O(V) queue.pop(0) of TSort. Vertices that are not ordered by any edge come out
+    in index order, so the result is deterministic and stable: the smallest possible
+    topological order in lexicographic sense.
+
+    With break_cycles=True, a cyclic dependency does not abort the sort. The strongly
+    connected components of the vertices left over by Kahn's algorithm are found with
+    Tarjan's algorithm. Inside each component, the vertices fall back to the order
+    given by key, e.g. their average depth (key defaults to the vertex index; ties are
+    broken by index), and the sort is repeated. Self-loops are dropped. Edges between
+    components are kept, so the result only differs locally. The number of cycles
+    resolved is left in cycles_broken, the number of edges that had to be reversed or
+    dropped in edges_dropped.
+    """
+
+    def __init__(self, vertices, break_cycles=False, key=None):
+        self.V = vertices               # No. of vertices
+        self.break_cycles = break_cycles
+        self.key = key                  # fallback order inside cycles, e.g. average depth
+        self.cycles_broken = 0
+        self.edges_dropped = 0
+        self._u = []                    # list of edge source arrays
+        self._v = []                    # list of edge destination arrays
+        self._pre = []                  # single edges from addPre()
+
+    def addPre(self, u, v):
+        self._pre.append((u, v))
+
+    def addEdges(self, u, v):
+        """ addPre(u[i], v[i]) for all i, without a python call per edge """
+        self._u.append(np.asarray(u, dtype=np.intp).ravel())
+        self._v.append(np.asarray(v, dtype=np.intp).ravel())
+
+    def _edges(self):
+        """ Returns (u, v) arrays of all edges added so far """
+        u = self._u[:]
+        v = self._v[:]
+        if self._pre:
+            pre = np.array(self._pre, dtype=np.intp).reshape(-1, 2)
+            u.append(pre[:,0])
+            v.append(pre[:,1])
+        if not u:
+            return (np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp))
+        return (np.concatenate(u), np.concatenate(v))
+
+    def _csr(self, u, v):
+        """ Returns (indptr, indices) as python lists. Edges of vertex i are indices[indptr[i]:indptr[i+1]] """
+        order = np.argsort(u, kind='mergesort')
+        indptr = np.zeros(self.V+1, dtype=np.intp)
+        np.cumsum(np.bincount(u, minlength=self.V), out=indptr[1:])
+        return (indptr.tolist(), v[order].tolist())
+
+    def _kahn(self, indptr, indices, in_degree):
+        # all vertices with indegree 0. A sorted list already is a heap.
+        heap = [i for i in range(self.V) if in_degree[i] == 0]
+        top_order = []
+        while heap:
+            u = heapq.heappop(heap)
+            top_order.append(u)
+            for i in indices[indptr[u]:indptr[u+1]]:
+                in_degree[i] -= 1
+                if in_degree[i] == 0:
+                    heapq.heappush(heap, i)
+        return top_order
+
+    def _scc(self, alive, indptr, indices):
+        """
+        Tarjan's algorithm, iterative, restricted to vertices with alive[i] True.
+        Returns a list of components with more than one vertex.
+        """
+        index = [-1]*self.V
+        low = [0]*self.V
+        onstack = [False]*self.V
+        stack = []
+        comps = []
+        counter = 0
+        for root in range(self.V):
+            if not alive[root] or index[root] >= 0:
+                continue
+            index[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            onstack[root] = True
+            work = [[root, indptr[root]]]
+            while work:
+                (v, p) = work[-1]
+                if p < indptr[v+1]:
+                    work[-1][1] = p+1
+                    w = indices[p]
+                    if not alive[w]:
+                        continue
+                    if index[w] < 0:
+                        index[w] = low[w] = counter
+                        counter += 1
+                        stack.append(w)
+                        onstack[w] = True
+                        work.append([w, indptr[w]])
+                    elif onstack[w]:
+                        low[v] = min(low[v], index[w])
+                else:
+                    work.pop()
+                    if work:
+                        u = work[-1][0]
+                        low[u] = min(low[u], low[v])
+                    if low[v] == index[v]:
+                        comp = []
+                        while True:
+                            w = stack.pop()
+                            onstack[w] = False
+                            comp.append(w)
+                            if w == v: break
+                        if len(comp) > 1:
+                            comps.append(comp)
+        return comps
+
+    def sort(self):
+        (u, v) = self._edges()
+        (indptr, indices) = self._csr(u, v)
+        in_degree = np.bincount(v, minlength=self.V).tolist()
+        top_order = self._kahn(indptr, indices, in_degree[:])
+
+        # Check if there was a cycle
+        if len(top_order) != self.V:
+            if not self.break_cycles:
+                raise Exception("cyclic dependency")
+            alive = [True]*self.V
+            for i in top_order:
+                alive[i] = False
+            comp_id = np.full(self.V, -1, dtype=np.intp)
+            comps = self._scc(alive, indptr, indices)
+            for c in range(len(comps)):
+                comp_id[comps[c]] = c
+            # rank all vertices by the fallback order.
+            key = np.arange(self.V) if self.key is None else np.asarray(self.key)
+            rank = np.empty(self.V, dtype=np.intp)
+            rank[np.lexsort((np.arange(self.V), key))] = np.arange(self.V)
+            loop = (u == v)
+            inside = (comp_id[u] >= 0) & (comp_id[u] == comp_id[v])
+            self.cycles_broken = len(comps) + len(set(u[loop & (comp_id[u] < 0)].tolist()))
+            self.edges_dropped = int(np.count_nonzero((inside & (rank[u] > rank[v])) | loop))
+            # replace the edges inside each component with a chain in fallback order.
+            chain_u = []
+            chain_v = []
+            for c in comps:
+                c = sorted(c, key=lambda i: rank[i])
+                chain_u += c[:-1]
+                chain_v += c[1:]
+            keep = ~(inside | loop)
+            u = np.concatenate((u[keep], np.array(chain_u, dtype=np.intp)))
+            v = np.concatenate((v[keep], np.array(chain_v, dtype=np.intp)))
+            (indptr, indices) = self._csr(u, v)
+            top_order = self._kahn(indptr, indices, np.bincount(v, minlength=self.V).tolist())
+        return top_order
+
 #! /usr/bin/python
 #
 # 'yellowgreen': '#9acd32'
 
 import simplestyle
+import numpy as np
 
 class SvgColor:
     """ Manipulate color strings for svg style attributes """
@@ -1378,6 +1678,22 @@ class SvgColor:
         self._rgb = self._hsl_to_rgb(hsl)
         return self._rgb
 
+    def adjusted_light(self, adjust):
+        """ adjust_light() for an array of adjust values. Returns a list of color strings, self is unchanged. """
+        (h, s, l) = self._rgb_to_hsl(self._rgb)
+        l = l + np.asarray(adjust, dtype=float)
+        if s == 0:
+            rgb = [l, l, l]
+        else:
+            v2 = np.where(l < 0.5, l * (1 + s), l + s - l*s)
+            v1 = 2*l - v2
+            rgb = [self._hue_2_rgb(v1, v2, h*6 + 2.0), self._hue_2_rgb(v1, v2, h*6), self._hue_2_rgb(v1, v2, h*6 - 2.0)]
+        rgb = np.floor(np.clip(np.transpose(rgb), 0, 255) + .5).astype(int)
+        # few distinct colors: format each only once.
+        (code, inv) = np.unique(rgb[:,0]*65536 + rgb[:,1]*256 + rgb[:,2], return_inverse=True)
+        names = ["#%06x" % c for c in code.tolist()]
+        return [names[i] for i in inv.ravel().tolist()]
+
     def __repr__(self):
         rgb = self._clamp_rgb(self._rgb)
         return "#%02x%02x%02x" % (int(rgb[0]+.5), int(rgb[1]+.5), int(rgb[2]+.5))
@@ -1386,12 +1702,515 @@ class SvgColor:
         return self.__repr__()
 
 
+#! /usr/bin/python3
+#
+# zsort2d.py -- depth ordering of the side walls, reduced to line segments in 2D.
+#
+# Distribute under GPLv2 or ask.
+#
+# All side walls span between two parallel planes. Seen along the eye vector, each
+# quad-face collapses to a two-point line in 2D. After rotating that 2D plane so that the
+# eye vector points exactly downwards, a segment with a smaller y coordinate at a common x
+# sorts in front of (is drawn before) a segment with a larger y coordinate.
+#
+# Each segment is a list [p0, p1, ...] where p0 and p1 are xy points. Additional
+# list members are ignored. Segments are referenced by their index in the segment list.
+
+import numpy as np
+import multiprocessing
+import random
+try:
+  from multiprocessing import shared_memory     # python >= 3.8
+except ImportError:
+  shared_memory = None
+
+ZSORT_EPS = 0.000001
+
+
+def y_at_x(gp, gv, x):
+  dx = x-gp[0]
+  if abs(gv[0]) < ZSORT_EPS:
+    return None
+  s = dx/gv[0]
+  if s < 0.0 or s > 1.0:
+    return None
+  return gp[1]+s*gv[1]
+
+
+def cmp2D(g1, g2):
+  """
+  returns -1 if g1 sorts in front of g2
+  returns 1  if g1 sorts in behind g2
+  returns None  if there was no clear decision
+  """
+  # convert g1 into point and vector:
+  g1p = g1[0]
+  g1v = (g1[1][0] - g1[0][0], g1[1][1] - g1[0][1])
+  #
+  y = y_at_x(g1p, g1v, g2[0][0])
+  if y is not None:
+    if y < g2[0][1]-ZSORT_EPS: return -1
+    if y > g2[0][1]+ZSORT_EPS: return 1
+  #
+  y = y_at_x(g1p, g1v, g2[1][0])
+  if y is not None:
+    if y < g2[1][1]-ZSORT_EPS: return -1
+    if y > g2[1][1]+ZSORT_EPS: return 1
+  #
+  g2p = g2[0]
+  g2v = (g2[1][0] - g2[0][0], g2[1][1] - g2[0][1])
+  y = y_at_x(g2p, g2v, g1[0][0])
+  if y is not None:
+    if g1[0][1]+ZSORT_EPS < y: return -1
+    if g1[0][1]-ZSORT_EPS > y: return 1
+  #
+  y = y_at_x(g2p, g2v, g1[1][0])
+  if y is not None:
+    if g1[1][1]+ZSORT_EPS < y: return -1
+    if g1[1][1]-ZSORT_EPS > y: return 1
+  #
+  return None   # non-comparable pair in the poset. sorted() would take that as less than aka -1
+
+
+def sweep_edges(segs):
+  """
+  Sweep-line ordering engine. Returns a list of (i, j) index pairs, meaning segs[i]
+  sorts in front of segs[j]. The pairs are meant to be fed into TSort.addPre().
+
+  The segments are walked by x. An active list holds all segments spanning the current
+  x, ordered by their y coordinate there. Only segments that become vertically adjacent
+  in the active list are compared. All other relations follow by transitivity, as
+  the side walls of flat objects do not cross each other. This produces O(n) edges in
+  O(n log n) comparisons, instead of the O(n^2) calls of cmp2D() for all pairs.
+  The active list is a skip list, so that each insert and removal costs O(log n).
+
+  Vertical segments (faces seen edge-on) are not inserted into the active list.
+  They are only related to their neighbours below and above, after all segments
+  starting at their x are inserted and before those ending there are removed.
+  Two vertical segments are never compared, same as with cmp2D().
+  Event x coordinates closer than ZSORT_EPS count as the same x, so that segments
+  touching at an end point, or a vertical segment slightly off, still meet.
+  """
+  n = len(segs)
+  xl = [0.0]*n          # left end point
+  yl = [0.0]*n
+  xr = [0.0]*n          # right end point
+  yr = [0.0]*n
+  slope = [0.0]*n
+  events = []
+  for i in range(n):
+    (ax, ay) = (float(segs[i][0][0]), float(segs[i][0][1]))
+    (bx, by) = (float(segs[i][1][0]), float(segs[i][1][1]))
+    if bx < ax:
+      (ax, ay, bx, by) = (bx, by, ax, ay)
+    (xl[i], yl[i], xr[i], yr[i]) = (ax, ay, bx, by)
+    if bx - ax < ZSORT_EPS:
+      slope[i] = None
+      if abs(by - ay) > 2*ZSORT_EPS:
+        events.append((ax, 1, i))   # vertical: after insertions, before removals
+    else:
+      slope[i] = (by - ay) / (bx - ax)
+      events.append((ax, 0, i))     # insert
+      events.append((bx, 2, i))     # remove
+  # snap event x to the first x of its group. A group spans at most ZSORT_EPS.
+  events.sort()
+  x0 = None
+  for k in range(len(events)):
+    if x0 is None or events[k][0] > x0 + ZSORT_EPS:
+      x0 = events[k][0]
+    events[k] = (x0, events[k][1], events[k][2])
+  events.sort()
+
+  def y_of(i, x):
+    if x <= xl[i]: return yl[i]
+    if x >= xr[i]: return yr[i]
+    return yl[i] + (x - xl[i]) * slope[i]
+
+  def above(t, x, y, s):
+    """ True if active segment t is above point (x, y) going in direction s """
+    d = y_of(t, x) - y
+    return d > ZSORT_EPS or (d >= -ZSORT_EPS and s is not None and slope[t] > s)
+
+  # skip list. Node n is the head, NIL ends a level. nxt[i][l], prv[i][l] link node i on level l.
+  NIL = -1
+  MAXL = 32
+  nxt = [None]*(n+1)
+  prv = [None]*(n+1)
+  nxt[n] = [NIL]*MAXL
+  level = [1]             # levels in use
+  rand = random.Random(0x5eed)   # node heights, reproducible
+
+  def find(x, y, s):
+    """ The last node per level that is not above point (x, y) going in direction s """
+    update = [n]*MAXL
+    t = n
+    for l in range(level[0]-1, -1, -1):
+      while nxt[t][l] != NIL and not above(nxt[t][l], x, y, s):
+        t = nxt[t][l]
+      update[l] = t
+    return update
+
+  edges = []
+  for (x, kind, i) in events:
+    if kind == 2:
+      (lo, hi) = (prv[i][0], nxt[i][0])
+      if lo != n and hi != NIL:
+        edges.append((lo, hi))
+      for l in range(len(nxt[i])):
+        nxt[prv[i][l]][l] = nxt[i][l]
+        if nxt[i][l] != NIL:
+          prv[nxt[i][l]][l] = prv[i][l]
+    elif kind == 0:
+      update = find(x, yl[i], slope[i])
+      h = 1
+      while h < MAXL and rand.random() < 0.5:
+        h += 1
+      level[0] = max(level[0], h)
+      if update[0] != n:
+        edges.append((update[0], i))
+      if nxt[update[0]][0] != NIL:
+        edges.append((i, nxt[update[0]][0]))
+      nxt[i] = [NIL]*h
+      prv[i] = [n]*h
+      for l in range(h):
+        t = update[l]
+        (nxt[i][l], prv[i][l]) = (nxt[t][l], t)
+        if nxt[t][l] != NIL:
+          prv[nxt[t][l]][l] = i
+        nxt[t][l] = i
+    else:
+      (ylo, yhi) = (min(yl[i], yr[i]), max(yl[i], yr[i]))
+      t = find(x, ylo, None)[0]
+      if t != n:
+        edges.append((t, i))
+      t = nxt[find(x, yhi - 2*ZSORT_EPS, None)[0]][0]
+      if t != NIL:
+        edges.append((i, t))
+  return edges
+
+
+def seg_rows(segs):
+  """ Pack the end points of segs into an (n, 4) array of rows x0, y0, x1, y1. """
+  a = np.zeros((len(segs), 4))
+  for i in range(len(segs)):
+    a[i] = (segs[i][0][0], segs[i][0][1], segs[i][1][0], segs[i][1][1])
+  return a
+
+
+def seg_arrays(segs):
+  """
+  Precompute per-segment arrays for cmp2D_batch(), once for all segs.
+  segs can also be given as seg_rows().
+  Returns a dict of numpy arrays, indexed by segment index:
+  x0, y0, x1, y1: the end points as given,
+  xmin, xmax: the x-range,
+  dx, dy: the direction vector. y_at_x() interpolates along it, and so do we,
+  so that batch results agree exactly with cmp2D(), also at the end points.
+  vert: True for vertical segments, where y_at_x() has no answer.
+  """
+  a = segs if isinstance(segs, np.ndarray) else seg_rows(segs)
+  (x0, y0, x1, y1) = (a[:,0], a[:,1], a[:,2], a[:,3])
+  dx = x1 - x0
+  vert = np.abs(dx) < ZSORT_EPS
+  return { 'x0': x0, 'y0': y0, 'x1': x1, 'y1': y1,
+           'xmin': np.minimum(x0, x1), 'xmax': np.maximum(x0, x1),
+           'dx': np.where(vert, 1.0, dx), 'dy': y1 - y0, 'vert': vert }
+
+
+def cmp2D_batch(arrs, I, J):
+  """
+  Vectorized cmp2D() for the candidate pairs (I[k], J[k]). arrs is from seg_arrays().
+  Returns an int8 array r, where r[k] is the cmp2D(segs[I[k]], segs[J[k]]) result.
+  None is represented as 0.
+  The four end point tests of cmp2D() are applied in the same order. The first decisive
+  test wins.
+  """
+  I = np.asarray(I, dtype=np.intp)
+  J = np.asarray(J, dtype=np.intp)
+  r = np.zeros(len(I), dtype=np.int8)
+  open_ = np.ones(len(I), dtype=bool)
+
+  def test(g, px, py, sign):
+    # y_at_x() of line g at px, compared with py. sign=1 for g=I, sign=-1 for g=J.
+    s = (px - arrs['x0'][g]) / arrs['dx'][g]
+    ok = open_ & ~arrs['vert'][g] & (s >= 0.0) & (s <= 1.0)
+    d = sign * (arrs['y0'][g] + s * arrs['dy'][g] - py)
+    lt = ok & (d < -ZSORT_EPS)
+    gt = ok & (d > ZSORT_EPS)
+    r[lt] = -1
+    r[gt] = 1
+    open_[lt | gt] = False
+
+  test(I, arrs['x0'][J], arrs['y0'][J],  1)
+  test(I, arrs['x1'][J], arrs['y1'][J],  1)
+  test(J, arrs['x0'][I], arrs['y0'][I], -1)
+  test(J, arrs['x1'][I], arrs['y1'][I], -1)
+  return r
+
+
+def _run_blocks(first, lens, block_size):
+  """
+  Row p stands for the run of partners first[p] .. first[p]+lens[p]-1.
+  Generate (P, Q) arrays of all row/partner combinations, cut between rows
+  into blocks of about block_size pairs. A single long row is never split.
+  """
+  block_size = max(1, int(block_size))
+  cum = np.cumsum(lens)
+  n = len(lens)
+  p = 0
+  done = 0
+  while p < n:
+    p1 = max(p+1, int(np.searchsorted(cum, done + block_size, side='right')))
+    rows = np.arange(p, p1, dtype=np.intp)
+    l = lens[p:p1]
+    cnt = int(cum[p1-1]) - done
+    if cnt > 0:
+      P = np.repeat(rows, l)
+      Q = np.arange(cnt, dtype=np.intp) - np.repeat(np.cumsum(l) - l, l) + np.repeat(first[p:p1], l)
+      yield (P, Q)
+    done += cnt
+    p = p1
+
+
+def pair_blocks(n, block_size=100000):
+  """
+  Generate all pairs i < j of n segments as (I, J) index arrays,
+  in blocks of about block_size pairs. Peak memory is bounded by the block size,
+  not by n^2.
+  """
+  rows = np.arange(n, dtype=np.intp)
+  return _run_blocks(rows+1, n-rows-1, block_size)
+
+
+def overlap_pairs(arrs, block_size=100000):
+  """
+  Generate only those pairs i < j of segments whose x-ranges overlap, as (I, J) index
+  arrays in blocks of about block_size pairs. arrs is from seg_arrays().
+  All other pairs are non-comparable for cmp2D(), as y_at_x() returns None for them.
+
+  Sort and sweep: with segments sorted by xmin, the partners of a segment are all
+  following segments up to the first one that starts right of its xmax.
+  """
+  n = len(arrs['xmin'])
+  order = np.argsort(arrs['xmin'], kind='mergesort')
+  xs = arrs['xmin'][order]
+  first = np.arange(1, n+1, dtype=np.intp)
+  hi = np.searchsorted(xs, arrs['xmax'][order] + ZSORT_EPS, side='right')
+  for (P, Q) in _run_blocks(first, hi - first, block_size):
+    (I, J) = (order[P], order[Q])
+    yield (np.minimum(I, J), np.maximum(I, J))
+
+
+def batch_edges(arrs, blocks):
+  """
+  Decide all (I, J) candidate blocks with cmp2D_batch().
+  Returns two index arrays (u, v). Each u[k] sorts in front of v[k], ready for TSort.addPre().
+  Undecided pairs are dropped.
+  """
+  us = []
+  vs = []
+  for (I, J) in blocks:
+    r = cmp2D_batch(arrs, I, J)
+    lt = r < 0
+    gt = r > 0
+    us.append(I[lt])
+    vs.append(J[lt])
+    us.append(J[gt])
+    vs.append(I[gt])
+  if not us:
+    return (np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp))
+  return (np.concatenate(us), np.concatenate(vs))
+
+
+def x_clusters(arrs):
+  """
+  Split the segments into independent clusters. arrs is from seg_arrays().
+  Two segments are in the same cluster, if their x-ranges overlap, directly
+  or through a chain of other segments. Segments of different clusters are
+  never comparable, so each cluster can be sorted on its own, and the results
+  concatenated. This bounds the cost by the largest cluster, not by the whole document.
+
+  Returns a list of index arrays, ordered by x. Indices within a cluster are ascending,
+  so that document order is preserved where nothing else decides.
+  """
+  n = len(arrs['xmin'])
+  if n == 0:
+    return []
+  order = np.argsort(arrs['xmin'], kind='mergesort')
+  reach = np.maximum.accumulate(arrs['xmax'][order])
+  # a new cluster starts where a segment begins right of everything seen before.
+  cut = np.nonzero(arrs['xmin'][order][1:] > reach[:-1] + ZSORT_EPS)[0] + 1
+  return [np.sort(c) for c in np.split(order, cut)]
+
+
+def winding_numbers(rows, pts, block_size=100000):
+  """
+  The winding number of each point in pts around the closed polygons, whose segments are
+  the rows x0, y0, x1, y1 (as from seg_rows()). pts is an array of x, y.
+  Counterclockwise in a y-up frame counts +1. At most block_size point-segment pairs
+  are compared at once.
+  """
+  rows = np.asarray(rows, dtype=float).reshape(-1, 4)
+  pts = np.asarray(pts, dtype=float).reshape(-1, 2)
+  (x0, y0, x1, y1) = (rows[:,0], rows[:,1], rows[:,2], rows[:,3])
+  w = np.zeros(len(pts), dtype=int)
+  step = max(1, block_size // max(1, len(rows)))
+  for b in range(0, len(pts), step):
+    px = pts[b:b+step, 0:1]
+    py = pts[b:b+step, 1:2]
+    side = (x1 - x0) * (py - y0) - (px - x0) * (y1 - y0)    # > 0: the point is left of the segment
+    w[b:b+step] = ((y0 <= py) & (y1 > py) & (side > 0)).sum(axis=1) - ((y0 > py) & (y1 <= py) & (side < 0)).sum(axis=1)
+  return w
+
+
+def facing_away(rows, rings, R, evenodd=False, probe=0.0001, eps=ZSORT_EPS):
+  """
+  The side faces of a closed, filled object that point away from the viewer.
+  rows are the seg_rows() of the outline in the object plane, rings is a list of
+  (first row, number of rows), one per closed subpath. R rotates object coordinates
+  (row vectors) into the view. The viewer looks from -z.
+  The filled side of a ring is probed once, just left of its longest segment, at probe
+  times the segment length. Only rings whose bounding box contains the probe are counted.
+  Rings must not cross each other, then all segments of a ring have the filled side
+  on the same side.
+  Returns a bool array, True where the outward normal of a segment points away.
+  """
+  rows = np.asarray(rows, dtype=float).reshape(-1, 4)
+  left = np.column_stack((rows[:,1]-rows[:,3], rows[:,2]-rows[:,0]))
+  first = np.array([r[0] for r in rings], dtype=np.intp)
+  last = first + np.array([r[1] for r in rings], dtype=np.intp)
+  (x, y) = (rows[:,0], rows[:,1])       # the rings are closed: all points are a start point.
+  box = [(x[f:l].min(), y[f:l].min(), x[f:l].max(), y[f:l].max()) if l > f else (0, 0, -1, -1)
+         for (f, l) in zip(first.tolist(), last.tolist())]
+  box = np.array(box, dtype=float).reshape(-1, 4)
+  sign = np.ones(len(rows))
+  for r in range(len(first)):
+    (f, l) = (first[r], last[r])
+    if l <= f: continue
+    j = f + int(np.argmax((left[f:l]**2).sum(axis=1)))
+    p = (rows[j,:2] + rows[j,2:]) / 2 + probe * left[j]
+    near = np.nonzero((box[:,0] <= p[0]) & (box[:,2] >= p[0]) & (box[:,1] <= p[1]) & (box[:,3] >= p[1]))[0]
+    if len(near) == 0: continue         # outside of all rings
+    w = winding_numbers(rows[np.concatenate([np.arange(first[k], last[k]) for k in near])], [p])[0]
+    if (w % 2 != 0) if evenodd else (w != 0):
+      sign[f:l] = -1                    # the filled side is left: the outward normal points right.
+  n3 = np.matmul(np.column_stack((sign[:,None] * left, np.zeros(len(rows)))), R)
+  return n3[:,2] > eps * np.linalg.norm(n3, axis=1)
+
+
+def cluster_order(rows, idx, engine='sweep', block_size=100000, tsort=None, groups=None):
+  """
+  Sort one cluster of segments. rows are the seg_rows() of all segments,
+  idx is the list of segment indices in the cluster.
+  engine is 'sweep' for sweep_edges() or 'pairs' for cmp2D_batch() of overlap_pairs().
+  tsort is the topological sort class, e.g. TSortArray. Edges are passed in bulk with addEdges().
+  Cycles are broken inside the cluster, falling back to the average y (depth) of the segments.
+  With groups (groups[i] is the group id of segment idx[i]), the segments of a group are sorted
+  as one unit: edges between segments become edges between their groups.
+  Returns (idx reordered frontmost last, or the group ids with groups, number of cycles broken).
+  """
+  if len(idx) < 2:
+    return ((list(idx) if groups is None else [int(g) for g in groups]), 0)
+  sub = rows[idx]
+  key = sub[:,1]+sub[:,3]
+  if engine == 'pairs':
+    arrs = seg_arrays(sub)
+    (u, v) = batch_edges(arrs, overlap_pairs(arrs, block_size))
+  else:
+    e = np.array(sweep_edges([((r[0], r[1]), (r[2], r[3])) for r in sub.tolist()]), dtype=np.intp).reshape(-1, 2)
+    (u, v) = (e[:,0], e[:,1])
+  ids = idx
+  if groups is not None:
+    (ids, inv) = np.unique(np.asarray(groups), return_inverse=True)
+    inv = inv.ravel()
+    key = np.bincount(inv, weights=key) / np.bincount(inv)
+    (u, v) = (inv[u], inv[v])
+    keep = u != v
+    (u, v) = (u[keep], v[keep])
+    ids = ids.tolist()
+  k = tsort(len(ids), break_cycles=True, key=key)
+  k.addEdges(u, v)
+  order = k.sort()
+  return ([ids[i] for i in order], k.cycles_broken)
+
+
+def _cluster_order_shm(task):
+  """ Pool worker for zsort_clusters(): cluster_order() on rows found in shared memory. """
+  (name, n, idx, engine, block_size, tsort, groups) = task
+  try:
+    shm = shared_memory.SharedMemory(name=name, track=False)   # python >= 3.13
+  except TypeError:
+    shm = shared_memory.SharedMemory(name=name)
+  try:
+    rows = np.ndarray((n, 4), dtype=np.float64, buffer=shm.buf)
+    return cluster_order(rows, idx, engine, block_size, tsort, groups)
+  finally:
+    rows = None         # release the buffer before closing.
+    shm.close()
+
+
+def zsort_clusters(rows, clusters, engine='sweep', block_size=100000, tsort=None, workers=1, group=None):
+  """
+  Sort independent clusters (from x_clusters()) with cluster_order() and concatenate
+  the results in cluster order. Returns (order, number of cycles broken).
+  With group (an array of one group id per segment), the order is a list of group ids.
+  All segments of a group must be in the same cluster.
+
+  With workers > 1 the clusters are sorted concurrently on a process pool. workers=0
+  uses one process per CPU. The rows are passed to the workers through
+  multiprocessing.shared_memory, only the index lists are pickled. The result is the
+  same as with workers=1. Without shared_memory (python < 3.8), or with less than two
+  clusters to sort, everything runs in this process.
+  """
+  clusters = [c.tolist() if isinstance(c, np.ndarray) else list(c) for c in clusters]
+  if workers < 1:
+    workers = multiprocessing.cpu_count()
+  big = [c for c in clusters if len(c) > 1]
+  if workers < 2 or len(big) < 2 or shared_memory is None:
+    order = []
+    cycles = 0
+    for c in clusters:
+      (o, n) = cluster_order(rows, c, engine, block_size, tsort, None if group is None else group[c])
+      order += o
+      cycles += n
+    return (order, cycles)
+
+  rows = np.ascontiguousarray(rows, dtype=np.float64)
+  shm = shared_memory.SharedMemory(create=True, size=max(1, rows.nbytes))
+  try:
+    np.ndarray(rows.shape, dtype=np.float64, buffer=shm.buf)[:] = rows
+    pool = multiprocessing.Pool(min(workers, len(big)))
+    try:
+      # largest clusters first, for better load balance.
+      tasks = sorted(big, key=len, reverse=True)
+      done = pool.map(_cluster_order_shm, [(shm.name, len(rows), c, engine, block_size, tsort,
+                                            None if group is None else group[c]) for c in tasks], 1)
+    finally:
+      pool.close()
+      pool.join()
+    sorted_c = {}
+    for (c, o) in zip(tasks, done):
+      sorted_c[c[0]] = o[0]
+    order = []
+    for c in clusters:
+      if len(c) > 1:
+        order += sorted_c[c[0]]
+      else:
+        order += c if group is None else [int(group[i]) for i in c]
+    return (order, sum([o[1] for o in done]))
+  finally:
+    shm.close()
+    shm.unlink()
 
 import json
 import inkex
+import cubicsuperpath
 import gettext
+from xml.sax.saxutils import escape, quoteattr
 
 CMP_EPS = 0.000001
+CULL_PROBE = 0.0001               # back-face culling probes inside/outside at this fraction of a segment length.
+STRIP_BEND_DEG = 30.0            # --side_strips: a sharper angle between neighbour faces starts a new strip.
 debugging_zsort = False          # Add sorting numbers and arrows to perimeter shell; print lists to tty.
 
 # python2 compatibility. Inkscape runs us with python2!
@@ -1400,10 +2219,36 @@ if sys.version_info.major < 3:
                 return "".join(map(chr, tupl))
 
 
+class CurvePathGen(LinearPathGen):
+    """
+    A LinearPathGen, that also keeps the path data of each object as it was before flattening.
+    curves[i] is the path d that produced svg.paths[i].
+    With flatten=False, objects are not flattened at all. Their svg.paths entries have no subpaths.
+    flatten can also be a function of the node, to decide per object.
+    """
+    def __init__(self, smoothness=0.2, flatten=True):
+        LinearPathGen.__init__(self, smoothness=smoothness)
+        self.flatten = flatten
+        self.curves = []
+
+    def pathString(self, d, node, mat):
+        if not (self.flatten(node) if callable(self.flatten) else self.flatten):
+            if d:
+                self._svg.paths.append( (node, [], mat) )
+                self.curves.append(d)
+            return
+        n = len(self._svg.paths)
+        LinearPathGen.pathString(self, d, node, mat)
+        self.curves += [d] * (len(self._svg.paths) - n)
+
+    def objRoundedRect(self, x, y, w, h, rx, ry, node, mat):
+        self.pathString(self._svg.roundedRectBezier(x, y, w, h, rx, ry), node, mat)
+
+
 class FlatProjection(inkex.Effect):
 
     # CAUTION: Keep in sync with flat-projection.inx and flat-projection_de.inx
-    __version__ = '0.9.5'         # >= max(src/flatproj.py:__version__, src/inksvg.py:__version__)
+    __version__ = '0.9.6'         # >= max(src/flatproj.py:__version__, src/inksvg.py:__version__)
 
     def __init__(self):
         """
@@ -1515,10 +2360,62 @@ Option parser example:
             '--shading', dest='shading_perc', type='float', default=float(10), action='store',
             help='Flat shading percentage. Compute lightness change of surfaces. Surfaces with a normal at 90 degrees with the ray direction are unaffected. 100% colors a face white, when its normal is the ray direction, and black when it is oposite. Use 0 to disable shading. Default(%): 10')
 
+        self.OptionParser.add_option(
+            '--shading_levels', dest='shading_levels', type='int', default=0, action='store',
+            help='Quantize flat shading to this number of lightness levels. Fewer levels give fewer distinct styles. 0 does not quantize, 1 keeps the unshaded color. Default: 0')
+
+        self.OptionParser.add_option(
+            "--style_classes", action="store", type="inkbool", dest="style_classes", default=False,
+            help="Write each distinct style once into a <style> block. Generated paths refer to it by class. Default: False")
+
+        self.OptionParser.add_option(
+            "--lod", action="store", type="float", dest="lod", default=0.0,
+            help="Level of detail in device pixels: merge nearly collinear points and drop side faces of less area. Default: 0 (off)")
+
+        self.OptionParser.add_option(
+            "--clip", action="store", type="string", dest="clip", default="",
+            help="Drop faces outside a clip region: 'page', or x,y,width,height in mm. Default: '' (no clipping)")
+
+        self.OptionParser.add_option(
+            "--cull_back", action="store", type="inkbool", dest="cull_back", default=True,
+            help="Drop side faces that point away from the viewer, where an opaque object hides them. Default: True")
+
+        self.OptionParser.add_option(
+            "--side_strips", action="store", type="inkbool", dest="side_strips", default=False,
+            help="Join neighbour side faces into strips, that face the same way without a sharp bend. Edges are only drawn between strips. Default: False")
+
+        self.OptionParser.add_option(
+            "--strip_gradient", action="store", type="inkbool", dest="strip_gradient", default=True,
+            help="Shade side strips with a linearGradient, instead of one flat color each. Default: True")
+
+        self.OptionParser.add_option(
+            "--curved_faces", action="store", type="inkbool", dest="curved_faces", default=False,
+            help="Write front and back faces with the original path data and a transform matrix. Curves stay exact. Default: False")
+
+        self.OptionParser.add_option(
+            '--path_precision', dest='path_precision', type='int', default=6, action='store',
+            help='Number of decimal places in generated path data. Default: 6')
+
+        self.OptionParser.add_option(
+            "--path_relative", action="store", type="inkbool", dest="path_relative", default=False,
+            help="Write generated path data with relative l/h/v commands and without redundant digits. Default: False")
+
         self.OptionParser.add_option(
             '--smoothness', dest='smoothness', type='float', default=float(0.2), action='store',
             help='Curve smoothing (less for more [0.0001 .. 5]). Default: 0.2')
 
+        self.OptionParser.add_option(
+            '--zsort', dest='zsort', type='string', default='sweep', action='store',
+            help='Ordering engine for the side walls. One of sweep (compare vertically adjacent faces only), pairs (vectorized cmp2D() of candidate pairs). Default: sweep')
+
+        self.OptionParser.add_option(
+            '--zsort_block', dest='zsort_block', type='int', default=100000, action='store',
+            help='Number of candidate pairs compared at once with --zsort=pairs. Bounds peak memory. Default: 100000')
+
+        self.OptionParser.add_option(
+            '--zsort_workers', dest='zsort_workers', type='int', default=1, action='store',
+            help='Number of processes sorting independent clusters of side walls. 0 uses all CPUs. Default: 1')
+
 
         self.OptionParser.add_option('-V', '--version',
           action = 'store_const', const=True, dest = 'version', default = False,
@@ -1554,6 +2451,25 @@ Option parser example:
             return(not nomatch)
         return nomatch
 
+    def is_opaque_fill(self, node, style_d):
+        """
+        True if the fill of node hides what is behind it. style_d is from getPathStyle(node).
+        A missing fill, a gradient or pattern fill, or an opacity below 1 here or in a parent group is not opaque.
+        """
+        fill = style_d.get('fill', 'none').strip()
+        if fill in ('none', '') or fill.startswith('url('):
+          return False
+        try:
+          opacity = float(style_d.get('fill-opacity', 1)) * float(style_d.get('opacity', 1))
+          node = node.getparent()
+          while node is not None:
+            m = re.search(r'(?:^|;)\s*opacity\s*:\s*([^;]+)', node.get('style') or '')
+            opacity *= float(m.group(1) if m else node.get('opacity', 1))
+            node = node.getparent()
+        except ValueError:
+          return False
+        return opacity >= 1.0
+
     def find_selected_id(self, node):
         while node is not None:
           id = node.attrib.get('id', '')
@@ -1561,30 +2477,39 @@ Option parser example:
           node = node.getparent()
         return None
 
-    def apply_shading(self, fill, normal):
+    def shading_adjust(self, normals):
         """
-        Apply self.options.shading_perc to the fill color, depending on the angle between
-        self.options.ray_direction and normal. fill is lightened when the angle is less
-        than 90 deg, and darkened when it is more than 90 deg.
+        Compute the lightness adjustment for an array of face normals. It applies self.options.shading_perc
+        depending on the angle between self.options.ray_direction and each normal. Faces are lightened
+        when the angle is less than 90 deg, and darkened when it is more than 90 deg.
+        With self.options.shading_levels, only that many distinct adjustments are used.
+        Use with SvgColor.adjusted_light().
         """
-
-        ## compute angle between two vectors in 3D
-        def vector_angle_3d(a, b):
-           norm_ab = np.linalg.norm(a) * np.linalg.norm(b)
-           if norm_ab == 0.: return 0
-           return np.arccos(np.dot(a,b) / norm_ab)
-
         ray = np.array(list(map(lambda x: float(x), self.options.ray_direction.split(','))))
-        alpha = 90-np.degrees(vector_angle_3d(ray, normal))
-        c = SvgColor(fill)
-        c.adjust_light(alpha*2.55/90 * float(self.options.shading_perc))
-        print("apply_shading: alpha=", alpha, " -> adjust_light(", alpha*2.55/90 * float(self.options.shading_perc), ")", file=self.tty)
-        return str(c)
+        normals = np.asarray(normals, dtype=float).reshape(-1, 3)
+        norm = np.linalg.norm(normals, axis=1) * np.linalg.norm(ray)
+        cos = np.ones(len(normals))             # a zero normal counts as angle 0
+        ok = norm != 0.
+        cos[ok] = np.clip(np.dot(normals[ok], ray) / norm[ok], -1., 1.)
+        alpha = 90-np.degrees(np.arccos(cos))
+        adjust = alpha*2.55/90 * float(self.options.shading_perc)
+        levels = self.options.shading_levels
+        if levels == 1:
+          adjust = np.zeros(len(normals))       # the one level in the middle: no adjustment.
+        elif levels > 1:
+          amax = 2.55 * float(self.options.shading_perc)
+          step = 2*amax/(levels-1)
+          adjust = np.round((adjust+amax)/step)*step - amax
+        return adjust
 
 
     def effect(self):
         smooth = float(self.options.smoothness) # svg.smoothness to be deprecated!
-        pg = LinearPathGen(smoothness=smooth)
+        # with curved faces, only objects that get side walls need to be flattened.
+        flatten = True
+        if self.options.curved_faces:
+          flatten = lambda node: self.options.with_sides and self.is_extrude_color(svg, node, self.options.apply_depth)
+        pg = CurvePathGen(smoothness=smooth, flatten=flatten)
         svg = InkSvg(document=self.document, pathgen=pg, smoothness=smooth)
 
         # Viewbox handling
@@ -1610,6 +2535,7 @@ Option parser example:
               inkex.addNS('label','inkscape'): self.options.dest_layer,
               inkex.addNS('groupmode','inkscape'): 'layer',
               'id': self.options.dest_layer })
+            svg.indexElement(dest_layer)
         # print('dest_layer', dest_layer, dest_layer.attrib, file=self.tty)
 
         # Second traverse the document (or selected items), reducing
@@ -1635,11 +2561,12 @@ Option parser example:
         ##                  [[[207, 744], [264, 801]],                         [[207, 801], [264, 744]]], ... ]
         ##
         paths_tupls = []
-        for tup in svg.paths:
+        for i in range(len(svg.paths)):
+            tup = svg.paths[i]
             ll = []
             for e in tup[1]:
                 ll.append(e[0])
-            paths_tupls.append( (tup[0], ll, tup[2]) )          # tup[2] is a transform matrix.
+            paths_tupls.append( (tup[0], ll, tup[2], pg.curves[i]) )    # tup[2] is a transform matrix, pg.curves[i] the path d.
         self.paths = None       # free some memory
 
         print("paths_tupls:\n", repr(paths_tupls), self.selected, svg.dpi, self.current_layer, file=self.tty)
@@ -1661,14 +2588,13 @@ Option parser example:
             src_id = self.find_selected_id(node)
             if src_id in dest_ids:
               return dest_g[dest_ids[src_id]]
-            existing_ids = map(lambda x: x.attrib.get('id', ''), list(dest_layer))
             n = 0;
             if src_id is None:
                 print("Please select one or more objects.", file=sys.stderr)
                 return
             print("find_selected_id:\n", src_id, node, file=self.tty)
             id = src_id+'_'+str(n)
-            while id in existing_ids:
+            while svg.getElementsById(id):
               n = n+1
               id = src_id+'_'+str(n)
             dest_ids[src_id] = id
@@ -1681,6 +2607,8 @@ Option parser example:
             g3 = inkex.etree.SubElement(g, 'g', { 'id': id+'_3', 'src': src_path })
             g2 = inkex.etree.SubElement(g, 'g', { 'id': id+'_2', 'src': src_path })
             g1 = inkex.etree.SubElement(g, 'g', { 'id': id+'_1', 'src': src_path })
+            for e in g.iter():
+              svg.indexElement(e)
             dest_g[id] = ( g1, g2, g3, '_'+str(n)+'_' )
             return dest_g[id]
 
@@ -1691,23 +2619,74 @@ Option parser example:
           if d < -CMP_EPS: return -1
           return 0
 
-        def same_point3d(a, b):
-          if cmp_f(a[0], b[0]): return False
-          if cmp_f(a[1], b[1]): return False
-          if cmp_f(a[2], b[2]): return False
-          return True
+        def merge_collinear(path, tol):
+          """ Drop the points of a flattened subpath that lie within tol of the segment between their kept neighbours.
+              First and last point stay, so that closed subpaths stay closed.
+              One pass: each dropped point allows the directions from the last kept point, that pass it within tol.
+              The next point is dropped too, if it is in all these directions, and not nearer than the others.
+          """
+          if len(path) < 3:
+            return path
+          p = np.asarray(path, dtype=float)
+          out = [p[0]]
+          (ax, ay) = p[0][:2]
+          ref = None    # direction to the first point beyond tol. Angles are relative to it.
+          i = 1
+          while i < len(p):
+            (vx, vy) = (p[i][0] - ax, p[i][1] - ay)
+            r = np.hypot(vx, vy)
+            if ref is None:
+              if r > tol:
+                ref = (vx / r, vy / r)
+                w = np.arcsin(tol / r)
+                (lo, hi, rmax) = (-w, w, r)
+              i += 1
+              continue
+            phi = np.arctan2(ref[0]*vy - ref[1]*vx, ref[0]*vx + ref[1]*vy)
+            if lo <= phi <= hi and r >= rmax:
+              w = np.arcsin(tol / r)
+              (lo, hi, rmax) = (max(lo, phi - w), min(hi, phi + w), r)
+              i += 1
+              continue
+            out.append(p[i-1])          # p[i] is out of reach: keep the point before, and start over from there.
+            (ax, ay) = p[i-1][:2]
+            ref = None
+          out.append(p[-1])
+          return np.array(out)
+
+        svgd_prec = max(0, self.options.path_precision)
+        svgd_num = '%%.%df' % svgd_prec
+        svgd_rel = ('', 'h'+svgd_num, 'v'+svgd_num, 'l'+svgd_num+','+svgd_num)    # indexed by (dx != 0) + 2*(dy != 0)
+
+        def compact_svgd(d):
+          " drop redundant digits from all numbers in d: trailing zeros, leading zeros, commas before minus signs "
+          d = re.sub(r'(\.\d*?)0+(?!\d)', r'\1', d)
+          d = re.sub(r'\.(?!\d)', '', d)
+          d = re.sub(r'(?<![\d.])0\.(?=\d)', '.', d)
+          return d.replace(',-', '-')
 
         def points_to_svgd(p, scale=1.0):
-          " convert list of points into a closed SVG path list"
-          f = p[0]
-          p = p[1:]
+          """ convert list of points into a closed SVG path list.
+              All coordinates are formatted in one go. With --path_relative, the l/h/v commands are computed
+              from the rounded absolute coordinates, so that rounding errors do not add up.
+          """
+          p = np.asarray(p, dtype=float)
+          p = p.reshape(len(p), -1)[:,:2]      # x, y of 2D or 3D points
           closed = False
-          if cmp_f(p[-1][0], f[0]) == 0 and cmp_f(p[-1][1], f[1]) == 0:
+          if len(p) > 1 and cmp_f(p[-1][0], p[0][0]) == 0 and cmp_f(p[-1][1], p[0][1]) == 0:
             p = p[:-1]
             closed = True
-          svgd = 'M%.6f,%.6f' % (f[0]*scale, f[1]*scale)
-          for x in p:
-            svgd += 'L%.6f,%.6f' % (x[0]*scale, x[1]*scale)
+          if not self.options.path_relative:
+            svgd = ('M'+svgd_num+','+svgd_num + ('L'+svgd_num+','+svgd_num)*(len(p)-1)) % tuple((p*scale).ravel())
+          else:
+            q = np.round(p*scale*10**svgd_prec)
+            dq = q[1:] - q[:-1]
+            kind = (dq[:,0] != 0) + 2*(dq[:,1] != 0)
+            # the numbers each command takes: h dx, v dy, l dx dy. Duplicate points take none.
+            nargs = np.array([0, 1, 1, 2])[kind]
+            args = np.stack((np.where(kind == 2, dq[:,1], dq[:,0]), dq[:,1]), axis=1)[np.arange(2) < nargs[:,None]]
+            svgd = compact_svgd((('M'+svgd_num+','+svgd_num) + ''.join([svgd_rel[k] for k in kind.tolist()])) %
+                                tuple(np.concatenate((q[0], args)) * 10.0**-svgd_prec))
           if closed:
             svgd += 'z'
           return svgd
@@ -1742,17 +2721,53 @@ Option parser example:
           for key in sty: s += str(key)+':'+str(sty[key])+';'
           return s.rstrip(';')
 
-        ## import from test_zsort2d.py
+        style_classes = {}  # map from dest_id to ({style: class name}, style element)
+        def styled(g, attrs):
+          """ With --style_classes, replace attrs['style'] with a class. Each distinct style is written once
+              into a <style> block in the parent group of g.
+          """
+          if not self.options.style_classes or 'style' not in attrs:
+            return attrs
+          top = g.getparent()
+          top_id = top.attrib.get('id', '')
+          if top_id not in style_classes:
+            style_classes[top_id] = ({}, inkex.etree.Element('style', { 'id': top_id+'_style', 'type': 'text/css' }))
+            top.insert(0, style_classes[top_id][1])
+          (names, css) = style_classes[top_id]
+          style = attrs.pop('style')
+          if style not in names:
+            names[style] = top_id+'_c'+str(len(names))
+            css.text = (css.text or '') + '.'+names[style]+' { '+style+' }\n'
+          attrs['class'] = names[style]
+          return attrs
+
+        fragments = {}      # map from a destination group to the xml text of its new children, in order.
+        style_xml = {}      # map from (group, style) to the xml text of the style or class attribute.
+        def add_elem(g, tag, attrs, text='', inner=''):
+          """ Queue a new child element of g. add_fragments() parses all children of a group in one go.
+              attrs['style'] goes through styled(). Each distinct style is formatted only once.
+              inner is xml text of child elements.
+          """
+          xml = '<' + tag
+          for key in attrs:
+            if key == 'style':
+              if (g, attrs[key]) not in style_xml:
+                sa = styled(g, { 'style': attrs[key] })
+                style_xml[(g, attrs[key])] = ''.join([' %s=%s' % (k, quoteattr(sa[k])) for k in sa])
+              xml += style_xml[(g, attrs[key])]
+            else:
+              xml += ' %s=%s' % (key, quoteattr(attrs[key]))
+          if g not in fragments: fragments[g] = []
+          fragments[g].append(xml + '>' + escape(text) + inner + '</' + tag + '>')
 
-        def y_at_x(gp, gv, x):
-          dx = x-gp[0]
-          if abs(gv[0]) < CMP_EPS:
-            return None
-          s = dx/gv[0]
-          if s < 0.0 or s > 1.0:
-            return None
-          return gp[1]+s*gv[1]
+        def add_fragments():
+          " Append all queued children to their groups. "
+          parser = inkex.etree.XMLParser(huge_tree=True)
+          for g in fragments:
+            g.extend(list(inkex.etree.fromstring('<g>' + ''.join(fragments[g]) + '</g>', parser)))
+          fragments.clear()
 
+        ## import from test_zsort2d.py
 
         # Zsort is only done for the rim.
         # - the general 3d face sorting problem can be reduced to a 2D problem as all faces span between two parallel planes.
@@ -1808,44 +2823,13 @@ Option parser example:
         #    - run tsort, implement Kahn's algorithm from https://en.wikipedia.org/wiki/Topological_sorting
         #      or Don Knuths algoritm T from p.266 of The_Art_of_Computer_Programming-Vol1.pdf
         #
+        #  * sweep-line (implemented in src/zsort2d.py: sweep_edges())
+        #    - the X-coordinates idea above, but only vertically adjacent lines are compared.
+        #      This feeds O(n) edges into tsort, instead of calling cmp2D() for all O(n^2) pairs.
+        #
         # ------------------------------------------------
         #
         #
-        def cmp2D(g1, g2):
-          """
-          returns -1 if g1 sorts in front of g2
-          returns 1  if g1 sorts in behind g2
-          returns None  if there was no clear decision
-          """
-          # convert g1 into point and vector:
-          g1p = g1[0]
-          g1v = (g1[1][0] - g1[0][0], g1[1][1] - g1[0][1])
-          #
-          y = y_at_x(g1p, g1v, g2[0][0])
-          if y is not None:
-            if y < g2[0][1]-CMP_EPS: return -1
-            if y > g2[0][1]+CMP_EPS: return 1
-          #
-          y = y_at_x(g1p, g1v, g2[1][0])
-          if y is not None:
-            if y < g2[1][1]-CMP_EPS: return -1
-            if y > g2[1][1]+CMP_EPS: return 1
-          #
-          g2p = g2[0]
-          g2v = (g2[1][0] - g2[0][0], g2[1][1] - g2[0][1])
-          y = y_at_x(g2p, g2v, g1[0][0])
-          if y is not None:
-            if g1[0][1]+CMP_EPS < y: return -1
-            if g1[0][1]-CMP_EPS > y: return 1
-          #
-          y = y_at_x(g2p, g2v, g1[1][0])
-          if y is not None:
-            if g1[1][1]+CMP_EPS < y: return -1
-            if g1[1][1]-CMP_EPS > y: return 1
-          #
-          return None   # non-comparable pair in the poset. sorted() would take that as less than aka -1
-
-
         def phi2D(R):
           """
           Given a 3D rotation matrix R, we compute the angle phi projected in the
@@ -2046,10 +3030,75 @@ Option parser example:
         else:
             backview = False
 
-        paths2d_flat = []                       # one list of all line segments. Used for index sorting of side faces.
-        paths3d_2 = []                          # side: visible edges and faces
+        # With --clip, faces entirely outside this rectangle are dropped: xmin, ymin, xmax, ymax in svg units.
+        clip = None
+        clip_count = [0]
+        if self.options.clip.strip() == 'page':
+            clip = (0.0, 0.0, svg.docWidth, svg.docHeight)
+        elif self.options.clip.strip() != '':
+            try:
+                (x, y, w, h) = [float(c) / 25.4 * svg.dpi for c in re.split('[ ,;]+', self.options.clip.strip())]
+                clip = (x, y, x+w, y+h)
+            except ValueError:
+                inkex.errormsg("Ignoring --clip='%s'. Expected 'page' or x,y,width,height in mm." % self.options.clip)
+
+        def outside_clip(paths3d):
+          " True if the bounding box of all points in paths3d lies outside the clip rectangle. Counted in clip_count. "
+          if clip is None or not sum([len(p) for p in paths3d]):
+            return False
+          p = np.concatenate([p for p in paths3d if len(p)])
+          if p[:,0].max() < clip[0] or p[:,0].min() > clip[2] or p[:,1].max() < clip[1] or p[:,1].min() > clip[3]:
+            clip_count[0] += 1
+            return True
+          return False
+
+        def curve_points(d, transform):
+          " The control points of path d under transform, as front face points. Their bounding box contains the curve. "
+          p = [pt for sub in cubicsuperpath.parsePath(d) for csp in sub for pt in csp]
+          p = np.array(p, dtype=float).reshape(-1, 2)
+          return np.matmul(np.matmul(np.column_stack((p, np.ones(len(p)))), np.array(transform, dtype=float).T), R[:2])
+
+        # --lod: details below this many pixels are dropped. Projection scales lengths by at most proj_scale.
+        lod = max(0.0, self.options.lod)
+        if lod > 0:
+          npts = 0
+          for tupl in paths_tupls:
+            for i in range(len(tupl[1])):
+              npts += len(tupl[1][i])
+              tupl[1][i] = merge_collinear(tupl[1][i], lod / proj_scale)
+          print("lod: ", npts, "points merged into", sum([len(p) for t in paths_tupls for p in t[1]]), file=self.tty)
+
+        # All subpaths of all objects are concatenated into one array of xy points, sub_off[k] is where subpath k starts.
+        # Front ring, back ring and the 2D rotation for the z-sort are each computed in one go, subpaths get views.
+        sub_off = [0]
+        for tupl in paths_tupls:
+            for path in tupl[1]:
+              sub_off.append(sub_off[-1] + len(path))
+        pts2d = np.zeros((sub_off[-1], 2))
+        k = 0
         for tupl in paths_tupls:
-            (elem, paths, transform) = tupl
+            for path in tupl[1]:
+              if len(path): pts2d[sub_off[k]:sub_off[k+1]] = path
+              k += 1
+        npts = len(pts2d)
+        front3d = np.matmul(pts2d, R[:2])                       # [x, y, 0] * R
+        back3d = front3d + np.matmul([0, 0, depth], R)          # [x, y, depth] * R
+
+        seg_start = []                          # index into pts2d of the first point of each line segment. One per side face.
+        # side walls as an indexed mesh. The vertex buffer is front3d followed by back3d.
+        side_edges = []                         # vertical edges: [front vertex, back vertex]
+        side_edge_style = []                    # stroke style of each edge
+        side_faces = []                         # quad faces: [edge 0, edge 1]. Neighbour faces share an edge index.
+        side_rings = []                         # faces of a subpath: (first face, number of faces, closed)
+        side_style = []                         # fill style of each face
+        side_shade = []                         # per face an index into shade_fill, shade_tmpl. Or -1 if not shaded.
+        shade_tmpl = []                         # style of an object, split where the fill color goes.
+        shade_fill = []                         # fill of an object, as an index into fill_ids.
+        fill_ids = {}                           # distinct fill colors
+        cull_objs = []                          # closed opaque objects: (first ring, end ring, evenodd)
+        k = 0
+        for tupl in paths_tupls:
+            (elem, paths, transform, curve) = tupl
             (g1, g2, g3, suf) = find_dest_g(elem, dest_layer)
             if backview:
                 g1,g3 = g3,g1
@@ -2064,6 +3113,14 @@ Option parser example:
             style_d_nostroke = style_d.copy()
             style_d_nostroke['stroke'] = 'none'
             style = fmtPathStyle(style_d)
+            style_nostroke = fmtPathStyle(style_d_nostroke)
+            shade = -1
+            if self.options.shading_perc > 0 and 'fill' in style_d_nostroke:
+              # modulate face color with shading, corresponding to the angle. Done for all faces after the loop.
+              shade = len(shade_tmpl)
+              shade_fill.append(fill_ids.setdefault(style_d_nostroke['fill'], len(fill_ids)))
+              style_d_nostroke['fill'] = '\0'
+              shade_tmpl.append(fmtPathStyle(style_d_nostroke).split('\0'))
 
             if path_id == suf:
               path_id = 'pathx'+str(missing_id)+suf
@@ -2071,102 +3128,259 @@ Option parser example:
             paths3d_1 = []
             paths3d_3 = []
             extrude = self.is_extrude_color(svg, elem, self.options.apply_depth)
+            ring0 = len(side_rings)
             for path in paths:
-              # Extend an array of xy vectors (path) into into xyz vectors with all z==0 (path3d_1)
-              p3d_1 = np.zeros( (len(path), 3) )
-              p3d_1[:,:-1] = path       # magic numpy slicing ..
-              # paths3d_1 is the front face: rotate p3d_1 into 3D space according to R
-              paths3d_1.append(np.matmul(p3d_1, R))
+              v0 = sub_off[k]
+              n = sub_off[k+1] - v0
+              k += 1
+              # paths3d_1 is the front face, paths3d_3 the back face
+              paths3d_1.append(front3d[v0:v0+n])
               if extrude:
+                paths3d_3.append(back3d[v0:v0+n])
 
-                # paths3d_3 is the back face: translate p3d_1 along z-axis then rotate into 3D space according to R
-                p3d_1 += [0, 0, depth]
-                paths3d_3.append(np.matmul(p3d_1, R))
-
-                # paths3d_2 holds all permimeter faces: beware of z-sort dragons.
+                # side walls: beware of z-sort dragons.
                 ##########################
-                if self.options.with_sides:
-                  for i in range(0, len(path)-1):
-                    paths2d_flat.append([path[i], path[i+1], len(paths2d_flat)])
-                  for i in range(0, len(paths3d_1[-1])-1):
-                    a, b = paths3d_1[-1][i],   paths3d_3[-1][i]
-                    c, d = paths3d_1[-1][i+1], paths3d_3[-1][i+1]
-                    style_d2_nostroke = style_d_nostroke.copy()
-                    if self.options.shading_perc > 0 and 'fill' in style_d2_nostroke:
-                      # modulate face color with shading, corresponding to the angle.
-                      fill = style_d2_nostroke['fill']
-                      style_d2_nostroke['fill'] = self.apply_shading(fill, np.cross(np.array(b)-np.array(a), np.array(c)-np.array(a)))
-                    style_2_nostroke = fmtPathStyle(style_d2_nostroke)
-                    paths3d_2.append({
-                      'orig_2Dpath': paths2d_flat[len(paths3d_2)],
-                      'orig_idx': len(paths3d_2),
-                      'edge_style': style,
-                      'edge_data': [[a, b], [c, d]],
-                      'edge_visible': [1, 1],
-                      'style': style_2_nostroke,
-                      'data': [a,b,d,c,a]})
-                  assert(len(paths2d_flat) == len(paths3d_2))
-
-            if extrude and self.options.with_back:
-                # populate back face with selected colors only
-                inkex.etree.SubElement(g3, 'path', { 'id': path_id+'3', 'style': style, 'd': paths_to_svgd(paths3d_3, 25.4/svg.dpi) })
-            # populate front face with all colors
-            if self.options.with_front:
-                inkex.etree.SubElement(g1, 'path', { 'id': path_id+'1', 'style': style, 'd': paths_to_svgd(paths3d_1, 25.4/svg.dpi) })
+                # repeated points, e.g. an explicit closing point before z, would give faces of zero length.
+                # Of a run of equal points, only the last one is used.
+                vk = [i for i in range(n-1) if cmp_f(path[i][0], path[i+1][0]) or cmp_f(path[i][1], path[i+1][1])] + [n-1]
+                m = len(vk)
+                if self.options.with_sides and m > 1:
+                  seg_start += [v0+i for i in vk[:-1]]
+                  # vertex k of the subpath is front vertex v0+k and back vertex npts+v0+k. Edge k connects the two.
+                  e0 = len(side_edges)
+                  ne = m
+                  if m > 2 and cmp_f(path[vk[0]][0], path[-1][0]) == 0 and cmp_f(path[vk[0]][1], path[-1][1]) == 0:
+                    ne = m-1                    # closed subpath: the last face meets the first face at edge e0.
+                  for i in vk[:ne]:
+                    side_edges.append([v0+i, npts+v0+i])
+                    side_edge_style.append(style)
+                  side_rings.append( (len(side_faces), m-1, ne < m) )
+                  for i in range(0, m-1):
+                    side_faces.append([e0+i, e0+(i+1)%ne])
+                  side_style += [style_nostroke]*(m-1)
+                  side_shade += [shade]*(m-1)
+                  assert(len(seg_start) == len(side_faces))
+
+            # the face on top must be there to cover the inside.
+            if (self.options.cull_back and (self.options.with_back if backview else self.options.with_front) and len(side_rings) > ring0 and
+                all([r[2] for r in side_rings[ring0:]]) and self.is_opaque_fill(elem, style_d)):
+              cull_objs.append( (ring0, len(side_rings), style_d.get('fill-rule', '').strip() == 'evenodd') )
+
+            if self.options.curved_faces:
+                # front and back face are an affine map of the object: keep its path d, add a matrix.
+                # The matrix also scales the stroke, compensate that on average.
+                A = (25.4/svg.dpi) * np.matmul(R[:2,:2].T, np.array(transform, dtype=float))
+                style_d_curve = style_d.copy()
+                if 'stroke-width' in style_d:
+                  try:
+                    style_d_curve['stroke-width'] = str(float(re.sub('[a-z]+$', '', style_d['stroke-width'])) / avgScaleFromM(A.tolist()))
+                  except ValueError:
+                    pass
+                style_curve = fmtPathStyle(style_d_curve)
+                back = (25.4/svg.dpi) * depth * R[2,:2]
+                fmt_matrix = 'matrix(%.9g,%.9g,%.9g,%.9g,%.9g,%.9g)'
+                (clip1, clip3) = (paths3d_1, paths3d_3)
+                if clip is not None and not sum([len(p) for p in paths3d_1]):
+                    # not flattened: clip by the control points of the curve.
+                    clip1 = [curve_points(curve, transform)]
+                    clip3 = [clip1[0] + np.matmul([0, 0, depth], R)]
+                if extrude and self.options.with_back and not outside_clip(clip3):
+                    add_elem(g3, 'path', { 'id': path_id+'3', 'style': style_curve, 'd': curve,
+                      'transform': fmt_matrix % (A[0][0], A[1][0], A[0][1], A[1][1], A[0][2]+back[0], A[1][2]+back[1]) })
+                if self.options.with_front and not outside_clip(clip1):
+                    add_elem(g1, 'path', { 'id': path_id+'1', 'style': style_curve, 'd': curve,
+                      'transform': fmt_matrix % (A[0][0], A[1][0], A[0][1], A[1][1], A[0][2], A[1][2]) })
+            else:
+                if extrude and self.options.with_back and not outside_clip(paths3d_3):
+                    # populate back face with selected colors only
+                    add_elem(g3, 'path', { 'id': path_id+'3', 'style': style, 'd': paths_to_svgd(paths3d_3, 25.4/svg.dpi) })
+                # populate front face with all colors
+                if self.options.with_front and not outside_clip(paths3d_1):
+                    add_elem(g1, 'path', { 'id': path_id+'1', 'style': style, 'd': paths_to_svgd(paths3d_1, 25.4/svg.dpi) })
 
         if self.options.with_sides:
-          ## 1) rotate paths2d_flat for cmp2D()
-          paths2d_flat_rot = []
-          for i in range(len(paths2d_flat)):
-            l = paths2d_flat[i]
-            paths2d_flat_rot.append([np.matmul(l[0], Rz2D), np.matmul(l[1], Rz2D)]+l[2:])
-          #   visualize the original and rotated paths2d_flat in blue, thin and thick.
+          # the side wall mesh, and the face normals.
+          V = np.concatenate((front3d, back3d))
+          E = np.array(side_edges, dtype=int).reshape(-1, 2)
+          F = np.array(side_faces, dtype=int).reshape(-1, 2)
+          A = V[E[F[:,0],0]]
+          N = np.cross(V[E[F[:,0],1]]-A, V[E[F[:,1],0]]-A)
+          seg_start = np.array(seg_start, dtype=int)
+
+          ## cull side faces that point away from the viewer. On a closed object with an opaque fill, the
+          # front face and the side faces towards the viewer always cover them. They are not shaded, sorted or drawn.
+          # Which side of a face is outside, is probed once per subpath, with the fill-rule of the object.
+          cull = np.zeros(len(F), dtype=bool)
+          for (r0, r1, evenodd) in cull_objs:
+            I = np.arange(side_rings[r0][0], side_rings[r1-1][0] + side_rings[r1-1][1])
+            segs = np.hstack((pts2d[seg_start[I]], pts2d[seg_start[I]+1]))
+            rings = [(f0 - I[0], nf) for (f0, nf, closed) in side_rings[r0:r1]]
+            cull[I] = facing_away(segs, rings, R, evenodd, CULL_PROBE, CMP_EPS)
+          nback = int(cull.sum())
+          if lod > 0:
+            # sub-pixel faces, mostly seen edge-on. |N[:,2]| is the projected area of the face.
+            cull |= np.abs(N[:,2]) < lod * lod
+          if clip is not None and len(F):
+            Q = V[E[F].reshape(-1, 4)]          # the 4 corners of each face
+            out = ((Q[:,:,0].max(axis=1) < clip[0]) | (Q[:,:,0].min(axis=1) > clip[2]) |
+                   (Q[:,:,1].max(axis=1) < clip[1]) | (Q[:,:,1].min(axis=1) > clip[3]))
+            clip_count[0] += int((out & ~cull).sum())
+            cull |= out
+          if cull.any():
+            # the remaining faces of a subpath form open chains. Renumber, so that each chain is consecutive.
+            keep = []
+            rings = []
+            for (f0, nf, closed) in side_rings:
+              order = list(range(f0, f0+nf))
+              if cull[f0:f0+nf].any() and closed:
+                last = f0 + int(np.nonzero(cull[f0:f0+nf])[0][-1])
+                order = order[last-f0+1:] + order[:last-f0+1]
+              run = []
+              for f in order + [-1]:
+                if f >= 0 and not cull[f]:
+                  run.append(f)
+                elif len(run):
+                  rings.append( (len(keep), len(run), closed and len(run) == nf) )
+                  keep += run
+                  run = []
+            print("cull: ", int(cull.sum()), "of", len(F), "side faces dropped,", nback, "point away", file=self.tty)
+            keep = np.array(keep, dtype=int)
+            (F, N, seg_start, side_rings) = (F[keep], N[keep], seg_start[keep], rings)
+            side_style = [side_style[i] for i in keep]
+            side_shade = [side_shade[i] for i in keep]
+
+          ## 0) flat shading. Each distinct fill is converted once, with all its faces in one array.
+          side_color = [None] * len(side_style)   # the shaded fill color of each face
+          if len(shade_tmpl):
+            adjust = self.shading_adjust(N)
+            face_shade = np.array(side_shade, dtype=int)
+            face_fill = np.where(face_shade >= 0, np.array(shade_fill+[-1])[face_shade], -1)
+            fills = sorted(fill_ids, key=fill_ids.get)
+            by_fill = np.argsort(face_fill, kind='mergesort')
+            bounds = np.searchsorted(face_fill[by_fill], np.arange(len(fills)+1))
+            for f in range(len(fills)):
+              I = by_fill[bounds[f]:bounds[f+1]]
+              for (i, color) in zip(I.tolist(), SvgColor(fills[f]).adjusted_light(adjust[I])):
+                t = shade_tmpl[side_shade[i]]
+                side_style[i] = t[0] + color + t[1]
+                side_color[i] = color
+
+          ## 1) rotate the line segments for cmp2D(). seg_flat, seg_rot are rows of x0, y0, x1, y1.
+          seg_flat = np.hstack((pts2d[seg_start], pts2d[seg_start+1]))
+          pts2d_rot = np.matmul(pts2d, Rz2D)
+          seg_rot = np.hstack((pts2d_rot[seg_start], pts2d_rot[seg_start+1]))
+          #   visualize the original and rotated line segments in blue, thin and thick.
           if debugging_zsort:
-            for i in range(len(paths2d_flat)):
-              print("[paths2d_flat[i][:2]]: ", i, paths2d_flat[i], file=self.tty)
+            for i in range(len(seg_flat)):
+              print("seg_flat[i]: ", i, seg_flat[i], file=self.tty)
               inkex.etree.SubElement(g2,   'path', { 'id': 'path_flat_orig_id'+str(missing_id)+'_'+str(i),
                 'style': "stroke:#0000ff;stroke-width:0.1;stroke-dasharray:0.1,0.3;fill:none",
-                'd': paths_to_svgd([paths2d_flat[i][:2]], 25.4/svg.dpi) })
-            for i in range(len(paths2d_flat_rot)):
-              print("paths2d_flat_rot[i][0]: ", i, paths2d_flat_rot[i], file=self.tty)
+                'd': paths_to_svgd([[seg_flat[i][:2], seg_flat[i][2:]]], 25.4/svg.dpi) })
+            for i in range(len(seg_rot)):
+              print("seg_rot[i]: ", i, seg_rot[i], file=self.tty)
               inkex.etree.SubElement(g2,   'path', { 'id': 'path_flat_rot_id'+str(missing_id)+'_'+str(i),
                 'style': "stroke:#0000ff;stroke-width:0.5;fill:none",
-                'd': paths_to_svgd([paths2d_flat_rot[i][:2]], 25.4/svg.dpi) })
-
-
-          ## 2) Sort the entries in paths3d_2 with cmp2D() "frontmost last"
-          # prepare a rotated version of the original two-D line set 'orig_2Dpath'
-          # so that cmp2D can sort towards negaive Y-Axis
-          plen = len(paths2d_flat_rot)
-          k = TSort(plen)
-          for i in range(plen):
-            for j in range(i+1, plen):
-              r = cmp2D(paths2d_flat_rot[i], paths2d_flat_rot[j])
-              if r is not None:
-                if r < 0: k.addPre(i, j)
-                if r > 0: k.addPre(j, i)
-          zsort_idx = k.sort()
+                'd': paths_to_svgd([[seg_rot[i][:2], seg_rot[i][2:]]], 25.4/svg.dpi) })
+
+
+          ## 2) Sort the side faces "frontmost last"
+          # the rotated version of the original two-D line set seg_rot
+          # lets the sweep sort towards negaive Y-Axis
+          plen = len(seg_rot)
+          succ = -np.ones(plen, dtype=int)    # the next face of the same subpath, or -1
+          for (f0, nf, closed) in side_rings:
+            succ[f0:f0+nf-1] = np.arange(f0+1, f0+nf)
+            if closed: succ[f0+nf-1] = f0
+
+          # With --side_strips, neighbour faces of a subpath are joined into strips. All faces of a strip
+          # face the same way (their segments in seg_rot run in the same x direction), without sharp bends.
+          # A strip is x-monotone, it projects into a simple polygon and sorts like a single face.
+          # Without --side_strips, each face is a strip of its own.
+          def find_strips():
+            """ Returns (strips, strip_of). strips lists the faces of each strip in subpath order,
+                strip_of maps a face to its strip.
+            """
+            dx = seg_rot[:,2] - seg_rot[:,0]
+            facing = np.where(dx > CMP_EPS, 1, np.where(dx < -CMP_EPS, -1, 0)).tolist()
+            # bend[i]: sharp angle between face i and the next face of its subpath.
+            nxt = np.where(succ >= 0, succ, np.arange(plen))
+            nn = np.linalg.norm(N, axis=1) * np.linalg.norm(N[nxt], axis=1)
+            bend = ((N * N[nxt]).sum(axis=1) < np.cos(np.radians(STRIP_BEND_DEG)) * nn).tolist()
+            strips = []
+            for (f0, nf, closed) in side_rings:
+              # faces seen edge-on (facing 0) join the strip before them.
+              eff = facing[f0:f0+nf]
+              last = 0
+              for k in list(range(nf)) * (2 if closed else 1):
+                if facing[f0+k]: last = facing[f0+k]
+                else: eff[k] = last
+              first = ([x for x in eff if x] + [0])[0]
+              eff = [x or first for x in eff]
+              cut = [k == 0 or eff[k] != eff[k-1] or bend[f0+k-1] for k in range(nf)]
+              if closed:
+                cut[0] = eff[0] != eff[-1] or bend[f0+nf-1]
+              starts = [k for k in range(nf) if cut[k]] or [0]
+              ring = list(range(f0, f0+nf))
+              if not cut[0]:
+                # the strip at the end of a closed subpath continues at its start.
+                ring = ring[starts[0]:] + ring[:starts[0]]
+                starts = [k - starts[0] for k in starts]
+              for j in range(len(starts)):
+                strips.append(ring[starts[j]:(starts[j+1] if j+1 < len(starts) else nf)])
+            strip_of = np.zeros(plen, dtype=int)
+            for j in range(len(strips)):
+              strip_of[strips[j]] = j
+            return (strips, strip_of)
+
+          if self.options.side_strips and plen:
+            (strips, strip_of) = find_strips()
+            print("side_strips: ", plen, "faces in", len(strips), "strips", file=self.tty)
+          else:
+            (strips, strip_of) = ([[i] for i in range(plen)], None)
+
+          # clusters that do not overlap in x are independent. Sort each on its own.
+          clusters = x_clusters(seg_arrays(seg_rot))
+          print("zsort: ", plen, "faces in", len(clusters), "clusters, largest", max([0]+[len(c) for c in clusters]), file=self.tty)
+          (zsort_idx, cycles) = zsort_clusters(seg_rot, clusters, engine=self.options.zsort.strip(" '\""),
+                                     block_size=self.options.zsort_block, tsort=TSortArray, workers=self.options.zsort_workers,
+                                     group=strip_of)
+          if cycles:
+            inkex.errormsg("Warning: %d cyclic dependencies in side walls broken. Local stacking may be off there." % cycles)
           if debugging_zsort:
             print("np.degrees(phi2D(R)): ", np.degrees(phi2D(R)), file=self.tty)
             for l in zsort_idx:
-              print("sorted(paths2d_flat_rot): ", l, file=self.tty)
-
-
-          ## 3) compare each enabled edge with all enabled edges following in the sorted list. In case of conicidence disable the edge that followed.
-          for i in range(plen):
-            for j in range(i+1, plen):
-              path1 = paths3d_2[zsort_idx[i]]
-              if j > len(zsort_idx):
-                print("len(zsort_idx):", len(zsort_idx), "j:", j, file=self.tty)
-              if zsort_idx[j] > len(paths3d_2):
-                print("len(paths3d_2):", len(paths3d_2), "zsort_idx[j]:", zsort_idx[j], "j:", j, file=self.tty)
-              path2 = paths3d_2[zsort_idx[j]]
-              if same_point3d(path1['edge_data'][0][0], path2['edge_data'][0][0]) or \
-                 same_point3d(path1['edge_data'][1][0], path2['edge_data'][0][0]):
-                path1['edge_visible'][0] = 0
-              if same_point3d(path1['edge_data'][0][0], path2['edge_data'][1][0]) or \
-                 same_point3d(path1['edge_data'][1][0], path2['edge_data'][1][0]):
-                path1['edge_visible'][1] = 0
+              print("sorted(seg_rot): ", l, file=self.tty)
+
+
+          ## 3) hide duplicate vertical edges. Most are shared by two neighbouring strips of a subpath.
+          # The strip sorted later draws it, the other strip does not. Between coplanar neighbours
+          # (parallel normals) there is no visible edge at all, and inside a strip neither.
+          # Edges of other subpaths or objects can coincide too. Of all edges at the same place,
+          # only the one of the strip sorted last is drawn. O(n), no pairwise point comparison.
+          nstrips = len(strips)
+          edge_owner = -np.ones(len(E), dtype=int)   # the strip drawing the edge, or -1
+          if plen:
+            sof = np.arange(plen) if strip_of is None else strip_of
+            zsort_pos = np.zeros(nstrips, dtype=int)
+            zsort_pos[zsort_idx] = np.arange(nstrips)
+            left = -np.ones(len(E), dtype=int)      # the face having the edge as its edge 1
+            right = -np.ones(len(E), dtype=int)     # the face having the edge as its edge 0
+            left[F[:,1]] = np.arange(plen)
+            right[F[:,0]] = np.arange(plen)
+            edge_owner = np.maximum(left, right)
+            edge_owner[edge_owner >= 0] = sof[edge_owner[edge_owner >= 0]]
+            S = np.nonzero((left >= 0) & (right >= 0))[0]
+            I, J = left[S], right[S]
+            nn = np.linalg.norm(N[I], axis=1) * np.linalg.norm(N[J], axis=1)
+            coplanar = (nn > 0) & (np.linalg.norm(np.cross(N[I], N[J]), axis=1) <= CMP_EPS * nn)
+            I, J = sof[I], sof[J]
+            edge_owner[S] = np.where(coplanar | (I == J), -1, np.where(zsort_pos[I] < zsort_pos[J], J, I))
+            (at, grp) = np.unique(np.round(V[E].reshape(-1, 6) / CMP_EPS), axis=0, return_inverse=True)
+            grp = grp.reshape(-1)
+            pos = np.where(edge_owner >= 0, zsort_pos[np.maximum(edge_owner, 0)], -1)
+            top = -np.ones(len(at), dtype=int)    # per place, the sort position of the strip sorted last
+            np.maximum.at(top, grp, pos)
+            edge_owner[pos < top[grp]] = -1
 
           if debugging_zsort:
             arrow_dir_deg = -15    # direction of the down arrow in degrees. 0 is south. -45 is south-east
@@ -2176,24 +3390,93 @@ Option parser example:
               'style': "stroke:#0000ff;stroke-width:0.1;fill:none",
               'd': "m -2,40 2,10 2,-10 M 0,0 0,45" })
 
+          # Along a strip, the output coordinate u perpendicular to the projected depth is monotone.
+          # A linearGradient along u can carry the shading of each face of a strip.
+          dv = np.matmul([0, 0, depth], R)[:2]
+          u_dir = None
+          if self.options.strip_gradient and np.linalg.norm(dv) > CMP_EPS:
+            u_dir = np.array([-dv[1], dv[0]]) / np.linalg.norm(dv)
+
+          def strip_gradient(fl, fronts):
+            """ Add a linearGradient with a hard step for each face color of strip fl. Returns its url,
+                or None if the strip has no extent in u.
+            """
+            u = np.dot(V[fronts][:,:2], u_dir) * 25.4/svg.dpi
+            if abs(u[-1] - u[0]) < CMP_EPS:
+              return None
+            off = np.maximum.accumulate(np.clip((u - u[0]) / (u[-1] - u[0]), 0, 1))
+            stops = ''
+            k = 0
+            while k < len(fl):
+              # neighbour faces of the same color share their two stops.
+              m = k
+              while m+1 < len(fl) and side_color[fl[m+1]] == side_color[fl[k]]: m += 1
+              for o in (off[k], off[m+1]):
+                stops += '<stop offset="%.6f" style="stop-color:%s"/>' % (o, side_color[fl[k]])
+              k = m+1
+            gid = 'path_g_id'+str(missing_id)
+            add_elem(g2, 'linearGradient', { 'id': gid, 'gradientUnits': 'userSpaceOnUse',
+              'x1': '%.6f' % (u[0]*u_dir[0]), 'y1': '%.6f' % (u[0]*u_dir[1]),
+              'x2': '%.6f' % (u[-1]*u_dir[0]), 'y2': '%.6f' % (u[-1]*u_dir[1]) }, inner=stops)
+            return 'url(#'+gid+')'
+
+          ## 4) merge neighbour strips of a subpath that follow each other in zsort_idx.
+          # With the same flat style and a hidden edge between them, one path looks the same as two.
+          def flat_style(fl):
+            if len(set([side_color[f] for f in fl])) > 1: return None
+            return side_style[fl[0]]
+
+          runs = []     # (faces, strips) in drawing order
+          for r in zsort_idx:
+            fl = strips[r]
+            if runs and flat_style(fl) is not None and flat_style(fl) == flat_style(runs[-1][0]):
+              (rf, rs) = runs[-1]
+              if succ[rf[-1]] == fl[0] and edge_owner[F[fl[0]][0]] < 0 and np.dot(N[rf[-1]], N[fl[0]]) > 0:
+                runs[-1] = (rf + fl, rs + [r])
+                continue
+              if succ[fl[-1]] == rf[0] and edge_owner[F[rf[0]][0]] < 0 and np.dot(N[fl[-1]], N[rf[0]]) > 0:
+                runs[-1] = (fl + rf, [r] + rs)
+                continue
+            runs.append((list(fl), [r]))
+          if len(runs) < nstrips:
+            print("merge: ", nstrips, "strips in", len(runs), "paths", file=self.tty)
+
           ## add the sorted elements to the dom tree.
           sorted_idx = 0
-          for i in zsort_idx:
-            path = paths3d_2[i]
-            inkex.etree.SubElement(g2,   'path', { 'id': 'path_e_id'+str(missing_id),  'style': path['style'], 'd': paths_to_svgd([path['data']], 25.4/svg.dpi) })
+          for (fl, rs) in runs:
+            r = rs[0]
+            fronts = [E[F[f][0]][0] for f in fl] + [E[F[fl[-1]][1]][0]]
+            backs = [E[F[f][0]][1] for f in fl] + [E[F[fl[-1]][1]][1]]
+            data = V[[fronts[0]] + backs + fronts[::-1]]         # front, up the back, down the front.
+            quad = [V[E[F[fl[0]][0]]], V[E[F[fl[-1]][1]]]]     # the edges at both ends
+            style = side_style[fl[0]]
+            if len(fl) > 1 and len(set([side_color[f] for f in fl])) > 1:
+              # shaded strip: the middle face sets a flat color, or a gradient has all.
+              style = side_style[fl[len(fl)//2]]
+              fill = strip_gradient(fl, fronts) if u_dir is not None else None
+              if fill is not None:
+                t = shade_tmpl[side_shade[fl[0]]]
+                style = t[0] + fill + t[1]
+            add_elem(g2,   'path', { 'id': 'path_e_id'+str(missing_id),  'style': style, 'd': paths_to_svgd([data], 25.4/svg.dpi) })
             if debugging_zsort:
-              inkex.etree.SubElement(g2,   'text', { 'id': 'text_e_id'+str(missing_id),
+              add_elem(g2,   'text', { 'id': 'text_e_id'+str(missing_id),
                 'style': 'font-size:3px;fill:#0000ff',
-                'x': str(path_c4(path['data'], 0, 25.4/svg.dpi)),
-                'y': str(path_c4(path['data'], 1, 25.4/svg.dpi))
-                 }).text = str(sorted_idx) + '(' + str(path['orig_idx']) + ')'
-            if path['edge_visible'][0]:
-              inkex.etree.SubElement(g2, 'path', { 'id': 'path_e1_id'+str(missing_id), 'style': path['edge_style'], 'd': paths_to_svgd([path['edge_data'][0]], 25.4/svg.dpi) })
-            if path['edge_visible'][1]:
-              inkex.etree.SubElement(g2, 'path', { 'id': 'path_e2_id'+str(missing_id), 'style': path['edge_style'], 'd': paths_to_svgd([path['edge_data'][1]], 25.4/svg.dpi) })
+                'x': str(path_c4(data, 0, 25.4/svg.dpi)),
+                'y': str(path_c4(data, 1, 25.4/svg.dpi))
+                 }, str(sorted_idx) + '(' + str(r) + ')')
+            if edge_owner[F[fl[0]][0]] == rs[0]:
+              add_elem(g2, 'path', { 'id': 'path_e1_id'+str(missing_id), 'style': side_edge_style[F[fl[0]][0]], 'd': paths_to_svgd([quad[0]], 25.4/svg.dpi) })
+            if edge_owner[F[fl[-1]][1]] == rs[-1]:
+              add_elem(g2, 'path', { 'id': 'path_e2_id'+str(missing_id), 'style': side_edge_style[F[fl[-1]][1]], 'd': paths_to_svgd([quad[1]], 25.4/svg.dpi) })
             missing_id += 1
             sorted_idx += 1
 
+        if clip is not None:
+          print("clip: ", clip_count[0], "faces outside the clip region dropped", file=self.tty)
+
+        ## all generated faces and edges are parsed and appended per group, in the order queued above.
+        add_fragments()
+
 
 if __name__ == '__main__':
     e = FlatProjection()
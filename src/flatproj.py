@@ -32,6 +32,26 @@
 # 2019-06-28, jw, v0.9.3  added shading options.
 # 2019-07-01, jw, v0.9.4  Fixed manual rotation.
 # 2019-07-08, jw, v0.9.5  extra rotation added. We sometimes need out of order rotations.
+# 2026-10-17,     v0.9.6  Sweep-line z-sort from src/zsort2d.py replaces the all-pairs cmp2D() loop.
+#                         * option --zsort=pairs: vectorized, block-chunked cmp2D_batch().
+#                           Only pairs from overlap_pairs() are compared, most pairs cannot overlap in x.
+#                         * side walls are sorted in independent x_clusters().
+#                         * option --zsort_workers: sort clusters on a process pool.
+#                         * TSortArray: CSR adjacency and a heap. Unrelated faces keep document order.
+#                           Cycles are broken locally, instead of aborting with "cyclic dependency".
+#                         * O(n) edge visibility from face adjacency and edge position, no pairwise same_point3d().
+#                         * side walls are an indexed mesh: vertex buffer, edge and face index arrays.
+#                         * all subpaths are projected in one batch, subpaths are views into it.
+#                         * flat shading of all side faces in one vectorized pass, one SvgColor per distinct fill.
+#                         * options --style_classes, --shading_levels: each distinct style is written once.
+#                         * options --path_precision, --path_relative: compact path data, formatted per array.
+#                         * generated elements are queued as xml text and parsed once per group.
+#                         * option --curved_faces: front and back faces keep their curves, under a matrix.
+#                         * option --side_strips: smooth runs of side faces become one path each, shaded by a gradient.
+#                         * side faces that sort next to their coplanar neighbour of the same style merge into one path.
+#                         * option --cull_back: side faces pointing away are dropped for closed, opaque objects.
+#                         * option --clip: faces outside the page or a given rectangle are dropped, and counted.
+#                         * option --lod: sub-pixel side faces are dropped, nearly collinear points merged.
 #
 # TODO:
 #   * test: adjustment of line-width according to transformation.
@@ -90,15 +110,20 @@ else:   # Linux
 ## INLINE_BLOCK_START
 # for easier distribution, our Makefile can inline these imports when generating flat-projection.py from src/flatproj.py
 from inksvg import InkSvg, LinearPathGen
-from tsort import TSort
+from tsort import TSortArray
 from svgcolor import SvgColor
+from zsort2d import seg_arrays, x_clusters, zsort_clusters, facing_away
 ## INLINE_BLOCK_END
 
 import json
 import inkex
+import cubicsuperpath
 import gettext
+from xml.sax.saxutils import escape, quoteattr
 
 CMP_EPS = 0.000001
+CULL_PROBE = 0.0001               # back-face culling probes inside/outside at this fraction of a segment length.
+STRIP_BEND_DEG = 30.0            # --side_strips: a sharper angle between neighbour faces starts a new strip.
 debugging_zsort = False          # Add sorting numbers and arrows to perimeter shell; print lists to tty.
 
 # python2 compatibility. Inkscape runs us with python2!
@@ -107,10 +132,36 @@ if sys.version_info.major < 3:
                 return "".join(map(chr, tupl))
 
 
+class CurvePathGen(LinearPathGen):
+    """
+    A LinearPathGen, that also keeps the path data of each object as it was before flattening.
+    curves[i] is the path d that produced svg.paths[i].
+    With flatten=False, objects are not flattened at all. Their svg.paths entries have no subpaths.
+    flatten can also be a function of the node, to decide per object.
+    """
+    def __init__(self, smoothness=0.2, flatten=True):
+        LinearPathGen.__init__(self, smoothness=smoothness)
+        self.flatten = flatten
+        self.curves = []
+
+    def pathString(self, d, node, mat):
+        if not (self.flatten(node) if callable(self.flatten) else self.flatten):
+            if d:
+                self._svg.paths.append( (node, [], mat) )
+                self.curves.append(d)
+            return
+        n = len(self._svg.paths)
+        LinearPathGen.pathString(self, d, node, mat)
+        self.curves += [d] * (len(self._svg.paths) - n)
+
+    def objRoundedRect(self, x, y, w, h, rx, ry, node, mat):
+        self.pathString(self._svg.roundedRectBezier(x, y, w, h, rx, ry), node, mat)
+
+
 class FlatProjection(inkex.Effect):
 
     # CAUTION: Keep in sync with flat-projection.inx and flat-projection_de.inx
-    __version__ = '0.9.5'         # >= max(src/flatproj.py:__version__, src/inksvg.py:__version__)
+    __version__ = '0.9.6'         # >= max(src/flatproj.py:__version__, src/inksvg.py:__version__)
 
     def __init__(self):
         """
@@ -222,10 +273,62 @@ Option parser example:
             '--shading', dest='shading_perc', type='float', default=float(10), action='store',
             help='Flat shading percentage. Compute lightness change of surfaces. Surfaces with a normal at 90 degrees with the ray direction are unaffected. 100% colors a face white, when its normal is the ray direction, and black when it is oposite. Use 0 to disable shading. Default(%): 10')
 
+        self.OptionParser.add_option(
+            '--shading_levels', dest='shading_levels', type='int', default=0, action='store',
+            help='Quantize flat shading to this number of lightness levels. Fewer levels give fewer distinct styles. 0 does not quantize, 1 keeps the unshaded color. Default: 0')
+
+        self.OptionParser.add_option(
+            "--style_classes", action="store", type="inkbool", dest="style_classes", default=False,
+            help="Write each distinct style once into a <style> block. Generated paths refer to it by class. Default: False")
+
+        self.OptionParser.add_option(
+            "--lod", action="store", type="float", dest="lod", default=0.0,
+            help="Level of detail in device pixels: merge nearly collinear points and drop side faces of less area. Default: 0 (off)")
+
+        self.OptionParser.add_option(
+            "--clip", action="store", type="string", dest="clip", default="",
+            help="Drop faces outside a clip region: 'page', or x,y,width,height in mm. Default: '' (no clipping)")
+
+        self.OptionParser.add_option(
+            "--cull_back", action="store", type="inkbool", dest="cull_back", default=True,
+            help="Drop side faces that point away from the viewer, where an opaque object hides them. Default: True")
+
+        self.OptionParser.add_option(
+            "--side_strips", action="store", type="inkbool", dest="side_strips", default=False,
+            help="Join neighbour side faces into strips, that face the same way without a sharp bend. Edges are only drawn between strips. Default: False")
+
+        self.OptionParser.add_option(
+            "--strip_gradient", action="store", type="inkbool", dest="strip_gradient", default=True,
+            help="Shade side strips with a linearGradient, instead of one flat color each. Default: True")
+
+        self.OptionParser.add_option(
+            "--curved_faces", action="store", type="inkbool", dest="curved_faces", default=False,
+            help="Write front and back faces with the original path data and a transform matrix. Curves stay exact. Default: False")
+
+        self.OptionParser.add_option(
+            '--path_precision', dest='path_precision', type='int', default=6, action='store',
+            help='Number of decimal places in generated path data. Default: 6')
+
+        self.OptionParser.add_option(
+            "--path_relative", action="store", type="inkbool", dest="path_relative", default=False,
+            help="Write generated path data with relative l/h/v commands and without redundant digits. Default: False")
+
         self.OptionParser.add_option(
             '--smoothness', dest='smoothness', type='float', default=float(0.2), action='store',
             help='Curve smoothing (less for more [0.0001 .. 5]). Default: 0.2')
 
+        self.OptionParser.add_option(
+            '--zsort', dest='zsort', type='string', default='sweep', action='store',
+            help='Ordering engine for the side walls. One of sweep (compare vertically adjacent faces only), pairs (vectorized cmp2D() of candidate pairs). Default: sweep')
+
+        self.OptionParser.add_option(
+            '--zsort_block', dest='zsort_block', type='int', default=100000, action='store',
+            help='Number of candidate pairs compared at once with --zsort=pairs. Bounds peak memory. Default: 100000')
+
+        self.OptionParser.add_option(
+            '--zsort_workers', dest='zsort_workers', type='int', default=1, action='store',
+            help='Number of processes sorting independent clusters of side walls. 0 uses all CPUs. Default: 1')
+
 
         self.OptionParser.add_option('-V', '--version',
           action = 'store_const', const=True, dest = 'version', default = False,
@@ -261,6 +364,25 @@ Option parser example:
             return(not nomatch)
         return nomatch
 
+    def is_opaque_fill(self, node, style_d):
+        """
+        True if the fill of node hides what is behind it. style_d is from getPathStyle(node).
+        A missing fill, a gradient or pattern fill, or an opacity below 1 here or in a parent group is not opaque.
+        """
+        fill = style_d.get('fill', 'none').strip()
+        if fill in ('none', '') or fill.startswith('url('):
+          return False
+        try:
+          opacity = float(style_d.get('fill-opacity', 1)) * float(style_d.get('opacity', 1))
+          node = node.getparent()
+          while node is not None:
+            m = re.search(r'(?:^|;)\s*opacity\s*:\s*([^;]+)', node.get('style') or '')
+            opacity *= float(m.group(1) if m else node.get('opacity', 1))
+            node = node.getparent()
+        except ValueError:
+          return False
+        return opacity >= 1.0
+
     def find_selected_id(self, node):
         while node is not None:
           id = node.attrib.get('id', '')
@@ -268,30 +390,39 @@ Option parser example:
           node = node.getparent()
         return None
 
-    def apply_shading(self, fill, normal):
+    def shading_adjust(self, normals):
         """
-        Apply self.options.shading_perc to the fill color, depending on the angle between
-        self.options.ray_direction and normal. fill is lightened when the angle is less
-        than 90 deg, and darkened when it is more than 90 deg.
+        Compute the lightness adjustment for an array of face normals. It applies self.options.shading_perc
+        depending on the angle between self.options.ray_direction and each normal. Faces are lightened
+        when the angle is less than 90 deg, and darkened when it is more than 90 deg.
+        With self.options.shading_levels, only that many distinct adjustments are used.
+        Use with SvgColor.adjusted_light().
         """
-
-        ## compute angle between two vectors in 3D
-        def vector_angle_3d(a, b):
-           norm_ab = np.linalg.norm(a) * np.linalg.norm(b)
-           if norm_ab == 0.: return 0
-           return np.arccos(np.dot(a,b) / norm_ab)
-
         ray = np.array(list(map(lambda x: float(x), self.options.ray_direction.split(','))))
-        alpha = 90-np.degrees(vector_angle_3d(ray, normal))
-        c = SvgColor(fill)
-        c.adjust_light(alpha*2.55/90 * float(self.options.shading_perc))
-        print("apply_shading: alpha=", alpha, " -> adjust_light(", alpha*2.55/90 * float(self.options.shading_perc), ")", file=self.tty)
-        return str(c)
+        normals = np.asarray(normals, dtype=float).reshape(-1, 3)
+        norm = np.linalg.norm(normals, axis=1) * np.linalg.norm(ray)
+        cos = np.ones(len(normals))             # a zero normal counts as angle 0
+        ok = norm != 0.
+        cos[ok] = np.clip(np.dot(normals[ok], ray) / norm[ok], -1., 1.)
+        alpha = 90-np.degrees(np.arccos(cos))
+        adjust = alpha*2.55/90 * float(self.options.shading_perc)
+        levels = self.options.shading_levels
+        if levels == 1:
+          adjust = np.zeros(len(normals))       # the one level in the middle: no adjustment.
+        elif levels > 1:
+          amax = 2.55 * float(self.options.shading_perc)
+          step = 2*amax/(levels-1)
+          adjust = np.round((adjust+amax)/step)*step - amax
+        return adjust
 
 
     def effect(self):
         smooth = float(self.options.smoothness) # svg.smoothness to be deprecated!
-        pg = LinearPathGen(smoothness=smooth)
+        # with curved faces, only objects that get side walls need to be flattened.
+        flatten = True
+        if self.options.curved_faces:
+          flatten = lambda node: self.options.with_sides and self.is_extrude_color(svg, node, self.options.apply_depth)
+        pg = CurvePathGen(smoothness=smooth, flatten=flatten)
         svg = InkSvg(document=self.document, pathgen=pg, smoothness=smooth)
 
         # Viewbox handling
@@ -317,6 +448,7 @@ Option parser example:
               inkex.addNS('label','inkscape'): self.options.dest_layer,
               inkex.addNS('groupmode','inkscape'): 'layer',
               'id': self.options.dest_layer })
+            svg.indexElement(dest_layer)
         # print('dest_layer', dest_layer, dest_layer.attrib, file=self.tty)
 
         # Second traverse the document (or selected items), reducing
@@ -342,11 +474,12 @@ Option parser example:
         ##                  [[[207, 744], [264, 801]],                         [[207, 801], [264, 744]]], ... ]
         ##
         paths_tupls = []
-        for tup in svg.paths:
+        for i in range(len(svg.paths)):
+            tup = svg.paths[i]
             ll = []
             for e in tup[1]:
                 ll.append(e[0])
-            paths_tupls.append( (tup[0], ll, tup[2]) )          # tup[2] is a transform matrix.
+            paths_tupls.append( (tup[0], ll, tup[2], pg.curves[i]) )    # tup[2] is a transform matrix, pg.curves[i] the path d.
         self.paths = None       # free some memory
 
         print("paths_tupls:\n", repr(paths_tupls), self.selected, svg.dpi, self.current_layer, file=self.tty)
@@ -368,14 +501,13 @@ Option parser example:
             src_id = self.find_selected_id(node)
             if src_id in dest_ids:
               return dest_g[dest_ids[src_id]]
-            existing_ids = map(lambda x: x.attrib.get('id', ''), list(dest_layer))
             n = 0;
             if src_id is None:
                 print("Please select one or more objects.", file=sys.stderr)
                 return
             print("find_selected_id:\n", src_id, node, file=self.tty)
             id = src_id+'_'+str(n)
-            while id in existing_ids:
+            while svg.getElementsById(id):
               n = n+1
               id = src_id+'_'+str(n)
             dest_ids[src_id] = id
@@ -388,6 +520,8 @@ Option parser example:
             g3 = inkex.etree.SubElement(g, 'g', { 'id': id+'_3', 'src': src_path })
             g2 = inkex.etree.SubElement(g, 'g', { 'id': id+'_2', 'src': src_path })
             g1 = inkex.etree.SubElement(g, 'g', { 'id': id+'_1', 'src': src_path })
+            for e in g.iter():
+              svg.indexElement(e)
             dest_g[id] = ( g1, g2, g3, '_'+str(n)+'_' )
             return dest_g[id]
 
@@ -398,23 +532,74 @@ Option parser example:
           if d < -CMP_EPS: return -1
           return 0
 
-        def same_point3d(a, b):
-          if cmp_f(a[0], b[0]): return False
-          if cmp_f(a[1], b[1]): return False
-          if cmp_f(a[2], b[2]): return False
-          return True
+        def merge_collinear(path, tol):
+          """ Drop the points of a flattened subpath that lie within tol of the segment between their kept neighbours.
+              First and last point stay, so that closed subpaths stay closed.
+              One pass: each dropped point allows the directions from the last kept point, that pass it within tol.
+              The next point is dropped too, if it is in all these directions, and not nearer than the others.
+          """
+          if len(path) < 3:
+            return path
+          p = np.asarray(path, dtype=float)
+          out = [p[0]]
+          (ax, ay) = p[0][:2]
+          ref = None    # direction to the first point beyond tol. Angles are relative to it.
+          i = 1
+          while i < len(p):
+            (vx, vy) = (p[i][0] - ax, p[i][1] - ay)
+            r = np.hypot(vx, vy)
+            if ref is None:
+              if r > tol:
+                ref = (vx / r, vy / r)
+                w = np.arcsin(tol / r)
+                (lo, hi, rmax) = (-w, w, r)
+              i += 1
+              continue
+            phi = np.arctan2(ref[0]*vy - ref[1]*vx, ref[0]*vx + ref[1]*vy)
+            if lo <= phi <= hi and r >= rmax:
+              w = np.arcsin(tol / r)
+              (lo, hi, rmax) = (max(lo, phi - w), min(hi, phi + w), r)
+              i += 1
+              continue
+            out.append(p[i-1])          # p[i] is out of reach: keep the point before, and start over from there.
+            (ax, ay) = p[i-1][:2]
+            ref = None
+          out.append(p[-1])
+          return np.array(out)
+
+        svgd_prec = max(0, self.options.path_precision)
+        svgd_num = '%%.%df' % svgd_prec
+        svgd_rel = ('', 'h'+svgd_num, 'v'+svgd_num, 'l'+svgd_num+','+svgd_num)    # indexed by (dx != 0) + 2*(dy != 0)
+
+        def compact_svgd(d):
+          " drop redundant digits from all numbers in d: trailing zeros, leading zeros, commas before minus signs "
+          d = re.sub(r'(\.\d*?)0+(?!\d)', r'\1', d)
+          d = re.sub(r'\.(?!\d)', '', d)
+          d = re.sub(r'(?<![\d.])0\.(?=\d)', '.', d)
+          return d.replace(',-', '-')
 
         def points_to_svgd(p, scale=1.0):
-          " convert list of points into a closed SVG path list"
-          f = p[0]
-          p = p[1:]
+          """ convert list of points into a closed SVG path list.
+              All coordinates are formatted in one go. With --path_relative, the l/h/v commands are computed
+              from the rounded absolute coordinates, so that rounding errors do not add up.
+          """
+          p = np.asarray(p, dtype=float)
+          p = p.reshape(len(p), -1)[:,:2]      # x, y of 2D or 3D points
           closed = False
-          if cmp_f(p[-1][0], f[0]) == 0 and cmp_f(p[-1][1], f[1]) == 0:
+          if len(p) > 1 and cmp_f(p[-1][0], p[0][0]) == 0 and cmp_f(p[-1][1], p[0][1]) == 0:
             p = p[:-1]
             closed = True
-          svgd = 'M%.6f,%.6f' % (f[0]*scale, f[1]*scale)
-          for x in p:
-            svgd += 'L%.6f,%.6f' % (x[0]*scale, x[1]*scale)
+          if not self.options.path_relative:
+            svgd = ('M'+svgd_num+','+svgd_num + ('L'+svgd_num+','+svgd_num)*(len(p)-1)) % tuple((p*scale).ravel())
+          else:
+            q = np.round(p*scale*10**svgd_prec)
+            dq = q[1:] - q[:-1]
+            kind = (dq[:,0] != 0) + 2*(dq[:,1] != 0)
+            # the numbers each command takes: h dx, v dy, l dx dy. Duplicate points take none.
+            nargs = np.array([0, 1, 1, 2])[kind]
+            args = np.stack((np.where(kind == 2, dq[:,1], dq[:,0]), dq[:,1]), axis=1)[np.arange(2) < nargs[:,None]]
+            svgd = compact_svgd((('M'+svgd_num+','+svgd_num) + ''.join([svgd_rel[k] for k in kind.tolist()])) %
+                                tuple(np.concatenate((q[0], args)) * 10.0**-svgd_prec))
           if closed:
             svgd += 'z'
           return svgd
@@ -449,17 +634,53 @@ Option parser example:
           for key in sty: s += str(key)+':'+str(sty[key])+';'
           return s.rstrip(';')
 
-        ## import from test_zsort2d.py
+        style_classes = {}  # map from dest_id to ({style: class name}, style element)
+        def styled(g, attrs):
+          """ With --style_classes, replace attrs['style'] with a class. Each distinct style is written once
+              into a <style> block in the parent group of g.
+          """
+          if not self.options.style_classes or 'style' not in attrs:
+            return attrs
+          top = g.getparent()
+          top_id = top.attrib.get('id', '')
+          if top_id not in style_classes:
+            style_classes[top_id] = ({}, inkex.etree.Element('style', { 'id': top_id+'_style', 'type': 'text/css' }))
+            top.insert(0, style_classes[top_id][1])
+          (names, css) = style_classes[top_id]
+          style = attrs.pop('style')
+          if style not in names:
+            names[style] = top_id+'_c'+str(len(names))
+            css.text = (css.text or '') + '.'+names[style]+' { '+style+' }\n'
+          attrs['class'] = names[style]
+          return attrs
+
+        fragments = {}      # map from a destination group to the xml text of its new children, in order.
+        style_xml = {}      # map from (group, style) to the xml text of the style or class attribute.
+        def add_elem(g, tag, attrs, text='', inner=''):
+          """ Queue a new child element of g. add_fragments() parses all children of a group in one go.
+              attrs['style'] goes through styled(). Each distinct style is formatted only once.
+              inner is xml text of child elements.
+          """
+          xml = '<' + tag
+          for key in attrs:
+            if key == 'style':
+              if (g, attrs[key]) not in style_xml:
+                sa = styled(g, { 'style': attrs[key] })
+                style_xml[(g, attrs[key])] = ''.join([' %s=%s' % (k, quoteattr(sa[k])) for k in sa])
+              xml += style_xml[(g, attrs[key])]
+            else:
+              xml += ' %s=%s' % (key, quoteattr(attrs[key]))
+          if g not in fragments: fragments[g] = []
+          fragments[g].append(xml + '>' + escape(text) + inner + '</' + tag + '>')
 
-        def y_at_x(gp, gv, x):
-          dx = x-gp[0]
-          if abs(gv[0]) < CMP_EPS:
-            return None
-          s = dx/gv[0]
-          if s < 0.0 or s > 1.0:
-            return None
-          return gp[1]+s*gv[1]
+        def add_fragments():
+          " Append all queued children to their groups. "
+          parser = inkex.etree.XMLParser(huge_tree=True)
+          for g in fragments:
+            g.extend(list(inkex.etree.fromstring('<g>' + ''.join(fragments[g]) + '</g>', parser)))
+          fragments.clear()
 
+        ## import from test_zsort2d.py
 
         # Zsort is only done for the rim.
         # - the general 3d face sorting problem can be reduced to a 2D problem as all faces span between two parallel planes.
@@ -515,44 +736,13 @@ Option parser example:
         #    - run tsort, implement Kahn's algorithm from https://en.wikipedia.org/wiki/Topological_sorting
         #      or Don Knuths algoritm T from p.266 of The_Art_of_Computer_Programming-Vol1.pdf
         #
+        #  * sweep-line (implemented in src/zsort2d.py: sweep_edges())
+        #    - the X-coordinates idea above, but only vertically adjacent lines are compared.
+        #      This feeds O(n) edges into tsort, instead of calling cmp2D() for all O(n^2) pairs.
+        #
         # ------------------------------------------------
         #
         #
-        def cmp2D(g1, g2):
-          """
-          returns -1 if g1 sorts in front of g2
-          returns 1  if g1 sorts in behind g2
-          returns None  if there was no clear decision
-          """
-          # convert g1 into point and vector:
-          g1p = g1[0]
-          g1v = (g1[1][0] - g1[0][0], g1[1][1] - g1[0][1])
-          #
-          y = y_at_x(g1p, g1v, g2[0][0])
-          if y is not None:
-            if y < g2[0][1]-CMP_EPS: return -1
-            if y > g2[0][1]+CMP_EPS: return 1
-          #
-          y = y_at_x(g1p, g1v, g2[1][0])
-          if y is not None:
-            if y < g2[1][1]-CMP_EPS: return -1
-            if y > g2[1][1]+CMP_EPS: return 1
-          #
-          g2p = g2[0]
-          g2v = (g2[1][0] - g2[0][0], g2[1][1] - g2[0][1])
-          y = y_at_x(g2p, g2v, g1[0][0])
-          if y is not None:
-            if g1[0][1]+CMP_EPS < y: return -1
-            if g1[0][1]-CMP_EPS > y: return 1
-          #
-          y = y_at_x(g2p, g2v, g1[1][0])
-          if y is not None:
-            if g1[1][1]+CMP_EPS < y: return -1
-            if g1[1][1]-CMP_EPS > y: return 1
-          #
-          return None   # non-comparable pair in the poset. sorted() would take that as less than aka -1
-
-
         def phi2D(R):
           """
           Given a 3D rotation matrix R, we compute the angle phi projected in the
@@ -753,10 +943,75 @@ Option parser example:
         else:
             backview = False
 
-        paths2d_flat = []                       # one list of all line segments. Used for index sorting of side faces.
-        paths3d_2 = []                          # side: visible edges and faces
+        # With --clip, faces entirely outside this rectangle are dropped: xmin, ymin, xmax, ymax in svg units.
+        clip = None
+        clip_count = [0]
+        if self.options.clip.strip() == 'page':
+            clip = (0.0, 0.0, svg.docWidth, svg.docHeight)
+        elif self.options.clip.strip() != '':
+            try:
+                (x, y, w, h) = [float(c) / 25.4 * svg.dpi for c in re.split('[ ,;]+', self.options.clip.strip())]
+                clip = (x, y, x+w, y+h)
+            except ValueError:
+                inkex.errormsg("Ignoring --clip='%s'. Expected 'page' or x,y,width,height in mm." % self.options.clip)
+
+        def outside_clip(paths3d):
+          " True if the bounding box of all points in paths3d lies outside the clip rectangle. Counted in clip_count. "
+          if clip is None or not sum([len(p) for p in paths3d]):
+            return False
+          p = np.concatenate([p for p in paths3d if len(p)])
+          if p[:,0].max() < clip[0] or p[:,0].min() > clip[2] or p[:,1].max() < clip[1] or p[:,1].min() > clip[3]:
+            clip_count[0] += 1
+            return True
+          return False
+
+        def curve_points(d, transform):
+          " The control points of path d under transform, as front face points. Their bounding box contains the curve. "
+          p = [pt for sub in cubicsuperpath.parsePath(d) for csp in sub for pt in csp]
+          p = np.array(p, dtype=float).reshape(-1, 2)
+          return np.matmul(np.matmul(np.column_stack((p, np.ones(len(p)))), np.array(transform, dtype=float).T), R[:2])
+
+        # --lod: details below this many pixels are dropped. Projection scales lengths by at most proj_scale.
+        lod = max(0.0, self.options.lod)
+        if lod > 0:
+          npts = 0
+          for tupl in paths_tupls:
+            for i in range(len(tupl[1])):
+              npts += len(tupl[1][i])
+              tupl[1][i] = merge_collinear(tupl[1][i], lod / proj_scale)
+          print("lod: ", npts, "points merged into", sum([len(p) for t in paths_tupls for p in t[1]]), file=self.tty)
+
+        # All subpaths of all objects are concatenated into one array of xy points, sub_off[k] is where subpath k starts.
+        # Front ring, back ring and the 2D rotation for the z-sort are each computed in one go, subpaths get views.
+        sub_off = [0]
+        for tupl in paths_tupls:
+            for path in tupl[1]:
+              sub_off.append(sub_off[-1] + len(path))
+        pts2d = np.zeros((sub_off[-1], 2))
+        k = 0
         for tupl in paths_tupls:
-            (elem, paths, transform) = tupl
+            for path in tupl[1]:
+              if len(path): pts2d[sub_off[k]:sub_off[k+1]] = path
+              k += 1
+        npts = len(pts2d)
+        front3d = np.matmul(pts2d, R[:2])                       # [x, y, 0] * R
+        back3d = front3d + np.matmul([0, 0, depth], R)          # [x, y, depth] * R
+
+        seg_start = []                          # index into pts2d of the first point of each line segment. One per side face.
+        # side walls as an indexed mesh. The vertex buffer is front3d followed by back3d.
+        side_edges = []                         # vertical edges: [front vertex, back vertex]
+        side_edge_style = []                    # stroke style of each edge
+        side_faces = []                         # quad faces: [edge 0, edge 1]. Neighbour faces share an edge index.
+        side_rings = []                         # faces of a subpath: (first face, number of faces, closed)
+        side_style = []                         # fill style of each face
+        side_shade = []                         # per face an index into shade_fill, shade_tmpl. Or -1 if not shaded.
+        shade_tmpl = []                         # style of an object, split where the fill color goes.
+        shade_fill = []                         # fill of an object, as an index into fill_ids.
+        fill_ids = {}                           # distinct fill colors
+        cull_objs = []                          # closed opaque objects: (first ring, end ring, evenodd)
+        k = 0
+        for tupl in paths_tupls:
+            (elem, paths, transform, curve) = tupl
             (g1, g2, g3, suf) = find_dest_g(elem, dest_layer)
             if backview:
                 g1,g3 = g3,g1
@@ -771,6 +1026,14 @@ Option parser example:
             style_d_nostroke = style_d.copy()
             style_d_nostroke['stroke'] = 'none'
             style = fmtPathStyle(style_d)
+            style_nostroke = fmtPathStyle(style_d_nostroke)
+            shade = -1
+            if self.options.shading_perc > 0 and 'fill' in style_d_nostroke:
+              # modulate face color with shading, corresponding to the angle. Done for all faces after the loop.
+              shade = len(shade_tmpl)
+              shade_fill.append(fill_ids.setdefault(style_d_nostroke['fill'], len(fill_ids)))
+              style_d_nostroke['fill'] = '\0'
+              shade_tmpl.append(fmtPathStyle(style_d_nostroke).split('\0'))
 
             if path_id == suf:
               path_id = 'pathx'+str(missing_id)+suf
@@ -778,102 +1041,259 @@ Option parser example:
             paths3d_1 = []
             paths3d_3 = []
             extrude = self.is_extrude_color(svg, elem, self.options.apply_depth)
+            ring0 = len(side_rings)
             for path in paths:
-              # Extend an array of xy vectors (path) into into xyz vectors with all z==0 (path3d_1)
-              p3d_1 = np.zeros( (len(path), 3) )
-              p3d_1[:,:-1] = path       # magic numpy slicing ..
-              # paths3d_1 is the front face: rotate p3d_1 into 3D space according to R
-              paths3d_1.append(np.matmul(p3d_1, R))
+              v0 = sub_off[k]
+              n = sub_off[k+1] - v0
+              k += 1
+              # paths3d_1 is the front face, paths3d_3 the back face
+              paths3d_1.append(front3d[v0:v0+n])
               if extrude:
+                paths3d_3.append(back3d[v0:v0+n])
 
-                # paths3d_3 is the back face: translate p3d_1 along z-axis then rotate into 3D space according to R
-                p3d_1 += [0, 0, depth]
-                paths3d_3.append(np.matmul(p3d_1, R))
-
-                # paths3d_2 holds all permimeter faces: beware of z-sort dragons.
+                # side walls: beware of z-sort dragons.
                 ##########################
-                if self.options.with_sides:
-                  for i in range(0, len(path)-1):
-                    paths2d_flat.append([path[i], path[i+1], len(paths2d_flat)])
-                  for i in range(0, len(paths3d_1[-1])-1):
-                    a, b = paths3d_1[-1][i],   paths3d_3[-1][i]
-                    c, d = paths3d_1[-1][i+1], paths3d_3[-1][i+1]
-                    style_d2_nostroke = style_d_nostroke.copy()
-                    if self.options.shading_perc > 0 and 'fill' in style_d2_nostroke:
-                      # modulate face color with shading, corresponding to the angle.
-                      fill = style_d2_nostroke['fill']
-                      style_d2_nostroke['fill'] = self.apply_shading(fill, np.cross(np.array(b)-np.array(a), np.array(c)-np.array(a)))
-                    style_2_nostroke = fmtPathStyle(style_d2_nostroke)
-                    paths3d_2.append({
-                      'orig_2Dpath': paths2d_flat[len(paths3d_2)],
-                      'orig_idx': len(paths3d_2),
-                      'edge_style': style,
-                      'edge_data': [[a, b], [c, d]],
-                      'edge_visible': [1, 1],
-                      'style': style_2_nostroke,
-                      'data': [a,b,d,c,a]})
-                  assert(len(paths2d_flat) == len(paths3d_2))
-
-            if extrude and self.options.with_back:
-                # populate back face with selected colors only
-                inkex.etree.SubElement(g3, 'path', { 'id': path_id+'3', 'style': style, 'd': paths_to_svgd(paths3d_3, 25.4/svg.dpi) })
-            # populate front face with all colors
-            if self.options.with_front:
-                inkex.etree.SubElement(g1, 'path', { 'id': path_id+'1', 'style': style, 'd': paths_to_svgd(paths3d_1, 25.4/svg.dpi) })
+                # repeated points, e.g. an explicit closing point before z, would give faces of zero length.
+                # Of a run of equal points, only the last one is used.
+                vk = [i for i in range(n-1) if cmp_f(path[i][0], path[i+1][0]) or cmp_f(path[i][1], path[i+1][1])] + [n-1]
+                m = len(vk)
+                if self.options.with_sides and m > 1:
+                  seg_start += [v0+i for i in vk[:-1]]
+                  # vertex k of the subpath is front vertex v0+k and back vertex npts+v0+k. Edge k connects the two.
+                  e0 = len(side_edges)
+                  ne = m
+                  if m > 2 and cmp_f(path[vk[0]][0], path[-1][0]) == 0 and cmp_f(path[vk[0]][1], path[-1][1]) == 0:
+                    ne = m-1                    # closed subpath: the last face meets the first face at edge e0.
+                  for i in vk[:ne]:
+                    side_edges.append([v0+i, npts+v0+i])
+                    side_edge_style.append(style)
+                  side_rings.append( (len(side_faces), m-1, ne < m) )
+                  for i in range(0, m-1):
+                    side_faces.append([e0+i, e0+(i+1)%ne])
+                  side_style += [style_nostroke]*(m-1)
+                  side_shade += [shade]*(m-1)
+                  assert(len(seg_start) == len(side_faces))
+
+            # the face on top must be there to cover the inside.
+            if (self.options.cull_back and (self.options.with_back if backview else self.options.with_front) and len(side_rings) > ring0 and
+                all([r[2] for r in side_rings[ring0:]]) and self.is_opaque_fill(elem, style_d)):
+              cull_objs.append( (ring0, len(side_rings), style_d.get('fill-rule', '').strip() == 'evenodd') )
+
+            if self.options.curved_faces:
+                # front and back face are an affine map of the object: keep its path d, add a matrix.
+                # The matrix also scales the stroke, compensate that on average.
+                A = (25.4/svg.dpi) * np.matmul(R[:2,:2].T, np.array(transform, dtype=float))
+                style_d_curve = style_d.copy()
+                if 'stroke-width' in style_d:
+                  try:
+                    style_d_curve['stroke-width'] = str(float(re.sub('[a-z]+$', '', style_d['stroke-width'])) / avgScaleFromM(A.tolist()))
+                  except ValueError:
+                    pass
+                style_curve = fmtPathStyle(style_d_curve)
+                back = (25.4/svg.dpi) * depth * R[2,:2]
+                fmt_matrix = 'matrix(%.9g,%.9g,%.9g,%.9g,%.9g,%.9g)'
+                (clip1, clip3) = (paths3d_1, paths3d_3)
+                if clip is not None and not sum([len(p) for p in paths3d_1]):
+                    # not flattened: clip by the control points of the curve.
+                    clip1 = [curve_points(curve, transform)]
+                    clip3 = [clip1[0] + np.matmul([0, 0, depth], R)]
+                if extrude and self.options.with_back and not outside_clip(clip3):
+                    add_elem(g3, 'path', { 'id': path_id+'3', 'style': style_curve, 'd': curve,
+                      'transform': fmt_matrix % (A[0][0], A[1][0], A[0][1], A[1][1], A[0][2]+back[0], A[1][2]+back[1]) })
+                if self.options.with_front and not outside_clip(clip1):
+                    add_elem(g1, 'path', { 'id': path_id+'1', 'style': style_curve, 'd': curve,
+                      'transform': fmt_matrix % (A[0][0], A[1][0], A[0][1], A[1][1], A[0][2], A[1][2]) })
+            else:
+                if extrude and self.options.with_back and not outside_clip(paths3d_3):
+                    # populate back face with selected colors only
+                    add_elem(g3, 'path', { 'id': path_id+'3', 'style': style, 'd': paths_to_svgd(paths3d_3, 25.4/svg.dpi) })
+                # populate front face with all colors
+                if self.options.with_front and not outside_clip(paths3d_1):
+                    add_elem(g1, 'path', { 'id': path_id+'1', 'style': style, 'd': paths_to_svgd(paths3d_1, 25.4/svg.dpi) })
 
         if self.options.with_sides:
-          ## 1) rotate paths2d_flat for cmp2D()
-          paths2d_flat_rot = []
-          for i in range(len(paths2d_flat)):
-            l = paths2d_flat[i]
-            paths2d_flat_rot.append([np.matmul(l[0], Rz2D), np.matmul(l[1], Rz2D)]+l[2:])
-          #   visualize the original and rotated paths2d_flat in blue, thin and thick.
+          # the side wall mesh, and the face normals.
+          V = np.concatenate((front3d, back3d))
+          E = np.array(side_edges, dtype=int).reshape(-1, 2)
+          F = np.array(side_faces, dtype=int).reshape(-1, 2)
+          A = V[E[F[:,0],0]]
+          N = np.cross(V[E[F[:,0],1]]-A, V[E[F[:,1],0]]-A)
+          seg_start = np.array(seg_start, dtype=int)
+
+          ## cull side faces that point away from the viewer. On a closed object with an opaque fill, the
+          # front face and the side faces towards the viewer always cover them. They are not shaded, sorted or drawn.
+          # Which side of a face is outside, is probed once per subpath, with the fill-rule of the object.
+          cull = np.zeros(len(F), dtype=bool)
+          for (r0, r1, evenodd) in cull_objs:
+            I = np.arange(side_rings[r0][0], side_rings[r1-1][0] + side_rings[r1-1][1])
+            segs = np.hstack((pts2d[seg_start[I]], pts2d[seg_start[I]+1]))
+            rings = [(f0 - I[0], nf) for (f0, nf, closed) in side_rings[r0:r1]]
+            cull[I] = facing_away(segs, rings, R, evenodd, CULL_PROBE, CMP_EPS)
+          nback = int(cull.sum())
+          if lod > 0:
+            # sub-pixel faces, mostly seen edge-on. |N[:,2]| is the projected area of the face.
+            cull |= np.abs(N[:,2]) < lod * lod
+          if clip is not None and len(F):
+            Q = V[E[F].reshape(-1, 4)]          # the 4 corners of each face
+            out = ((Q[:,:,0].max(axis=1) < clip[0]) | (Q[:,:,0].min(axis=1) > clip[2]) |
+                   (Q[:,:,1].max(axis=1) < clip[1]) | (Q[:,:,1].min(axis=1) > clip[3]))
+            clip_count[0] += int((out & ~cull).sum())
+            cull |= out
+          if cull.any():
+            # the remaining faces of a subpath form open chains. Renumber, so that each chain is consecutive.
+            keep = []
+            rings = []
+            for (f0, nf, closed) in side_rings:
+              order = list(range(f0, f0+nf))
+              if cull[f0:f0+nf].any() and closed:
+                last = f0 + int(np.nonzero(cull[f0:f0+nf])[0][-1])
+                order = order[last-f0+1:] + order[:last-f0+1]
+              run = []
+              for f in order + [-1]:
+                if f >= 0 and not cull[f]:
+                  run.append(f)
+                elif len(run):
+                  rings.append( (len(keep), len(run), closed and len(run) == nf) )
+                  keep += run
+                  run = []
+            print("cull: ", int(cull.sum()), "of", len(F), "side faces dropped,", nback, "point away", file=self.tty)
+            keep = np.array(keep, dtype=int)
+            (F, N, seg_start, side_rings) = (F[keep], N[keep], seg_start[keep], rings)
+            side_style = [side_style[i] for i in keep]
+            side_shade = [side_shade[i] for i in keep]
+
+          ## 0) flat shading. Each distinct fill is converted once, with all its faces in one array.
+          side_color = [None] * len(side_style)   # the shaded fill color of each face
+          if len(shade_tmpl):
+            adjust = self.shading_adjust(N)
+            face_shade = np.array(side_shade, dtype=int)
+            face_fill = np.where(face_shade >= 0, np.array(shade_fill+[-1])[face_shade], -1)
+            fills = sorted(fill_ids, key=fill_ids.get)
+            by_fill = np.argsort(face_fill, kind='mergesort')
+            bounds = np.searchsorted(face_fill[by_fill], np.arange(len(fills)+1))
+            for f in range(len(fills)):
+              I = by_fill[bounds[f]:bounds[f+1]]
+              for (i, color) in zip(I.tolist(), SvgColor(fills[f]).adjusted_light(adjust[I])):
+                t = shade_tmpl[side_shade[i]]
+                side_style[i] = t[0] + color + t[1]
+                side_color[i] = color
+
+          ## 1) rotate the line segments for cmp2D(). seg_flat, seg_rot are rows of x0, y0, x1, y1.
+          seg_flat = np.hstack((pts2d[seg_start], pts2d[seg_start+1]))
+          pts2d_rot = np.matmul(pts2d, Rz2D)
+          seg_rot = np.hstack((pts2d_rot[seg_start], pts2d_rot[seg_start+1]))
+          #   visualize the original and rotated line segments in blue, thin and thick.
           if debugging_zsort:
-            for i in range(len(paths2d_flat)):
-              print("[paths2d_flat[i][:2]]: ", i, paths2d_flat[i], file=self.tty)
+            for i in range(len(seg_flat)):
+              print("seg_flat[i]: ", i, seg_flat[i], file=self.tty)
               inkex.etree.SubElement(g2,   'path', { 'id': 'path_flat_orig_id'+str(missing_id)+'_'+str(i),
                 'style': "stroke:#0000ff;stroke-width:0.1;stroke-dasharray:0.1,0.3;fill:none",
-                'd': paths_to_svgd([paths2d_flat[i][:2]], 25.4/svg.dpi) })
-            for i in range(len(paths2d_flat_rot)):
-              print("paths2d_flat_rot[i][0]: ", i, paths2d_flat_rot[i], file=self.tty)
+                'd': paths_to_svgd([[seg_flat[i][:2], seg_flat[i][2:]]], 25.4/svg.dpi) })
+            for i in range(len(seg_rot)):
+              print("seg_rot[i]: ", i, seg_rot[i], file=self.tty)
               inkex.etree.SubElement(g2,   'path', { 'id': 'path_flat_rot_id'+str(missing_id)+'_'+str(i),
                 'style': "stroke:#0000ff;stroke-width:0.5;fill:none",
-                'd': paths_to_svgd([paths2d_flat_rot[i][:2]], 25.4/svg.dpi) })
-
-
-          ## 2) Sort the entries in paths3d_2 with cmp2D() "frontmost last"
-          # prepare a rotated version of the original two-D line set 'orig_2Dpath'
-          # so that cmp2D can sort towards negaive Y-Axis
-          plen = len(paths2d_flat_rot)
-          k = TSort(plen)
-          for i in range(plen):
-            for j in range(i+1, plen):
-              r = cmp2D(paths2d_flat_rot[i], paths2d_flat_rot[j])
-              if r is not None:
-                if r < 0: k.addPre(i, j)
-                if r > 0: k.addPre(j, i)
-          zsort_idx = k.sort()
+                'd': paths_to_svgd([[seg_rot[i][:2], seg_rot[i][2:]]], 25.4/svg.dpi) })
+
+
+          ## 2) Sort the side faces "frontmost last"
+          # the rotated version of the original two-D line set seg_rot
+          # lets the sweep sort towards negaive Y-Axis
+          plen = len(seg_rot)
+          succ = -np.ones(plen, dtype=int)    # the next face of the same subpath, or -1
+          for (f0, nf, closed) in side_rings:
+            succ[f0:f0+nf-1] = np.arange(f0+1, f0+nf)
+            if closed: succ[f0+nf-1] = f0
+
+          # With --side_strips, neighbour faces of a subpath are joined into strips. All faces of a strip
+          # face the same way (their segments in seg_rot run in the same x direction), without sharp bends.
+          # A strip is x-monotone, it projects into a simple polygon and sorts like a single face.
+          # Without --side_strips, each face is a strip of its own.
+          def find_strips():
+            """ Returns (strips, strip_of). strips lists the faces of each strip in subpath order,
+                strip_of maps a face to its strip.
+            """
+            dx = seg_rot[:,2] - seg_rot[:,0]
+            facing = np.where(dx > CMP_EPS, 1, np.where(dx < -CMP_EPS, -1, 0)).tolist()
+            # bend[i]: sharp angle between face i and the next face of its subpath.
+            nxt = np.where(succ >= 0, succ, np.arange(plen))
+            nn = np.linalg.norm(N, axis=1) * np.linalg.norm(N[nxt], axis=1)
+            bend = ((N * N[nxt]).sum(axis=1) < np.cos(np.radians(STRIP_BEND_DEG)) * nn).tolist()
+            strips = []
+            for (f0, nf, closed) in side_rings:
+              # faces seen edge-on (facing 0) join the strip before them.
+              eff = facing[f0:f0+nf]
+              last = 0
+              for k in list(range(nf)) * (2 if closed else 1):
+                if facing[f0+k]: last = facing[f0+k]
+                else: eff[k] = last
+              first = ([x for x in eff if x] + [0])[0]
+              eff = [x or first for x in eff]
+              cut = [k == 0 or eff[k] != eff[k-1] or bend[f0+k-1] for k in range(nf)]
+              if closed:
+                cut[0] = eff[0] != eff[-1] or bend[f0+nf-1]
+              starts = [k for k in range(nf) if cut[k]] or [0]
+              ring = list(range(f0, f0+nf))
+              if not cut[0]:
+                # the strip at the end of a closed subpath continues at its start.
+                ring = ring[starts[0]:] + ring[:starts[0]]
+                starts = [k - starts[0] for k in starts]
+              for j in range(len(starts)):
+                strips.append(ring[starts[j]:(starts[j+1] if j+1 < len(starts) else nf)])
+            strip_of = np.zeros(plen, dtype=int)
+            for j in range(len(strips)):
+              strip_of[strips[j]] = j
+            return (strips, strip_of)
+
+          if self.options.side_strips and plen:
+            (strips, strip_of) = find_strips()
+            print("side_strips: ", plen, "faces in", len(strips), "strips", file=self.tty)
+          else:
+            (strips, strip_of) = ([[i] for i in range(plen)], None)
+
+          # clusters that do not overlap in x are independent. Sort each on its own.
+          clusters = x_clusters(seg_arrays(seg_rot))
+          print("zsort: ", plen, "faces in", len(clusters), "clusters, largest", max([0]+[len(c) for c in clusters]), file=self.tty)
+          (zsort_idx, cycles) = zsort_clusters(seg_rot, clusters, engine=self.options.zsort.strip(" '\""),
+                                     block_size=self.options.zsort_block, tsort=TSortArray, workers=self.options.zsort_workers,
+                                     group=strip_of)
+          if cycles:
+            inkex.errormsg("Warning: %d cyclic dependencies in side walls broken. Local stacking may be off there." % cycles)
           if debugging_zsort:
             print("np.degrees(phi2D(R)): ", np.degrees(phi2D(R)), file=self.tty)
             for l in zsort_idx:
-              print("sorted(paths2d_flat_rot): ", l, file=self.tty)
-
-
-          ## 3) compare each enabled edge with all enabled edges following in the sorted list. In case of conicidence disable the edge that followed.
-          for i in range(plen):
-            for j in range(i+1, plen):
-              path1 = paths3d_2[zsort_idx[i]]
-              if j > len(zsort_idx):
-                print("len(zsort_idx):", len(zsort_idx), "j:", j, file=self.tty)
-              if zsort_idx[j] > len(paths3d_2):
-                print("len(paths3d_2):", len(paths3d_2), "zsort_idx[j]:", zsort_idx[j], "j:", j, file=self.tty)
-              path2 = paths3d_2[zsort_idx[j]]
-              if same_point3d(path1['edge_data'][0][0], path2['edge_data'][0][0]) or \
-                 same_point3d(path1['edge_data'][1][0], path2['edge_data'][0][0]):
-                path1['edge_visible'][0] = 0
-              if same_point3d(path1['edge_data'][0][0], path2['edge_data'][1][0]) or \
-                 same_point3d(path1['edge_data'][1][0], path2['edge_data'][1][0]):
-                path1['edge_visible'][1] = 0
+              print("sorted(seg_rot): ", l, file=self.tty)
+
+
+          ## 3) hide duplicate vertical edges. Most are shared by two neighbouring strips of a subpath.
+          # The strip sorted later draws it, the other strip does not. Between coplanar neighbours
+          # (parallel normals) there is no visible edge at all, and inside a strip neither.
+          # Edges of other subpaths or objects can coincide too. Of all edges at the same place,
+          # only the one of the strip sorted last is drawn. O(n), no pairwise point comparison.
+          nstrips = len(strips)
+          edge_owner = -np.ones(len(E), dtype=int)   # the strip drawing the edge, or -1
+          if plen:
+            sof = np.arange(plen) if strip_of is None else strip_of
+            zsort_pos = np.zeros(nstrips, dtype=int)
+            zsort_pos[zsort_idx] = np.arange(nstrips)
+            left = -np.ones(len(E), dtype=int)      # the face having the edge as its edge 1
+            right = -np.ones(len(E), dtype=int)     # the face having the edge as its edge 0
+            left[F[:,1]] = np.arange(plen)
+            right[F[:,0]] = np.arange(plen)
+            edge_owner = np.maximum(left, right)
+            edge_owner[edge_owner >= 0] = sof[edge_owner[edge_owner >= 0]]
+            S = np.nonzero((left >= 0) & (right >= 0))[0]
+            I, J = left[S], right[S]
+            nn = np.linalg.norm(N[I], axis=1) * np.linalg.norm(N[J], axis=1)
+            coplanar = (nn > 0) & (np.linalg.norm(np.cross(N[I], N[J]), axis=1) <= CMP_EPS * nn)
+            I, J = sof[I], sof[J]
+            edge_owner[S] = np.where(coplanar | (I == J), -1, np.where(zsort_pos[I] < zsort_pos[J], J, I))
+            (at, grp) = np.unique(np.round(V[E].reshape(-1, 6) / CMP_EPS), axis=0, return_inverse=True)
+            grp = grp.reshape(-1)
+            pos = np.where(edge_owner >= 0, zsort_pos[np.maximum(edge_owner, 0)], -1)
+            top = -np.ones(len(at), dtype=int)    # per place, the sort position of the strip sorted last
+            np.maximum.at(top, grp, pos)
+            edge_owner[pos < top[grp]] = -1
 
           if debugging_zsort:
             arrow_dir_deg = -15    # direction of the down arrow in degrees. 0 is south. -45 is south-east
@@ -883,24 +1303,93 @@ Option parser example:
               'style': "stroke:#0000ff;stroke-width:0.1;fill:none",
               'd': "m -2,40 2,10 2,-10 M 0,0 0,45" })
 
+          # Along a strip, the output coordinate u perpendicular to the projected depth is monotone.
+          # A linearGradient along u can carry the shading of each face of a strip.
+          dv = np.matmul([0, 0, depth], R)[:2]
+          u_dir = None
+          if self.options.strip_gradient and np.linalg.norm(dv) > CMP_EPS:
+            u_dir = np.array([-dv[1], dv[0]]) / np.linalg.norm(dv)
+
+          def strip_gradient(fl, fronts):
+            """ Add a linearGradient with a hard step for each face color of strip fl. Returns its url,
+                or None if the strip has no extent in u.
+            """
+            u = np.dot(V[fronts][:,:2], u_dir) * 25.4/svg.dpi
+            if abs(u[-1] - u[0]) < CMP_EPS:
+              return None
+            off = np.maximum.accumulate(np.clip((u - u[0]) / (u[-1] - u[0]), 0, 1))
+            stops = ''
+            k = 0
+            while k < len(fl):
+              # neighbour faces of the same color share their two stops.
+              m = k
+              while m+1 < len(fl) and side_color[fl[m+1]] == side_color[fl[k]]: m += 1
+              for o in (off[k], off[m+1]):
+                stops += '<stop offset="%.6f" style="stop-color:%s"/>' % (o, side_color[fl[k]])
+              k = m+1
+            gid = 'path_g_id'+str(missing_id)
+            add_elem(g2, 'linearGradient', { 'id': gid, 'gradientUnits': 'userSpaceOnUse',
+              'x1': '%.6f' % (u[0]*u_dir[0]), 'y1': '%.6f' % (u[0]*u_dir[1]),
+              'x2': '%.6f' % (u[-1]*u_dir[0]), 'y2': '%.6f' % (u[-1]*u_dir[1]) }, inner=stops)
+            return 'url(#'+gid+')'
+
+          ## 4) merge neighbour strips of a subpath that follow each other in zsort_idx.
+          # With the same flat style and a hidden edge between them, one path looks the same as two.
+          def flat_style(fl):
+            if len(set([side_color[f] for f in fl])) > 1: return None
+            return side_style[fl[0]]
+
+          runs = []     # (faces, strips) in drawing order
+          for r in zsort_idx:
+            fl = strips[r]
+            if runs and flat_style(fl) is not None and flat_style(fl) == flat_style(runs[-1][0]):
+              (rf, rs) = runs[-1]
+              if succ[rf[-1]] == fl[0] and edge_owner[F[fl[0]][0]] < 0 and np.dot(N[rf[-1]], N[fl[0]]) > 0:
+                runs[-1] = (rf + fl, rs + [r])
+                continue
+              if succ[fl[-1]] == rf[0] and edge_owner[F[rf[0]][0]] < 0 and np.dot(N[fl[-1]], N[rf[0]]) > 0:
+                runs[-1] = (fl + rf, [r] + rs)
+                continue
+            runs.append((list(fl), [r]))
+          if len(runs) < nstrips:
+            print("merge: ", nstrips, "strips in", len(runs), "paths", file=self.tty)
+
           ## add the sorted elements to the dom tree.
           sorted_idx = 0
-          for i in zsort_idx:
-            path = paths3d_2[i]
-            inkex.etree.SubElement(g2,   'path', { 'id': 'path_e_id'+str(missing_id),  'style': path['style'], 'd': paths_to_svgd([path['data']], 25.4/svg.dpi) })
+          for (fl, rs) in runs:
+            r = rs[0]
+            fronts = [E[F[f][0]][0] for f in fl] + [E[F[fl[-1]][1]][0]]
+            backs = [E[F[f][0]][1] for f in fl] + [E[F[fl[-1]][1]][1]]
+            data = V[[fronts[0]] + backs + fronts[::-1]]         # front, up the back, down the front.
+            quad = [V[E[F[fl[0]][0]]], V[E[F[fl[-1]][1]]]]     # the edges at both ends
+            style = side_style[fl[0]]
+            if len(fl) > 1 and len(set([side_color[f] for f in fl])) > 1:
+              # shaded strip: the middle face sets a flat color, or a gradient has all.
+              style = side_style[fl[len(fl)//2]]
+              fill = strip_gradient(fl, fronts) if u_dir is not None else None
+              if fill is not None:
+                t = shade_tmpl[side_shade[fl[0]]]
+                style = t[0] + fill + t[1]
+            add_elem(g2,   'path', { 'id': 'path_e_id'+str(missing_id),  'style': style, 'd': paths_to_svgd([data], 25.4/svg.dpi) })
             if debugging_zsort:
-              inkex.etree.SubElement(g2,   'text', { 'id': 'text_e_id'+str(missing_id),
+              add_elem(g2,   'text', { 'id': 'text_e_id'+str(missing_id),
                 'style': 'font-size:3px;fill:#0000ff',
-                'x': str(path_c4(path['data'], 0, 25.4/svg.dpi)),
-                'y': str(path_c4(path['data'], 1, 25.4/svg.dpi))
-                 }).text = str(sorted_idx) + '(' + str(path['orig_idx']) + ')'
-            if path['edge_visible'][0]:
-              inkex.etree.SubElement(g2, 'path', { 'id': 'path_e1_id'+str(missing_id), 'style': path['edge_style'], 'd': paths_to_svgd([path['edge_data'][0]], 25.4/svg.dpi) })
-            if path['edge_visible'][1]:
-              inkex.etree.SubElement(g2, 'path', { 'id': 'path_e2_id'+str(missing_id), 'style': path['edge_style'], 'd': paths_to_svgd([path['edge_data'][1]], 25.4/svg.dpi) })
+                'x': str(path_c4(data, 0, 25.4/svg.dpi)),
+                'y': str(path_c4(data, 1, 25.4/svg.dpi))
+                 }, str(sorted_idx) + '(' + str(r) + ')')
+            if edge_owner[F[fl[0]][0]] == rs[0]:
+              add_elem(g2, 'path', { 'id': 'path_e1_id'+str(missing_id), 'style': side_edge_style[F[fl[0]][0]], 'd': paths_to_svgd([quad[0]], 25.4/svg.dpi) })
+            if edge_owner[F[fl[-1]][1]] == rs[-1]:
+              add_elem(g2, 'path', { 'id': 'path_e2_id'+str(missing_id), 'style': side_edge_style[F[fl[-1]][1]], 'd': paths_to_svgd([quad[1]], 25.4/svg.dpi) })
             missing_id += 1
             sorted_idx += 1
 
+        if clip is not None:
+          print("clip: ", clip_count[0], "faces outside the clip region dropped", file=self.tty)
+
+        ## all generated faces and edges are parsed and appended per group, in the order queued above.
+        add_fragments()
+
 
 if __name__ == '__main__':
     e = FlatProjection()
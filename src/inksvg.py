@@ -36,6 +36,12 @@
 #                      Added traverse().
 # 2019-01-12 jw, v1.7e debug output to self.tty
 # 2019-01-15 jw, v1.7f tunnel transform as third item into paths tuple. needed for style stroke-width adjustment.
+#                v1.7g getNodeStyle() memoized per node, recursivelyTraverseSvg() carries the style down.
+#                v1.7h cssDictAdd() parses each rule once. getNodeStyleOne() caches per class combination,
+#                      tag.class selectors use the tag name without namespace, plain tag selectors work.
+#                v1.7i Added parseTransform() with a cache. recursivelyGetEnclosingTransform() memoized per ancestor.
+#                v1.7j Added getElementsById(), indexElement(): one id index for the document, also used with <use>.
+#                v1.7k getPathVertices() flattens elements referenced by <use> once, in their own coordinates.
 
 import gettext
 import re
@@ -219,7 +225,7 @@ class InkSvg():
     #    print(svg.paths)       # all coordinates in mm
 
     """
-    __version__ = "1.7f"
+    __version__ = "1.7k"
     DEFAULT_WIDTH = 100
     DEFAULT_HEIGHT = 100
 
@@ -243,8 +249,7 @@ class InkSvg():
         nodes = []
         for id in ids:
           if id != '':    # empty strings happen after splitting...
-            path = '//*[@id="%s"]' % id
-            el_list = self.document.xpath(path, namespaces=InkSvg.NSS)
+            el_list = self.getElementsById(id)
             if el_list:
               for node in el_list:
                 nodes.append(node)
@@ -253,6 +258,27 @@ class InkSvg():
         return nodes
 
 
+    def getElementsById(self, id):
+        """
+        Returns the list of all nodes with this id, in document order.
+        The index of all ids is built on first use. Add new nodes with indexElement().
+        """
+        if self.id_index is None:
+          self.id_index = {}
+          for node in self.document.getroot().iter(etree.Element):
+            self.indexElement(node)
+        return self.id_index.get(id, [])
+
+    def indexElement(self, node):
+        """
+        Add a node to the index of getElementsById(), e.g. after creating it.
+        """
+        if self.id_index is None: return        # built later, with node.
+        id = node.get('id')
+        if id:
+          self.id_index.setdefault(id, []).append(node)
+
+
     def load(self, filename):
         inkex.localize()
         # OO-Fail: cannot call inkex.Effect.parse(), Effect constructor has so many side-effects.
@@ -284,40 +310,59 @@ class InkSvg():
 
     def getNodeStyleOne(self, node):
         """
-        Finds style declarations by .class, #id or by tag.class syntax,
+        Finds style declarations by tag, .class, tag.class or #id syntax,
         and of course by a direct style='...' attribute.
+        The rules for each combination of tag and classes are merged once, then cached.
         # FIXME: stroke-width depends on the current transformation matrix scale.
         """
-        sheet = ''
-        selectors = []
+        tag = node.tag.split('}')[-1] if isinstance(node.tag, basestring) else ''
         classes = node.get('class', '')         # classes == None can happen here.
-        if classes is not None and classes != '':
-            selectors = ["."+cls for cls in re.split('[\s,]+', classes)]
-            selectors += [node.tag+sel for sel in selectors]
+        if classes is None: classes = ''
+        key = (tag, classes)
+        if key not in self.css_class_cache:
+            sheet = dict(self.css_dict.get(tag, {}))
+            if classes != '':
+                selectors = ["."+cls for cls in re.split('[\s,]+', classes)]
+                selectors += [tag+sel for sel in selectors]
+                for sel in selectors:
+                    sheet.update(self.css_dict.get(sel, {}))
+            self.css_class_cache[key] = sheet
+        sheet = dict(self.css_class_cache[key])
         node_id = node.get('id', '')
         if node_id is not None and node_id != '':
-            selectors += [ "#"+node_id ]
-        for sel in selectors:
-            if sel in self.css_dict:
-                sheet += '; '+self.css_dict[sel]
+            sheet.update(self.css_dict.get("#"+node_id, {}))
         style = node.get('style', '')
         if style is not None and style != '':
-            sheet += '; '+style
-        return simplestyle.parseStyle(sheet)
+            if style not in self.style_attr_cache:
+                self.style_attr_cache[style] = simplestyle.parseStyle(style)
+            sheet.update(self.style_attr_cache[style])
+        return sheet
 
     def getNodeStyle(self, node):
         """
         Recurse into parent group nodes, like simpletransform.ComposeParents
         Calling getNodeStyleOne() for each.
+        The result is memoized per node, callers must not modify it.
         """
-        combined_style = {}
+        if node in self.node_style:
+            return self.node_style[node]
+        parent_style = {}
         parent = node.getparent()
-        if parent.tag == inkex.addNS('g','svg') or parent.tag == 'g':
-            combined_style = self.getNodeStyle(parent)
+        if parent is not None and (parent.tag == inkex.addNS('g','svg') or parent.tag == 'g'):
+            parent_style = self.getNodeStyle(parent)
+        return self.getNodeStyleInherit(node, parent_style)
+
+    def getNodeStyleInherit(self, node, parent_style):
+        """
+        Combine parent_style, the style of the parent group as from getNodeStyle(), with the
+        style of node itself. The result is memoized for getNodeStyle().
+        """
+        combined_style = dict(parent_style)
         style = self.getNodeStyleOne(node)
         for s in style:
             # FIXME: stroke-width depends on the current transformation matrix scale.
             combined_style[s] = style[s]        # overwrite or add
+        self.node_style[node] = combined_style
         return combined_style
 
 
@@ -439,9 +484,12 @@ class InkSvg():
 
     def cssDictAdd(self, text):
         """
-        Represent css cdata as a hash in css_dict.
+        Represent css cdata as a hash in css_dict, from selector to a dict of declarations.
         Implements what is seen on: http://www.blooberry.com/indexdot/css/examples/cssembedded.htm
+        Styles memoized by getNodeStyle() and getNodeStyleOne() are dropped, new rules may apply to them.
         """
+        self.node_style = {}
+        self.css_class_cache = {}
         text=re.sub('^\s*(<!--)?\s*', '', text)
         while True:
             try:
@@ -455,11 +503,9 @@ class InkSvg():
             (val,text) = rest.split('}', 1)
             val = re.sub('/\*.*?\*/', '', val)      # replace comments nothing in values
             val = re.sub('\s+', ' ', val).strip()   # normalize whitespace
+            decl = simplestyle.parseStyle(val)      # parsed once per rule
             for k in keys:
-                if not k in self.css_dict:
-                    self.css_dict[k] = val
-                else:
-                    self.css_dict[k] += '; '+val
+                self.css_dict.setdefault(k, {}).update(decl)
 
 
     def roundedRectBezier(self, x, y, w, h, rx, ry=0):
@@ -587,6 +633,11 @@ class InkSvg():
 
         # cssDictAdd collects style definitions here:
         self.css_dict = {}
+        self.css_class_cache = {}       # getNodeStyleOne(): (tag, classes) -> merged rules
+        self.style_attr_cache = {}      # getNodeStyleOne(): style attribute -> parsed dict
+
+        # getNodeStyle() memoizes the combined style of each node here:
+        self.node_style = {}
 
         # For handling an SVG viewbox attribute, we will need to know the
         # values of the document's <svg> width and height attributes as well
@@ -596,6 +647,19 @@ class InkSvg():
         self.docHeight = float(self.DEFAULT_HEIGHT)
         self.docTransform = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]
 
+        # parseTransform() caches parsed transform attributes here, by their text.
+        # recursivelyGetEnclosingTransform() memoizes the transform each ancestor passes on to its children.
+        self.transform_cache = {}
+        self.enclosing_transform = {}
+
+        # getElementsById() indexes the document here, from id to a list of nodes.
+        self.id_index = None
+
+        # getPathVertices() keeps the flattened subpaths of nodes referenced by <use> here, untransformed.
+        # Keyed by (node, path d, smoothness in node coordinates). use_depth > 0 while inside a <use>.
+        self.instance_cache = {}
+        self.use_depth = 0
+
         # Dictionary of warnings issued.  This to prevent from warning
         # multiple times about the same problem
         self.warnings = {}
@@ -728,6 +792,7 @@ class InkSvg():
                     sx = self.docWidth  / float(vinfo[2])
                     sy = self.docHeight / float(vinfo[3])
                     self.docTransform = simpletransform.parseTransform('scale(%f,%f)' % (sx, sy))
+                    self.enclosing_transform = {}
 
     def getPathVertices(self, path, node=None, transform=None, smoothness=None):
 
@@ -750,29 +815,54 @@ class InkSvg():
             # Nothing to do
             return None
 
-        if node is not None:
-            path = self.styleDasharray(path, node)
-
-        # parsePath() may raise an exception.  This is okay
-        sp = simplepath.parsePath(path)
-        if (not sp) or (len(sp) == 0):
-            # Path must have been devoid of any real content
-            return None
-
-        # Get a cubic super path
-        p = cubicsuperpath.CubicSuperPath(sp)
-        if (not p) or (len(p) == 0):
-            # Probably never happens, but...
-            return None
-
-        if transform:
-            simpletransform.applyTransformToPath(transform, p)
-
-        # Now traverse the cubic super path
+        # Clones of the same node at the same scale share one flattening, done in node coordinates.
+        # Each clone then only applies its transform. The smoothness is divided by the largest
+        # stretch of the transform (its largest singular value), so that it holds in all directions.
+        instance = None
+        if self.use_depth and node is not None and transform:
+            (a, b, c, d) = (transform[0][0], transform[1][0], transform[0][1], transform[1][1])
+            q = a*a + b*b - c*c - d*d
+            scale = (0.5 * (a*a + b*b + c*c + d*d + (q*q + 4*(a*c + b*d)**2) ** 0.5)) ** 0.5
+            if scale > 0:
+                instance = (node, path, '%.6g' % (float(smoothness) / scale))
+
+        if instance is not None and instance in self.instance_cache:
+            vertex_lists = self.instance_cache[instance]
+        else:
+            if node is not None:
+                path = self.styleDasharray(path, node)
+
+            # parsePath() may raise an exception.  This is okay
+            sp = simplepath.parsePath(path)
+            if (not sp) or (len(sp) == 0):
+                # Path must have been devoid of any real content
+                return None
+
+            # Get a cubic super path
+            p = cubicsuperpath.CubicSuperPath(sp)
+            if (not p) or (len(p) == 0):
+                # Probably never happens, but...
+                return None
+
+            if transform and instance is None:
+                simpletransform.applyTransformToPath(transform, p)
+
+            vertex_lists = []
+            for sp in p:
+                self.subdivideCubicPath(sp, float(instance[2] if instance else smoothness))
+                vertex_lists.append([csp[1] for csp in sp])
+            if instance is not None:
+                self.instance_cache[instance] = vertex_lists
+
+        if instance is not None:
+            ((a, c, e), (b, d, f)) = transform
+            vertex_lists = [[[a*x + c*y + e, b*x + d*y + f] for (x, y) in v] for v in vertex_lists]
+
+        # Now traverse the flattened subpaths
         subpath_list = []
         subpath_vertices = []
 
-        for sp in p:
+        for vertices in vertex_lists:
 
             # We've started a new subpath
             # See if there is a prior subpath and whether we should keep it
@@ -780,23 +870,19 @@ class InkSvg():
                 subpath_list.append([subpath_vertices, [sp_xmin, sp_xmax, sp_ymin, sp_ymax]])
 
             subpath_vertices = []
-            self.subdivideCubicPath(sp, float(smoothness))
 
             # Note the first point of the subpath
-            first_point = sp[0][1]
+            first_point = vertices[0]
             subpath_vertices.append(first_point)
             sp_xmin = first_point[0]
             sp_xmax = first_point[0]
             sp_ymin = first_point[1]
             sp_ymax = first_point[1]
 
-            n = len(sp)
-
             # Traverse each point of the subpath
-            for csp in sp[1:n]:
+            for pt in vertices[1:]:
 
                 # Append the vertex to our list of vertices
-                pt = csp[1]
                 subpath_vertices.append(pt)
 
                 # Track the bounding box of this subpath
@@ -830,7 +916,7 @@ class InkSvg():
 
 
     def recursivelyTraverseSvg(self, aNodeList, matCurrent=[[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]],
-                               parent_visibility='visible'):
+                               parent_visibility='visible', parent_style=None):
 
         '''
         [ This too is largely lifted from eggbot.py ]
@@ -851,6 +937,9 @@ class InkSvg():
             processing directives
 
         All other SVG elements trigger an error (including <text>)
+
+        parent_style is the style of the group aNodeList, as from getNodeStyle().
+        Each node then only adds its own style, instead of walking up all its parents.
         '''
 
         for node in aNodeList:
@@ -863,23 +952,30 @@ class InkSvg():
                 continue
 
             # FIXME: should we inherit styles from parents?
-            s = self.getNodeStyle(node)
+            if parent_style is not None and node not in self.node_style and \
+               self.node_style.get(node.getparent()) is parent_style:
+                s = self.getNodeStyleInherit(node, parent_style)
+            else:
+                s = self.getNodeStyle(node)     # also, when a style element invalidated parent_style.
             if s.get('display', '') == 'none': continue
 
             # First apply the current matrix transform to this node's tranform
-            matNew = simpletransform.composeTransform(
-                matCurrent, simpletransform.parseTransform(node.get("transform")))
+            transform = node.get("transform")
+            if transform:
+                matNew = simpletransform.composeTransform(matCurrent, self.parseTransform(transform))
+            else:
+                matNew = matCurrent
 
             if node.tag == inkex.addNS('g', 'svg') or node.tag == 'g':
 
-                self.recursivelyTraverseSvg(node, matNew, visibility)
+                self.recursivelyTraverseSvg(node, matNew, visibility, s)
 
             elif node.tag == inkex.addNS('use', 'svg') or node.tag == 'use':
 
                 # A <use> element refers to another SVG element via an
                 # xlink:href="#blah" attribute.  We will handle the element by
-                # doing an XPath search through the document, looking for the
-                # element with the matching id="blah" attribute.  We then
+                # looking up the element with the matching id="blah" attribute
+                # in the id index of the document.  We then
                 # recursively process that element after applying any necessary
                 # (x,y) translation.
                 #
@@ -896,18 +992,21 @@ class InkSvg():
                     continue
 
                 # [1:] to ignore leading '#' in reference
-                path = '//*[@id="%s"]' % refid[1:]
-                refnode = node.xpath(path)
+                refnode = self.getElementsById(refid[1:])
                 if refnode:
                     x = float(node.get('x', '0'))
                     y = float(node.get('y', '0'))
                     # Note: the transform has already been applied
                     if (x != 0) or (y != 0):
-                        matNew2 = simpletransform.composeTransform(matNew, simpletransform.parseTransform('translate(%f,%f)' % (x, y)))
+                        matNew2 = simpletransform.composeTransform(matNew, [[1.0, 0.0, x], [0.0, 1.0, y]])
                     else:
                         matNew2 = matNew
                     visibility = node.get('visibility', visibility)
-                    self.recursivelyTraverseSvg(refnode, matNew2, visibility)
+                    self.use_depth += 1
+                    try:
+                        self.recursivelyTraverseSvg(refnode, matNew2, visibility)
+                    finally:
+                        self.use_depth -= 1
 
             elif node.tag == inkex.addNS('path', 'svg'):
 
@@ -1110,24 +1209,37 @@ class InkSvg():
                 inkex.errormsg('Warning: unable to draw object <%s>, please convert it to a path first.' % node.tag)
                 pass
 
+    def parseTransform(self, transform):
+
+        '''
+        simpletransform.parseTransform() with a cache by the attribute text.
+        The returned matrix is shared, callers must not modify it.
+        '''
+        if transform not in self.transform_cache:
+            self.transform_cache[transform] = simpletransform.parseTransform(transform)
+        return self.transform_cache[transform]
+
     def recursivelyGetEnclosingTransform(self, node):
 
         '''
         Determine the cumulative transform which node inherits from
         its chain of ancestors.
+        The transform each ancestor passes on is memoized, so that nodes
+        sharing ancestors only walk up to the first one seen before.
         '''
+        chain = []
         node = node.getparent()
-        if node is not None:
-            parent_transform = self.recursivelyGetEnclosingTransform(node)
-            node_transform = node.get('transform', None)
-            if node_transform is None:
-                return parent_transform
-            else:
-                tr = simpletransform.parseTransform(node_transform)
-                if parent_transform is None:
-                    return tr
-                else:
-                    return simpletransform.composeTransform(parent_transform, tr)
+        while node is not None and node not in self.enclosing_transform:
+            chain.append(node)
+            node = node.getparent()
+        if node is None:
+            mat = self.docTransform
         else:
-            return self.docTransform
+            mat = self.enclosing_transform[node]
+        for node in reversed(chain):
+            node_transform = node.get('transform', None)
+            if node_transform is not None:
+                mat = simpletransform.composeTransform(mat, self.parseTransform(node_transform))
+            self.enclosing_transform[node] = mat
+        return mat
 
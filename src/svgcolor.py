@@ -4,6 +4,7 @@
 
 from __future__ import print_function
 import simplestyle
+import numpy as np
 
 class SvgColor:
     """ Manipulate color strings for svg style attributes """
@@ -93,6 +94,22 @@ class SvgColor:
         self._rgb = self._hsl_to_rgb(hsl)
         return self._rgb
 
+    def adjusted_light(self, adjust):
+        """ adjust_light() for an array of adjust values. Returns a list of color strings, self is unchanged. """
+        (h, s, l) = self._rgb_to_hsl(self._rgb)
+        l = l + np.asarray(adjust, dtype=float)
+        if s == 0:
+            rgb = [l, l, l]
+        else:
+            v2 = np.where(l < 0.5, l * (1 + s), l + s - l*s)
+            v1 = 2*l - v2
+            rgb = [self._hue_2_rgb(v1, v2, h*6 + 2.0), self._hue_2_rgb(v1, v2, h*6), self._hue_2_rgb(v1, v2, h*6 - 2.0)]
+        rgb = np.floor(np.clip(np.transpose(rgb), 0, 255) + .5).astype(int)
+        # few distinct colors: format each only once.
+        (code, inv) = np.unique(rgb[:,0]*65536 + rgb[:,1]*256 + rgb[:,2], return_inverse=True)
+        names = ["#%06x" % c for c in code.tolist()]
+        return [names[i] for i in inv.ravel().tolist()]
+
     def __repr__(self):
         rgb = self._clamp_rgb(self._rgb)
         return "#%02x%02x%02x" % (int(rgb[0]+.5), int(rgb[1]+.5), int(rgb[2]+.5))
@@ -109,5 +126,6 @@ if __name__ == '__main__':
     rgb=(8*i+i, 16*i+i, 16*i+i)
     c = SvgColor(rgb)
     print('color: ', c, c.rgb(), c.hsl())
+    print('                       l-20, l+20 -> ', c.adjusted_light([-20, +20]))
     c.adjust_light(+20)
     print('                       l+20 -> ', c, c.rgb())
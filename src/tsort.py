@@ -3,6 +3,8 @@
 
 from __future__ import print_function
 from collections import defaultdict     # minimum python 2.5
+import heapq
+import numpy as np
 
 class TSort:
     """
@@ -17,6 +19,11 @@ class TSort:
     def addPre(self, u, v):
         self.graph[u].append(v)
 
+    def addEdges(self, u, v):
+        """ addPre(u[i], v[i]) for all i """
+        for (i, j) in zip(list(u), list(v)):
+            self.graph[int(i)].append(int(j))
+
     def sort(self):
         # Create a vector to store indegrees of all vertices.
         # Initialize all indegrees as 0.
@@ -63,6 +70,166 @@ class TSort:
             raise Exception("cyclic dependency")
         return top_order
 
+class TSortArray:
+    """
+    Kahn's Algorithm for topological ordering, array backed.
+
+    Same interface as TSort, but edges are collected in bulk, e.g. as numpy arrays
+    from zsort2d.batch_edges(), and turned into a CSR adjacency (indptr, indices)
+    only once, when sort() is called. A heap keyed on the vertex index replaces the
+    O(V) queue.pop(0) of TSort. Vertices that are not ordered by any edge come out
+    in index order, so the result is deterministic and stable: the smallest possible
+    topological order in lexicographic sense.
+
+    With break_cycles=True, a cyclic dependency does not abort the sort. The strongly
+    connected components of the vertices left over by Kahn's algorithm are found with
+    Tarjan's algorithm. Inside each component, the vertices fall back to the order
+    given by key, e.g. their average depth (key defaults to the vertex index; ties are
+    broken by index), and the sort is repeated. Self-loops are dropped. Edges between
+    components are kept, so the result only differs locally. The number of cycles
+    resolved is left in cycles_broken, the number of edges that had to be reversed or
+    dropped in edges_dropped.
+    """
+
+    def __init__(self, vertices, break_cycles=False, key=None):
+        self.V = vertices               # No. of vertices
+        self.break_cycles = break_cycles
+        self.key = key                  # fallback order inside cycles, e.g. average depth
+        self.cycles_broken = 0
+        self.edges_dropped = 0
+        self._u = []                    # list of edge source arrays
+        self._v = []                    # list of edge destination arrays
+        self._pre = []                  # single edges from addPre()
+
+    def addPre(self, u, v):
+        self._pre.append((u, v))
+
+    def addEdges(self, u, v):
+        """ addPre(u[i], v[i]) for all i, without a python call per edge """
+        self._u.append(np.asarray(u, dtype=np.intp).ravel())
+        self._v.append(np.asarray(v, dtype=np.intp).ravel())
+
+    def _edges(self):
+        """ Returns (u, v) arrays of all edges added so far """
+        u = self._u[:]
+        v = self._v[:]
+        if self._pre:
+            pre = np.array(self._pre, dtype=np.intp).reshape(-1, 2)
+            u.append(pre[:,0])
+            v.append(pre[:,1])
+        if not u:
+            return (np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp))
+        return (np.concatenate(u), np.concatenate(v))
+
+    def _csr(self, u, v):
+        """ Returns (indptr, indices) as python lists. Edges of vertex i are indices[indptr[i]:indptr[i+1]] """
+        order = np.argsort(u, kind='mergesort')
+        indptr = np.zeros(self.V+1, dtype=np.intp)
+        np.cumsum(np.bincount(u, minlength=self.V), out=indptr[1:])
+        return (indptr.tolist(), v[order].tolist())
+
+    def _kahn(self, indptr, indices, in_degree):
+        # all vertices with indegree 0. A sorted list already is a heap.
+        heap = [i for i in range(self.V) if in_degree[i] == 0]
+        top_order = []
+        while heap:
+            u = heapq.heappop(heap)
+            top_order.append(u)
+            for i in indices[indptr[u]:indptr[u+1]]:
+                in_degree[i] -= 1
+                if in_degree[i] == 0:
+                    heapq.heappush(heap, i)
+        return top_order
+
+    def _scc(self, alive, indptr, indices):
+        """
+        Tarjan's algorithm, iterative, restricted to vertices with alive[i] True.
+        Returns a list of components with more than one vertex.
+        """
+        index = [-1]*self.V
+        low = [0]*self.V
+        onstack = [False]*self.V
+        stack = []
+        comps = []
+        counter = 0
+        for root in range(self.V):
+            if not alive[root] or index[root] >= 0:
+                continue
+            index[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            onstack[root] = True
+            work = [[root, indptr[root]]]
+            while work:
+                (v, p) = work[-1]
+                if p < indptr[v+1]:
+                    work[-1][1] = p+1
+                    w = indices[p]
+                    if not alive[w]:
+                        continue
+                    if index[w] < 0:
+                        index[w] = low[w] = counter
+                        counter += 1
+                        stack.append(w)
+                        onstack[w] = True
+                        work.append([w, indptr[w]])
+                    elif onstack[w]:
+                        low[v] = min(low[v], index[w])
+                else:
+                    work.pop()
+                    if work:
+                        u = work[-1][0]
+                        low[u] = min(low[u], low[v])
+                    if low[v] == index[v]:
+                        comp = []
+                        while True:
+                            w = stack.pop()
+                            onstack[w] = False
+                            comp.append(w)
+                            if w == v: break
+                        if len(comp) > 1:
+                            comps.append(comp)
+        return comps
+
+    def sort(self):
+        (u, v) = self._edges()
+        (indptr, indices) = self._csr(u, v)
+        in_degree = np.bincount(v, minlength=self.V).tolist()
+        top_order = self._kahn(indptr, indices, in_degree[:])
+
+        # Check if there was a cycle
+        if len(top_order) != self.V:
+            if not self.break_cycles:
+                raise Exception("cyclic dependency")
+            alive = [True]*self.V
+            for i in top_order:
+                alive[i] = False
+            comp_id = np.full(self.V, -1, dtype=np.intp)
+            comps = self._scc(alive, indptr, indices)
+            for c in range(len(comps)):
+                comp_id[comps[c]] = c
+            # rank all vertices by the fallback order.
+            key = np.arange(self.V) if self.key is None else np.asarray(self.key)
+            rank = np.empty(self.V, dtype=np.intp)
+            rank[np.lexsort((np.arange(self.V), key))] = np.arange(self.V)
+            loop = (u == v)
+            inside = (comp_id[u] >= 0) & (comp_id[u] == comp_id[v])
+            self.cycles_broken = len(comps) + len(set(u[loop & (comp_id[u] < 0)].tolist()))
+            self.edges_dropped = int(np.count_nonzero((inside & (rank[u] > rank[v])) | loop))
+            # replace the edges inside each component with a chain in fallback order.
+            chain_u = []
+            chain_v = []
+            for c in comps:
+                c = sorted(c, key=lambda i: rank[i])
+                chain_u += c[:-1]
+                chain_v += c[1:]
+            keep = ~(inside | loop)
+            u = np.concatenate((u[keep], np.array(chain_u, dtype=np.intp)))
+            v = np.concatenate((v[keep], np.array(chain_v, dtype=np.intp)))
+            (indptr, indices) = self._csr(u, v)
+            top_order = self._kahn(indptr, indices, np.bincount(v, minlength=self.V).tolist())
+        return top_order
+
 if __name__ == '__main__':
   k = TSort(6)
   k.addPre(5, 2)
@@ -75,3 +242,10 @@ if __name__ == '__main__':
   sorted_list = k.sort()
   print("The next two lines should match:\n[4, 5, 2, 0, 3, 1]")
   print(sorted_list)
+
+  k = TSortArray(6)
+  k.addEdges([5, 5, 4, 4], [2, 0, 0, 1])
+  k.addPre(2, 3)
+  k.addPre(3, 1)
+  print("The next two lines should match:\n[4, 5, 0, 2, 3, 1]")
+  print(k.sort())
@@ -0,0 +1,500 @@
+#! /usr/bin/python3
+#
+# zsort2d.py -- depth ordering of the side walls, reduced to line segments in 2D.
+#
+# Distribute under GPLv2 or ask.
+#
+# All side walls span between two parallel planes. Seen along the eye vector, each
+# quad-face collapses to a two-point line in 2D. After rotating that 2D plane so that the
+# eye vector points exactly downwards, a segment with a smaller y coordinate at a common x
+# sorts in front of (is drawn before) a segment with a larger y coordinate.
+#
+# Each segment is a list [p0, p1, ...] where p0 and p1 are xy points. Additional
+# list members are ignored. Segments are referenced by their index in the segment list.
+
+from __future__ import print_function
+import numpy as np
+import multiprocessing
+import random
+try:
+  from multiprocessing import shared_memory     # python >= 3.8
+except ImportError:
+  shared_memory = None
+
+ZSORT_EPS = 0.000001
+
+
+def y_at_x(gp, gv, x):
+  dx = x-gp[0]
+  if abs(gv[0]) < ZSORT_EPS:
+    return None
+  s = dx/gv[0]
+  if s < 0.0 or s > 1.0:
+    return None
+  return gp[1]+s*gv[1]
+
+
+def cmp2D(g1, g2):
+  """
+  returns -1 if g1 sorts in front of g2
+  returns 1  if g1 sorts in behind g2
+  returns None  if there was no clear decision
+  """
+  # convert g1 into point and vector:
+  g1p = g1[0]
+  g1v = (g1[1][0] - g1[0][0], g1[1][1] - g1[0][1])
+  #
+  y = y_at_x(g1p, g1v, g2[0][0])
+  if y is not None:
+    if y < g2[0][1]-ZSORT_EPS: return -1
+    if y > g2[0][1]+ZSORT_EPS: return 1
+  #
+  y = y_at_x(g1p, g1v, g2[1][0])
+  if y is not None:
+    if y < g2[1][1]-ZSORT_EPS: return -1
+    if y > g2[1][1]+ZSORT_EPS: return 1
+  #
+  g2p = g2[0]
+  g2v = (g2[1][0] - g2[0][0], g2[1][1] - g2[0][1])
+  y = y_at_x(g2p, g2v, g1[0][0])
+  if y is not None:
+    if g1[0][1]+ZSORT_EPS < y: return -1
+    if g1[0][1]-ZSORT_EPS > y: return 1
+  #
+  y = y_at_x(g2p, g2v, g1[1][0])
+  if y is not None:
+    if g1[1][1]+ZSORT_EPS < y: return -1
+    if g1[1][1]-ZSORT_EPS > y: return 1
+  #
+  return None   # non-comparable pair in the poset. sorted() would take that as less than aka -1
+
+
+def sweep_edges(segs):
+  """
+  Sweep-line ordering engine. Returns a list of (i, j) index pairs, meaning segs[i]
+  sorts in front of segs[j]. The pairs are meant to be fed into TSort.addPre().
+
+  The segments are walked by x. An active list holds all segments spanning the current
+  x, ordered by their y coordinate there. Only segments that become vertically adjacent
+  in the active list are compared. All other relations follow by transitivity, as
+  the side walls of flat objects do not cross each other. This produces O(n) edges in
+  O(n log n) comparisons, instead of the O(n^2) calls of cmp2D() for all pairs.
+  The active list is a skip list, so that each insert and removal costs O(log n).
+
+  Vertical segments (faces seen edge-on) are not inserted into the active list.
+  They are only related to their neighbours below and above, after all segments
+  starting at their x are inserted and before those ending there are removed.
+  Two vertical segments are never compared, same as with cmp2D().
+  Event x coordinates closer than ZSORT_EPS count as the same x, so that segments
+  touching at an end point, or a vertical segment slightly off, still meet.
+  """
+  n = len(segs)
+  xl = [0.0]*n          # left end point
+  yl = [0.0]*n
+  xr = [0.0]*n          # right end point
+  yr = [0.0]*n
+  slope = [0.0]*n
+  events = []
+  for i in range(n):
+    (ax, ay) = (float(segs[i][0][0]), float(segs[i][0][1]))
+    (bx, by) = (float(segs[i][1][0]), float(segs[i][1][1]))
+    if bx < ax:
+      (ax, ay, bx, by) = (bx, by, ax, ay)
+    (xl[i], yl[i], xr[i], yr[i]) = (ax, ay, bx, by)
+    if bx - ax < ZSORT_EPS:
+      slope[i] = None
+      if abs(by - ay) > 2*ZSORT_EPS:
+        events.append((ax, 1, i))   # vertical: after insertions, before removals
+    else:
+      slope[i] = (by - ay) / (bx - ax)
+      events.append((ax, 0, i))     # insert
+      events.append((bx, 2, i))     # remove
+  # snap event x to the first x of its group. A group spans at most ZSORT_EPS.
+  events.sort()
+  x0 = None
+  for k in range(len(events)):
+    if x0 is None or events[k][0] > x0 + ZSORT_EPS:
+      x0 = events[k][0]
+    events[k] = (x0, events[k][1], events[k][2])
+  events.sort()
+
+  def y_of(i, x):
+    if x <= xl[i]: return yl[i]
+    if x >= xr[i]: return yr[i]
+    return yl[i] + (x - xl[i]) * slope[i]
+
+  def above(t, x, y, s):
+    """ True if active segment t is above point (x, y) going in direction s """
+    d = y_of(t, x) - y
+    return d > ZSORT_EPS or (d >= -ZSORT_EPS and s is not None and slope[t] > s)
+
+  # skip list. Node n is the head, NIL ends a level. nxt[i][l], prv[i][l] link node i on level l.
+  NIL = -1
+  MAXL = 32
+  nxt = [None]*(n+1)
+  prv = [None]*(n+1)
+  nxt[n] = [NIL]*MAXL
+  level = [1]             # levels in use
+  rand = random.Random(0x5eed)   # node heights, reproducible
+
+  def find(x, y, s):
+    """ The last node per level that is not above point (x, y) going in direction s """
+    update = [n]*MAXL
+    t = n
+    for l in range(level[0]-1, -1, -1):
+      while nxt[t][l] != NIL and not above(nxt[t][l], x, y, s):
+        t = nxt[t][l]
+      update[l] = t
+    return update
+
+  edges = []
+  for (x, kind, i) in events:
+    if kind == 2:
+      (lo, hi) = (prv[i][0], nxt[i][0])
+      if lo != n and hi != NIL:
+        edges.append((lo, hi))
+      for l in range(len(nxt[i])):
+        nxt[prv[i][l]][l] = nxt[i][l]
+        if nxt[i][l] != NIL:
+          prv[nxt[i][l]][l] = prv[i][l]
+    elif kind == 0:
+      update = find(x, yl[i], slope[i])
+      h = 1
+      while h < MAXL and rand.random() < 0.5:
+        h += 1
+      level[0] = max(level[0], h)
+      if update[0] != n:
+        edges.append((update[0], i))
+      if nxt[update[0]][0] != NIL:
+        edges.append((i, nxt[update[0]][0]))
+      nxt[i] = [NIL]*h
+      prv[i] = [n]*h
+      for l in range(h):
+        t = update[l]
+        (nxt[i][l], prv[i][l]) = (nxt[t][l], t)
+        if nxt[t][l] != NIL:
+          prv[nxt[t][l]][l] = i
+        nxt[t][l] = i
+    else:
+      (ylo, yhi) = (min(yl[i], yr[i]), max(yl[i], yr[i]))
+      t = find(x, ylo, None)[0]
+      if t != n:
+        edges.append((t, i))
+      t = nxt[find(x, yhi - 2*ZSORT_EPS, None)[0]][0]
+      if t != NIL:
+        edges.append((i, t))
+  return edges
+
+
+def seg_rows(segs):
+  """ Pack the end points of segs into an (n, 4) array of rows x0, y0, x1, y1. """
+  a = np.zeros((len(segs), 4))
+  for i in range(len(segs)):
+    a[i] = (segs[i][0][0], segs[i][0][1], segs[i][1][0], segs[i][1][1])
+  return a
+
+
+def seg_arrays(segs):
+  """
+  Precompute per-segment arrays for cmp2D_batch(), once for all segs.
+  segs can also be given as seg_rows().
+  Returns a dict of numpy arrays, indexed by segment index:
+  x0, y0, x1, y1: the end points as given,
+  xmin, xmax: the x-range,
+  dx, dy: the direction vector. y_at_x() interpolates along it, and so do we,
+  so that batch results agree exactly with cmp2D(), also at the end points.
+  vert: True for vertical segments, where y_at_x() has no answer.
+  """
+  a = segs if isinstance(segs, np.ndarray) else seg_rows(segs)
+  (x0, y0, x1, y1) = (a[:,0], a[:,1], a[:,2], a[:,3])
+  dx = x1 - x0
+  vert = np.abs(dx) < ZSORT_EPS
+  return { 'x0': x0, 'y0': y0, 'x1': x1, 'y1': y1,
+           'xmin': np.minimum(x0, x1), 'xmax': np.maximum(x0, x1),
+           'dx': np.where(vert, 1.0, dx), 'dy': y1 - y0, 'vert': vert }
+
+
+def cmp2D_batch(arrs, I, J):
+  """
+  Vectorized cmp2D() for the candidate pairs (I[k], J[k]). arrs is from seg_arrays().
+  Returns an int8 array r, where r[k] is the cmp2D(segs[I[k]], segs[J[k]]) result.
+  None is represented as 0.
+  The four end point tests of cmp2D() are applied in the same order. The first decisive
+  test wins.
+  """
+  I = np.asarray(I, dtype=np.intp)
+  J = np.asarray(J, dtype=np.intp)
+  r = np.zeros(len(I), dtype=np.int8)
+  open_ = np.ones(len(I), dtype=bool)
+
+  def test(g, px, py, sign):
+    # y_at_x() of line g at px, compared with py. sign=1 for g=I, sign=-1 for g=J.
+    s = (px - arrs['x0'][g]) / arrs['dx'][g]
+    ok = open_ & ~arrs['vert'][g] & (s >= 0.0) & (s <= 1.0)
+    d = sign * (arrs['y0'][g] + s * arrs['dy'][g] - py)
+    lt = ok & (d < -ZSORT_EPS)
+    gt = ok & (d > ZSORT_EPS)
+    r[lt] = -1
+    r[gt] = 1
+    open_[lt | gt] = False
+
+  test(I, arrs['x0'][J], arrs['y0'][J],  1)
+  test(I, arrs['x1'][J], arrs['y1'][J],  1)
+  test(J, arrs['x0'][I], arrs['y0'][I], -1)
+  test(J, arrs['x1'][I], arrs['y1'][I], -1)
+  return r
+
+
+def _run_blocks(first, lens, block_size):
+  """
+  Row p stands for the run of partners first[p] .. first[p]+lens[p]-1.
+  Generate (P, Q) arrays of all row/partner combinations, cut between rows
+  into blocks of about block_size pairs. A single long row is never split.
+  """
+  block_size = max(1, int(block_size))
+  cum = np.cumsum(lens)
+  n = len(lens)
+  p = 0
+  done = 0
+  while p < n:
+    p1 = max(p+1, int(np.searchsorted(cum, done + block_size, side='right')))
+    rows = np.arange(p, p1, dtype=np.intp)
+    l = lens[p:p1]
+    cnt = int(cum[p1-1]) - done
+    if cnt > 0:
+      P = np.repeat(rows, l)
+      Q = np.arange(cnt, dtype=np.intp) - np.repeat(np.cumsum(l) - l, l) + np.repeat(first[p:p1], l)
+      yield (P, Q)
+    done += cnt
+    p = p1
+
+
+def pair_blocks(n, block_size=100000):
+  """
+  Generate all pairs i < j of n segments as (I, J) index arrays,
+  in blocks of about block_size pairs. Peak memory is bounded by the block size,
+  not by n^2.
+  """
+  rows = np.arange(n, dtype=np.intp)
+  return _run_blocks(rows+1, n-rows-1, block_size)
+
+
+def overlap_pairs(arrs, block_size=100000):
+  """
+  Generate only those pairs i < j of segments whose x-ranges overlap, as (I, J) index
+  arrays in blocks of about block_size pairs. arrs is from seg_arrays().
+  All other pairs are non-comparable for cmp2D(), as y_at_x() returns None for them.
+
+  Sort and sweep: with segments sorted by xmin, the partners of a segment are all
+  following segments up to the first one that starts right of its xmax.
+  """
+  n = len(arrs['xmin'])
+  order = np.argsort(arrs['xmin'], kind='mergesort')
+  xs = arrs['xmin'][order]
+  first = np.arange(1, n+1, dtype=np.intp)
+  hi = np.searchsorted(xs, arrs['xmax'][order] + ZSORT_EPS, side='right')
+  for (P, Q) in _run_blocks(first, hi - first, block_size):
+    (I, J) = (order[P], order[Q])
+    yield (np.minimum(I, J), np.maximum(I, J))
+
+
+def batch_edges(arrs, blocks):
+  """
+  Decide all (I, J) candidate blocks with cmp2D_batch().
+  Returns two index arrays (u, v). Each u[k] sorts in front of v[k], ready for TSort.addPre().
+  Undecided pairs are dropped.
+  """
+  us = []
+  vs = []
+  for (I, J) in blocks:
+    r = cmp2D_batch(arrs, I, J)
+    lt = r < 0
+    gt = r > 0
+    us.append(I[lt])
+    vs.append(J[lt])
+    us.append(J[gt])
+    vs.append(I[gt])
+  if not us:
+    return (np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp))
+  return (np.concatenate(us), np.concatenate(vs))
+
+
+def x_clusters(arrs):
+  """
+  Split the segments into independent clusters. arrs is from seg_arrays().
+  Two segments are in the same cluster, if their x-ranges overlap, directly
+  or through a chain of other segments. Segments of different clusters are
+  never comparable, so each cluster can be sorted on its own, and the results
+  concatenated. This bounds the cost by the largest cluster, not by the whole document.
+
+  Returns a list of index arrays, ordered by x. Indices within a cluster are ascending,
+  so that document order is preserved where nothing else decides.
+  """
+  n = len(arrs['xmin'])
+  if n == 0:
+    return []
+  order = np.argsort(arrs['xmin'], kind='mergesort')
+  reach = np.maximum.accumulate(arrs['xmax'][order])
+  # a new cluster starts where a segment begins right of everything seen before.
+  cut = np.nonzero(arrs['xmin'][order][1:] > reach[:-1] + ZSORT_EPS)[0] + 1
+  return [np.sort(c) for c in np.split(order, cut)]
+
+
+def winding_numbers(rows, pts, block_size=100000):
+  """
+  The winding number of each point in pts around the closed polygons, whose segments are
+  the rows x0, y0, x1, y1 (as from seg_rows()). pts is an array of x, y.
+  Counterclockwise in a y-up frame counts +1. At most block_size point-segment pairs
+  are compared at once.
+  """
+  rows = np.asarray(rows, dtype=float).reshape(-1, 4)
+  pts = np.asarray(pts, dtype=float).reshape(-1, 2)
+  (x0, y0, x1, y1) = (rows[:,0], rows[:,1], rows[:,2], rows[:,3])
+  w = np.zeros(len(pts), dtype=int)
+  step = max(1, block_size // max(1, len(rows)))
+  for b in range(0, len(pts), step):
+    px = pts[b:b+step, 0:1]
+    py = pts[b:b+step, 1:2]
+    side = (x1 - x0) * (py - y0) - (px - x0) * (y1 - y0)    # > 0: the point is left of the segment
+    w[b:b+step] = ((y0 <= py) & (y1 > py) & (side > 0)).sum(axis=1) - ((y0 > py) & (y1 <= py) & (side < 0)).sum(axis=1)
+  return w
+
+
+def facing_away(rows, rings, R, evenodd=False, probe=0.0001, eps=ZSORT_EPS):
+  """
+  The side faces of a closed, filled object that point away from the viewer.
+  rows are the seg_rows() of the outline in the object plane, rings is a list of
+  (first row, number of rows), one per closed subpath. R rotates object coordinates
+  (row vectors) into the view. The viewer looks from -z.
+  The filled side of a ring is probed once, just left of its longest segment, at probe
+  times the segment length. Only rings whose bounding box contains the probe are counted.
+  Rings must not cross each other, then all segments of a ring have the filled side
+  on the same side.
+  Returns a bool array, True where the outward normal of a segment points away.
+  """
+  rows = np.asarray(rows, dtype=float).reshape(-1, 4)
+  left = np.column_stack((rows[:,1]-rows[:,3], rows[:,2]-rows[:,0]))
+  first = np.array([r[0] for r in rings], dtype=np.intp)
+  last = first + np.array([r[1] for r in rings], dtype=np.intp)
+  (x, y) = (rows[:,0], rows[:,1])       # the rings are closed: all points are a start point.
+  box = [(x[f:l].min(), y[f:l].min(), x[f:l].max(), y[f:l].max()) if l > f else (0, 0, -1, -1)
+         for (f, l) in zip(first.tolist(), last.tolist())]
+  box = np.array(box, dtype=float).reshape(-1, 4)
+  sign = np.ones(len(rows))
+  for r in range(len(first)):
+    (f, l) = (first[r], last[r])
+    if l <= f: continue
+    j = f + int(np.argmax((left[f:l]**2).sum(axis=1)))
+    p = (rows[j,:2] + rows[j,2:]) / 2 + probe * left[j]
+    near = np.nonzero((box[:,0] <= p[0]) & (box[:,2] >= p[0]) & (box[:,1] <= p[1]) & (box[:,3] >= p[1]))[0]
+    if len(near) == 0: continue         # outside of all rings
+    w = winding_numbers(rows[np.concatenate([np.arange(first[k], last[k]) for k in near])], [p])[0]
+    if (w % 2 != 0) if evenodd else (w != 0):
+      sign[f:l] = -1                    # the filled side is left: the outward normal points right.
+  n3 = np.matmul(np.column_stack((sign[:,None] * left, np.zeros(len(rows)))), R)
+  return n3[:,2] > eps * np.linalg.norm(n3, axis=1)
+
+
+def cluster_order(rows, idx, engine='sweep', block_size=100000, tsort=None, groups=None):
+  """
+  Sort one cluster of segments. rows are the seg_rows() of all segments,
+  idx is the list of segment indices in the cluster.
+  engine is 'sweep' for sweep_edges() or 'pairs' for cmp2D_batch() of overlap_pairs().
+  tsort is the topological sort class, e.g. TSortArray. Edges are passed in bulk with addEdges().
+  Cycles are broken inside the cluster, falling back to the average y (depth) of the segments.
+  With groups (groups[i] is the group id of segment idx[i]), the segments of a group are sorted
+  as one unit: edges between segments become edges between their groups.
+  Returns (idx reordered frontmost last, or the group ids with groups, number of cycles broken).
+  """
+  if len(idx) < 2:
+    return ((list(idx) if groups is None else [int(g) for g in groups]), 0)
+  sub = rows[idx]
+  key = sub[:,1]+sub[:,3]
+  if engine == 'pairs':
+    arrs = seg_arrays(sub)
+    (u, v) = batch_edges(arrs, overlap_pairs(arrs, block_size))
+  else:
+    e = np.array(sweep_edges([((r[0], r[1]), (r[2], r[3])) for r in sub.tolist()]), dtype=np.intp).reshape(-1, 2)
+    (u, v) = (e[:,0], e[:,1])
+  ids = idx
+  if groups is not None:
+    (ids, inv) = np.unique(np.asarray(groups), return_inverse=True)
+    inv = inv.ravel()
+    key = np.bincount(inv, weights=key) / np.bincount(inv)
+    (u, v) = (inv[u], inv[v])
+    keep = u != v
+    (u, v) = (u[keep], v[keep])
+    ids = ids.tolist()
+  k = tsort(len(ids), break_cycles=True, key=key)
+  k.addEdges(u, v)
+  order = k.sort()
+  return ([ids[i] for i in order], k.cycles_broken)
+
+
+def _cluster_order_shm(task):
+  """ Pool worker for zsort_clusters(): cluster_order() on rows found in shared memory. """
+  (name, n, idx, engine, block_size, tsort, groups) = task
+  try:
+    shm = shared_memory.SharedMemory(name=name, track=False)   # python >= 3.13
+  except TypeError:
+    shm = shared_memory.SharedMemory(name=name)
+  try:
+    rows = np.ndarray((n, 4), dtype=np.float64, buffer=shm.buf)
+    return cluster_order(rows, idx, engine, block_size, tsort, groups)
+  finally:
+    rows = None         # release the buffer before closing.
+    shm.close()
+
+
+def zsort_clusters(rows, clusters, engine='sweep', block_size=100000, tsort=None, workers=1, group=None):
+  """
+  Sort independent clusters (from x_clusters()) with cluster_order() and concatenate
+  the results in cluster order. Returns (order, number of cycles broken).
+  With group (an array of one group id per segment), the order is a list of group ids.
+  All segments of a group must be in the same cluster.
+
+  With workers > 1 the clusters are sorted concurrently on a process pool. workers=0
+  uses one process per CPU. The rows are passed to the workers through
+  multiprocessing.shared_memory, only the index lists are pickled. The result is the
+  same as with workers=1. Without shared_memory (python < 3.8), or with less than two
+  clusters to sort, everything runs in this process.
+  """
+  clusters = [c.tolist() if isinstance(c, np.ndarray) else list(c) for c in clusters]
+  if workers < 1:
+    workers = multiprocessing.cpu_count()
+  big = [c for c in clusters if len(c) > 1]
+  if workers < 2 or len(big) < 2 or shared_memory is None:
+    order = []
+    cycles = 0
+    for c in clusters:
+      (o, n) = cluster_order(rows, c, engine, block_size, tsort, None if group is None else group[c])
+      order += o
+      cycles += n
+    return (order, cycles)
+
+  rows = np.ascontiguousarray(rows, dtype=np.float64)
+  shm = shared_memory.SharedMemory(create=True, size=max(1, rows.nbytes))
+  try:
+    np.ndarray(rows.shape, dtype=np.float64, buffer=shm.buf)[:] = rows
+    pool = multiprocessing.Pool(min(workers, len(big)))
+    try:
+      # largest clusters first, for better load balance.
+      tasks = sorted(big, key=len, reverse=True)
+      done = pool.map(_cluster_order_shm, [(shm.name, len(rows), c, engine, block_size, tsort,
+                                            None if group is None else group[c]) for c in tasks], 1)
+    finally:
+      pool.close()
+      pool.join()
+    sorted_c = {}
+    for (c, o) in zip(tasks, done):
+      sorted_c[c[0]] = o[0]
+    order = []
+    for c in clusters:
+      if len(c) > 1:
+        order += sorted_c[c[0]]
+      else:
+        order += c if group is None else [int(group[i]) for i in c]
+    return (order, sum([o[1] for o in done]))
+  finally:
+    shm.close()
+    shm.unlink()
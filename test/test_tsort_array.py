@@ -0,0 +1,104 @@
+#! /usr/bin/python
+#
+# TSortArray must produce a valid topological order, the same for edges added
+# with addPre() or in bulk with addEdges(), and keep unrelated vertices in index order.
+# With break_cycles=True, cycles are resolved locally and counted.
+#
+# CAUTION: test with python2 and python3!
+#
+
+from __future__ import print_function
+import sys
+import numpy as np
+
+sys.path.append('../src/')
+sys.path.append('src/')
+from tsort import TSort, TSortArray
+
+
+def check_valid(order, u, v, n):
+  assert(sorted(order) == list(range(n)))
+  pos = [0]*n
+  for i in range(n):
+    pos[order[i]] = i
+  for (a, b) in zip(u, v):
+    assert(pos[a] < pos[b]), "%d must sort before %d" % (a, b)
+
+
+# the example from src/tsort.py
+k = TSortArray(6)
+k.addEdges(np.array([5, 5, 4, 4, 2, 3]), np.array([2, 0, 0, 1, 3, 1]))
+print(k.sort())
+assert(k.sort() == [4, 5, 0, 2, 3, 1])
+
+# no edges: document order
+k = TSortArray(5)
+assert(k.sort() == [0, 1, 2, 3, 4])
+
+# random DAGs: edges always point from a lower to a higher rank
+rnd = np.random.RandomState(42)
+for n in (2, 10, 100, 1000):
+  rank = rnd.permutation(n)
+  a = rnd.randint(0, n, 3*n)
+  b = rnd.randint(0, n, 3*n)
+  keep = rank[a] < rank[b]
+  (u, v) = (a[keep], b[keep])
+  k1 = TSortArray(n)
+  k1.addEdges(u, v)
+  o1 = k1.sort()
+  check_valid(o1, u.tolist(), v.tolist(), n)
+  k2 = TSortArray(n)
+  for (i, j) in zip(u.tolist(), v.tolist()):
+    k2.addPre(i, j)
+  assert(k2.sort() == o1)
+  k3 = TSort(n)
+  k3.addEdges(u, v)
+  check_valid(k3.sort(), u.tolist(), v.tolist(), n)
+  # whenever two vertices are free at the same time, the lower index comes first.
+  # thus the first vertex is the lowest one without predecessors.
+  assert(o1[0] == min(set(range(n)) - set(v.tolist())))
+
+# cycles are detected
+k = TSortArray(3)
+k.addEdges([0, 1, 2], [1, 2, 0])
+try:
+  k.sort()
+  assert(False), "cyclic dependency not detected"
+except Exception as e:
+  assert(str(e) == "cyclic dependency")
+
+# two separate cycles in a chain. Only edges inside the cycles may be dropped.
+#  0 -> 1 -> 2 -> 0 -> 3 -> 4 -> 5 -> 6 -> 4,  7 -> 7
+u = [0, 1, 2, 0, 3, 4, 5, 6, 7]
+v = [1, 2, 0, 3, 4, 5, 6, 4, 7]
+k = TSortArray(8, break_cycles=True)
+k.addEdges(u, v)
+o = k.sort()
+print(o, k.cycles_broken, "cycles broken,", k.edges_dropped, "edges dropped")
+assert(k.cycles_broken == 3)
+assert(k.edges_dropped == 3)
+assert(o == [0, 1, 2, 3, 4, 5, 6, 7])
+
+# the fallback key decides the order inside a cycle, e.g. average depth
+k = TSortArray(8, break_cycles=True, key=[0, 2, 1, 3, 6, 5, 4, 7])
+k.addEdges(u, v)
+o = k.sort()
+print(o)
+assert(o == [0, 2, 1, 3, 6, 5, 4, 7])
+
+# random graphs with cycles always finish. Without cycles nothing is dropped.
+for n in (10, 100, 1000):
+  a = rnd.randint(0, n, 2*n)
+  b = rnd.randint(0, n, 2*n)
+  k = TSortArray(n, break_cycles=True)
+  k.addEdges(a, b)
+  o = k.sort()
+  assert(sorted(o) == list(range(n)))
+  rank = rnd.permutation(n)
+  keep = rank[a] < rank[b]
+  k = TSortArray(n, break_cycles=True)
+  k.addEdges(a[keep], b[keep])
+  check_valid(k.sort(), a[keep].tolist(), b[keep].tolist(), n)
+  assert(k.cycles_broken == 0 and k.edges_dropped == 0)
+
+print("OK.")
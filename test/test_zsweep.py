@@ -0,0 +1,190 @@
+#! /usr/bin/python
+#
+# Compare the sweep-line ordering engine against the all-pairs cmp2D() loop.
+# Every pair that cmp2D() can decide must appear in the same order in the
+# topological sort built from sweep_edges().
+# The vectorized cmp2D_batch() must agree with cmp2D() on every pair.
+# overlap_pairs() must not prune any pair that cmp2D() can decide.
+# x_clusters() must not separate any pair that cmp2D() can decide.
+# zsort_clusters() on a process pool must return the same order as without.
+# zsort_clusters() with groups must return each group once.
+# Vertical segments off by less than ZSORT_EPS, and segments touching at an end point must meet.
+# winding_numbers() must count the square inside the star twice, and the outside not at all.
+# facing_away() must find the side faces hidden behind an extruded object, also in back view.
+#
+# CAUTION: test with python2 and python3!
+#
+
+from __future__ import print_function
+import sys
+import numpy as np
+
+sys.path.append('../src/')
+sys.path.append('src/')
+from tsort import TSort, TSortArray
+from zsort2d import cmp2D, sweep_edges, cmp2D_batch, pair_blocks, overlap_pairs, x_clusters
+from zsort2d import seg_arrays, seg_rows, zsort_clusters, winding_numbers, facing_away
+
+
+def polygon_segs(pts, segs):
+  for i in range(len(pts)):
+    segs.append([pts[i], pts[(i+1) % len(pts)], len(segs)])
+
+
+def star(cx, cy, r1, r2, n, phase=0.0):
+  pts = []
+  for i in range(2*n):
+    r = r1 if i % 2 == 0 else r2
+    a = phase + np.pi*i/n
+    pts.append(np.array([cx + r*np.cos(a), cy + r*np.sin(a)]))
+  return pts
+
+
+def check_batch(segs, block_size):
+  arrs = seg_arrays(segs)
+  npairs = 0
+  for (I, J) in pair_blocks(len(segs), block_size):
+    assert(len(I) <= max(block_size, len(segs)))
+    r = cmp2D_batch(arrs, I, J)
+    for k in range(len(I)):
+      assert(I[k] < J[k])
+      c = cmp2D(segs[I[k]], segs[J[k]])
+      assert(r[k] == (c or 0)), "cmp2D_batch(%d, %d) = %d, expected %s" % (I[k], J[k], r[k], c)
+    npairs += len(I)
+  assert(npairs == len(segs)*(len(segs)-1)//2)
+
+  cand = set()
+  for (I, J) in overlap_pairs(arrs, block_size):
+    cand.update(zip(I.tolist(), J.tolist()))
+  for i in range(len(segs)):
+    for j in range(i+1, len(segs)):
+      if cmp2D(segs[i], segs[j]) is not None:
+        assert((i, j) in cand), "pair (%d, %d) was pruned" % (i, j)
+
+  cluster = [0]*len(segs)
+  clusters = x_clusters(arrs)
+  assert(sorted(np.concatenate(clusters).tolist()) == list(range(len(segs))))
+  for c in range(len(clusters)):
+    for i in clusters[c]:
+      cluster[i] = c
+  for (i, j) in cand:
+    assert(cluster[i] == cluster[j]), "pair (%d, %d) split into clusters" % (i, j)
+  return (len(cand), len(clusters))
+
+
+def check_order(segs):
+  k = TSort(len(segs))
+  for (i, j) in sweep_edges(segs):
+    k.addPre(i, j)
+  order = k.sort()
+  assert(sorted(order) == list(range(len(segs))))
+  pos = [0]*len(segs)
+  for n in range(len(order)):
+    pos[order[n]] = n
+  decided = 0
+  for i in range(len(segs)):
+    for j in range(i+1, len(segs)):
+      r = cmp2D(segs[i], segs[j])
+      if r is None: continue
+      decided += 1
+      if r < 0: assert pos[i] < pos[j], "%d must sort before %d" % (i, j)
+      if r > 0: assert pos[j] < pos[i], "%d must sort before %d" % (j, i)
+  return decided
+
+
+# concave star with a square hole
+segs = []
+polygon_segs(star(0, 0, 100, 40, 7), segs)
+polygon_segs([np.array(p) for p in ((-10, -10), (10, -10), (10, 10), (-10, 10))], segs)
+print("star: ", len(segs), "segments,", check_order(segs), "decided pairs")
+w = winding_numbers(seg_rows(segs), [(0, 0), (30, 0), (0, 60), (200, 0), (0, -30)], 3)
+assert(w[0] == 2 and w[1] == 1 and w[3] == 0 and w[4] == 1), "winding numbers %s" % w
+
+# the same, seen from many directions. Rotation by 90 deg produces vertical segments.
+for deg in (15, 30, 45, 90, 133, 180, 270):
+  phi = np.radians(deg)
+  R = np.array(((np.cos(phi), np.sin(phi)), (-np.sin(phi), np.cos(phi))))
+  rsegs = [[np.matmul(s[0], R), np.matmul(s[1], R), s[2]] for s in segs]
+  print("star at", deg, "deg: ", check_order(rsegs), "decided pairs")
+  check_batch(rsegs, 7)
+
+# a row of gears, far apart and nested
+segs = []
+for i in range(6):
+  polygon_segs(star(300*i, 20*i, 120, 100, 24, 0.1*i), segs)
+  polygon_segs(star(300*i, 20*i, 30, 25, 8), segs)
+print("gears: ", len(segs), "segments,", check_order(segs), "decided pairs")
+n = len(segs)
+(npairs, nclusters) = check_batch(segs, 5000)
+print("gears: ", npairs, "of", n*(n-1)//2, "pairs overlap in x,", nclusters, "clusters")
+assert(nclusters == 6)
+
+# vertical segments slightly left or right of an end point of a horizontal segment
+for v in (((1-1e-9, 1), (1+1e-9, 3)), ((1+1e-9, -3), (1-1e-9, -1)), ((2+1e-9, 1), (2-1e-9, 3))):
+  vsegs = [[np.array((1.0, 0.0)), np.array((2.0, 0.0)), 0], [np.array(v[0]), np.array(v[1]), 1]]
+  assert(check_order(vsegs) == 1), "near-tie vertical %s" % (v,)
+
+# rectangles on a grid, touching in x. Rotation by 90 deg produces near-tie verticals.
+rects = []
+for (x, y, w, h) in ((0, 0, 4, 2), (4, 6, 6, 2), (10, 0, 2, 4), (-4, 10, 4, 4), (0, 3, 2, 2)):
+  polygon_segs([np.array(p, dtype=float) for p in ((x, y), (x+w, y), (x+w, y+h), (x, y+h))], rects)
+for deg in (0, 90, 180, 270):
+  phi = np.radians(deg)
+  R = np.array(((np.cos(phi), np.sin(phi)), (-np.sin(phi), np.cos(phi))))
+  rsegs = [[np.matmul(s[0], R), np.matmul(s[1], R), s[2]] for s in rects]
+  print("rectangles at", deg, "deg: ", check_order(rsegs), "decided pairs")
+
+def rot(axis, deg):
+  # same as genRx(), genRy() in flatproj.py: for row vectors.
+  (c, s) = (np.cos(np.radians(deg)), np.sin(np.radians(deg)))
+  if axis == 'x': return np.array(((1, 0, 0), (0, c, s), (0, -s, c)))
+  return np.array(((c, 0, -s), (0, 1, 0), (s, 0, c)))
+
+
+def check_facing(segs, rings, R, evenodd, depth=5.0):
+  # a face is hidden, if a point just in front of it, towards the viewer at -z, is inside the extruded object.
+  rows = seg_rows(segs)
+  away = facing_away(rows, rings, R, evenodd)
+  Rinv = np.linalg.inv(R)
+  view = np.matmul([0, 0, 1.0], Rinv)
+  nculled = 0
+  for i in range(len(rows)):
+    n = np.array([rows[i,3]-rows[i,1], rows[i,0]-rows[i,2], 0])
+    if abs(np.dot(n, view)) < 0.01 * np.linalg.norm(n): continue     # seen edge-on
+    m = np.matmul([(rows[i,0]+rows[i,2])/2, (rows[i,1]+rows[i,3])/2, depth/2], R)
+    q = np.matmul(m - [0, 0, 0.001], Rinv)
+    w = winding_numbers(rows, [q[:2]])[0]
+    hidden = 0 < q[2] < depth and ((w % 2 != 0) if evenodd else (w != 0))
+    assert(away[i] == hidden), "face %d: facing_away %s, hidden %s" % (i, away[i], hidden)
+    nculled += hidden
+  return nculled
+
+# square with a square hole. The hole is clockwise, or counterclockwise with evenodd.
+for (hole, evenodd) in (([(3, 3), (3, 7), (7, 7), (7, 3)], False), ([(3, 3), (3, 7), (7, 7), (7, 3)], True),
+                        ([(3, 3), (7, 3), (7, 7), (3, 7)], True)):
+  square = []
+  polygon_segs([np.array(p, dtype=float) for p in ((0, 0), (10, 0), (10, 10), (0, 10))], square)
+  polygon_segs([np.array(p, dtype=float) for p in hole], square)
+  tilt = np.matmul(rot('y', 42), rot('x', 7))
+  for (name, uR) in (('front', np.eye(3)), ('x+90', rot('x', 90)), ('x-90', rot('x', -90)), ('y+180', rot('y', 180))):
+    R = np.matmul(uR, tilt)
+    backview = np.matmul([0, 0, 1.0], R)[2] < 0
+    n = check_facing(square, [(0, 4), (4, 4)], R, evenodd)
+    assert(n == 4), "%s: %d faces hidden" % (name, n)
+    print("facing:", name, "evenodd" if evenodd else "nonzero", "back view" if backview else "", n, "of 8 faces hidden")
+
+if __name__ == '__main__':
+  rows = seg_rows(segs)
+  clusters = x_clusters(seg_arrays(rows))
+  for engine in ('sweep', 'pairs'):
+    (o1, c1) = zsort_clusters(rows, clusters, engine, 1000, TSortArray, workers=1)
+    (o3, c3) = zsort_clusters(rows, clusters, engine, 1000, TSortArray, workers=3)
+    assert(o1 == o3 and c1 == 0 and c3 == 0)
+    assert(sorted(o1) == list(range(len(segs))))
+  print("pool: ", len(clusters), "clusters sorted in parallel")
+  group = np.arange(len(segs)) // 4
+  (og, cg) = zsort_clusters(rows, clusters, 'sweep', 1000, TSortArray, workers=1, group=group)
+  assert(sorted(og) == list(range(group[-1]+1)))
+  print("groups: ", len(og), "groups sorted,", cg, "cycles broken")
+
+print("OK.")